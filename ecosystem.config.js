@@ -14,6 +14,8 @@ module.exports = {
       env: {
         GATEWAY_PORT: '11435',
         SCHEDULING_STRATEGY: 'round_robin',
+        // 多進程模式（可选，默认单进程）
+        // GATEWAY_WORKERS: '4',
         // 配置文件路径（可选，默认使用 config/node_config.json）
         // NODE_CONFIG_FILE: 'config/node_config.json'
       },
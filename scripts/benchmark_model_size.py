@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+get_model_size_b 微基準測試
+
+生成大量 model_name_patterns（默認 10000 個），分別測量：
+- 逐個子串查找（舊實現：每次調用都排序並掃描所有模式）
+- 編譯後的匹配器（不經過緩存）
+- 帶 LRU 緩存的 get_model_size_b（熱路徑上的實際開銷）
+
+用法：
+    python scripts/benchmark_model_size.py [模式數量] [請求數]
+"""
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import ollama_gateway as gateway  # noqa: E402
+
+
+def naive_pattern_size(model_name: str):
+    """舊實現的模式匹配部分，用於對照結果和耗時"""
+    sorted_patterns = sorted(gateway.model_patterns.items(), key=lambda x: x[1], reverse=True)
+    for pattern, size in sorted_patterns:
+        if pattern.lower() in model_name.lower():
+            return size
+    return None
+
+
+def random_word(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def timed(fn, names, repeat: int = 1) -> float:
+    """返回每次調用的平均耗時（微秒）"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for name in names:
+            fn(name)
+    return (time.perf_counter() - start) / (len(names) * repeat) * 1e6
+
+
+def main():
+    pattern_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    request_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rng = random.Random(42)
+
+    patterns = {}
+    while len(patterns) < pattern_count:
+        patterns[f"{random_word(rng, rng.randint(4, 10))}-{rng.randint(1, 400)}x"] = rng.randint(1, 700)
+    pattern_list = list(patterns)
+
+    # 一半請求命中某個模式，一半不命中；模型名中不含 "数字b"，確保走到模式匹配這一步
+    names = []
+    for i in range(request_count):
+        if i % 2:
+            names.append(f"{random_word(rng, 3)}{rng.choice(pattern_list)}-instruct")
+        else:
+            names.append(f"{random_word(rng, 12)}-chat")
+
+    gateway.model_patterns = patterns
+    gateway.model_name_mapping = {}
+    gateway.model_size_matcher = None
+    gateway.model_size_cache.clear()
+
+    build_start = time.perf_counter()
+    gateway.model_size_matcher = gateway.ModelSizeMatcher(patterns)
+    build_ms = (time.perf_counter() - build_start) * 1000
+
+    for name in names:
+        expected = naive_pattern_size(name)
+        actual = gateway.model_size_matcher.match(name.lower())
+        if expected != actual:
+            raise SystemExit(f"Mismatch for {name}: naive={expected}, matcher={actual}")
+
+    naive_us = timed(naive_pattern_size, names[:200])
+    matcher_us = timed(lambda n: gateway.resolve_model_size_b(n), names)
+    gateway.model_size_cache.clear()
+    cached_us = timed(lambda n: gateway.get_model_size_b(n), names, repeat=20)
+
+    print(f"patterns: {pattern_count}, distinct model names: {request_count}")
+    print(f"matcher build:              {build_ms:10.1f} ms (once per config load)")
+    print(f"naive substring scan:       {naive_us:10.1f} µs/request")
+    print(f"compiled matcher (no memo): {matcher_us:10.1f} µs/request")
+    print(f"get_model_size_b (LRU):     {cached_us:10.1f} µs/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+#!/bin/bash
+
+# 在本機啟動兩個組成集群的網關（用於測試 gossip 和健康檢查分片）
+# 使用 config/node_config.json 中的節點，自動加上兩個網關的 peers 配置
+
+BASE_CONFIG="${NODE_CONFIG_FILE:-config/node_config.json}"
+PORT1="${GATEWAY_PORT1:-11435}"
+PORT2="${GATEWAY_PORT2:-11436}"
+CLUSTER_CONFIG="$(mktemp -t gateway-cluster-XXXXXX.json)"
+# 集群模式需要共享密鑰，未設置時為本次測試隨機生成
+export CLUSTER_SECRET="${CLUSTER_SECRET:-$(python3 -c 'import secrets; print(secrets.token_hex(16))')}"
+
+python3 - "$BASE_CONFIG" "$CLUSTER_CONFIG" "$PORT1" "$PORT2" <<'EOF'
+import json
+import sys
+
+base, target, port1, port2 = sys.argv[1:]
+with open(base, encoding="utf-8") as f:
+    config = json.load(f)
+config["peers"] = [
+    {"name": "gw1", "url": f"http://127.0.0.1:{port1}"},
+    {"name": "gw2", "url": f"http://127.0.0.1:{port2}"},
+]
+with open(target, "w", encoding="utf-8") as f:
+    json.dump(config, f, indent=2, ensure_ascii=False)
+EOF
+
+cleanup() {
+    kill "$PID1" "$PID2" 2>/dev/null
+    rm -f "$CLUSTER_CONFIG"
+}
+trap cleanup EXIT INT TERM
+
+echo "Starting gw1 on port $PORT1 and gw2 on port $PORT2 (config: $CLUSTER_CONFIG)..."
+NODE_CONFIG_FILE="$CLUSTER_CONFIG" GATEWAY_NAME=gw1 GATEWAY_PORT="$PORT1" python3 src/ollama_gateway.py &
+PID1=$!
+NODE_CONFIG_FILE="$CLUSTER_CONFIG" GATEWAY_NAME=gw2 GATEWAY_PORT="$PORT2" python3 src/ollama_gateway.py &
+PID2=$!
+
+echo "Cluster view: curl http://localhost:$PORT1/api/cluster"
+wait
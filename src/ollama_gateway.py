@@ -7,19 +7,86 @@ import asyncio
 import time
 import json
 import re
-from typing import List, Optional, Dict, Set, Tuple
+import random
+import bisect
+import hashlib
+import hmac
+import math
+import mmap
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import multiprocessing
+import queue
+import atexit
+import logging
+import logging.handlers
+from collections import deque, OrderedDict
+from datetime import datetime
+from typing import List, Optional, Dict, Set, Tuple, AsyncIterator
 from fastapi import FastAPI, Request, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse
 import httpx
 from dotenv import load_dotenv
 import uvicorn
-from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST, CollectorRegistry, REGISTRY, multiprocess
 from fastapi.responses import Response as MetricsResponse
 
 # 加載環境變量
 load_dotenv()
 
+# 日志：請求熱路徑只把日志記錄放入隊列，由後台線程寫入 stdout，不阻塞事件循環
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "%(asctime)s %(levelname)-7s %(name)s: %(message)s")
+# 按類別採樣 INFO 及以下的日志，如 "proxy=0.1,routing=0.01"；WARNING 及以上始終輸出
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+
+class CategorySampler(logging.Filter):
+    """按日志類別（logger 名稱的最後一段）採樣低級別日志"""
+    
+    def __init__(self, spec: str):
+        super().__init__()
+        self.rates: Dict[str, float] = {}
+        for item in spec.split(","):
+            category, _, rate = item.partition("=")
+            if category.strip() and rate.strip():
+                self.rates[category.strip()] = float(rate)
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(record.name.rsplit(".", 1)[-1])
+        return rate is None or random.random() < rate
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """配置 gateway.* 日志：QueueHandler 入隊，QueueListener 在後台線程輸出"""
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(CategorySampler(LOG_SAMPLE_RATES))
+    
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    root_logger = logging.getLogger("gateway")
+    root_logger.setLevel(LOG_LEVEL)
+    root_logger.addHandler(queue_handler)
+    root_logger.propagate = False
+    return listener
+
+
+log_listener = setup_logging()
+proxy_log = logging.getLogger("gateway.proxy")
+routing_log = logging.getLogger("gateway.routing")
+health_log = logging.getLogger("gateway.health")
+
 # 加載節點配置
 # 获取项目根目录（src 的父目录）
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -59,6 +126,12 @@ model_name_mapping = {}
 default_model_size = 7
 config_data = {}  # 保存完整的配置數據
 
+# 網關集群：配置文件中 "peers" 列出的網關互相交換節點狀態（見 gossip_loop），本網關按 GATEWAY_NAME 排除自己
+GATEWAY_NAME = os.getenv("GATEWAY_NAME") or f"{socket.gethostname()}:{os.getenv('GATEWAY_PORT', '11435')}"
+# gossip 端點與代理共用端口，請求必須帶相同的 X-Cluster-Secret 頭；未設置時不啟用集群模式
+CLUSTER_SECRET = os.getenv("CLUSTER_SECRET", "")
+cluster_peers: List[Dict] = []
+
 def resolve_env_var(value: str) -> str:
     """解析環境變量引用，支持 ${VAR} 格式"""
     if not isinstance(value, str):
@@ -83,7 +156,8 @@ def resolve_config_values(config: Dict) -> Dict:
 
 def load_config():
     """加載節點配置文件"""
-    global node_config, model_patterns, model_name_mapping, default_model_size, config_data, NODES
+    global node_config, model_patterns, model_name_mapping, default_model_size, config_data, NODES, tags_catalog, routing_index
+    global model_size_matcher, cluster_peers
     try:
         print(f"📂 Loading config from: {CONFIG_FILE}")
         with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
@@ -97,6 +171,15 @@ def load_config():
             model_patterns = config_data.get("model_name_patterns", {})
             model_name_mapping = config_data.get("model_name_mapping", {})
             default_model_size = config_data.get("default_model_size_b", 7)
+            cluster_peers = [
+                peer for peer in config_data.get("peers", [])
+                if peer.get("name") and peer.get("url") and peer["name"] != GATEWAY_NAME
+            ]
+            if cluster_peers and not CLUSTER_SECRET:
+                # 沒有密鑰時任何能訪問網關的客戶端都可以冒充對等網關，注入負載或節點狀態，因此不啟用集群模式
+                print("❌ Config lists gateway peers but CLUSTER_SECRET is not set: cluster mode disabled, "
+                      "this gateway probes all nodes on its own")
+                cluster_peers = []
             
             # 從配置文件構建 NODES 列表
             NODES.clear()
@@ -113,6 +196,8 @@ def load_config():
                         "api_key": node_cfg.get("api_key", ""),
                         "timeout_seconds": node_cfg.get("timeout_seconds", 300),
                         "headers": node_cfg.get("headers", {}),
+                        "max_connections": node_cfg.get("max_connections", DEFAULT_NODE_MAX_CONNECTIONS),
+                        "max_keepalive": node_cfg.get("max_keepalive", DEFAULT_NODE_MAX_KEEPALIVE),
                         "weight": 1.0,
                         "enabled": node_cfg.get("enabled", True),
                         "config": node_cfg,  # 保存完整配置
@@ -135,6 +220,9 @@ def load_config():
                         "type": "local",
                         "hosts": hosts,
                         "port": node_cfg.get("port", 11434),
+                        "timeout_seconds": node_cfg.get("timeout_seconds", 300),
+                        "max_connections": node_cfg.get("max_connections", DEFAULT_NODE_MAX_CONNECTIONS),
+                        "max_keepalive": node_cfg.get("max_keepalive", DEFAULT_NODE_MAX_KEEPALIVE),
                         "weight": node_cfg.get("weight", 1.0),
                         "enabled": node_cfg.get("enabled", True),
                         "config": node_cfg,
@@ -143,6 +231,8 @@ def load_config():
                 print(f"      ✅ Added node: {node['name']} (type: {node.get('type', 'local')})")
             
             print(f"   📊 Total nodes in NODES: {len(NODES)}")
+            # 節點的地址、超時或認證信息可能已變更，淘汰舊的連接池，下次使用時按新配置重建
+            retire_node_clients()
             # 重新初始化節點狀態（只為新節點）
             for node in NODES:
                 if node["name"] not in node_stats:
@@ -151,10 +241,12 @@ def load_config():
                         "total_requests": 0,
                         "failed_requests": 0,
                         "last_health_check": None,
-                        "is_healthy": True,
+                        "is_healthy": False,  # 首次健康檢查通過前不參與路由
                         "current_weight": node["weight"],
                         "effective_weight": node["weight"],
                         "last_model_sync": None,
+                        "consecutive_failures": 0,
+                        "next_health_check": None,
                     }
                     node_models[node["name"]] = set()
                 else:
@@ -168,6 +260,15 @@ def load_config():
                 if node_name not in node_names:
                     del node_stats[node_name]
                     del node_models[node_name]
+                    node_tags.pop(node_name, None)
+                    node_loaded_models.pop(node_name, None)
+            # 節點集合可能已變化，聚合的模型目錄和路由索引需要重建
+            tags_catalog = None
+            routing_index = None
+        
+        # 模型大小規則可能已變化：在加載配置時重新編譯匹配器（不留到第一個請求），並清空緩存
+        model_size_matcher = ModelSizeMatcher(model_patterns)
+        model_size_cache.clear()
             
         print(f"✅ Loaded node configuration from {CONFIG_FILE}")
         local_nodes = sum(1 for n in NODES if n.get("type") == "local")
@@ -208,7 +309,6 @@ def save_config(new_config: dict) -> Tuple[bool, str]:
         backup_filename = f"{os.path.basename(CONFIG_FILE)}.backup.{int(time.time())}"
         backup_file = os.path.join(backups_dir, backup_filename)
         if os.path.exists(CONFIG_FILE):
-            import shutil
             shutil.copy2(CONFIG_FILE, backup_file)
             print(f"📦 Created backup: {backup_file}")
         
@@ -236,6 +336,115 @@ NODES: List[Dict] = []
 node_stats: Dict[str, Dict] = {}
 node_models: Dict[str, Set[str]] = {}
 
+# 每個節點已加載到內存的模型（來自 /api/ps）：{node_name: {完整模型名: {"size_vram": int, "expires_at": float}}}
+node_loaded_models: Dict[str, Dict[str, Dict]] = {}
+
+# 每個節點最近一次 /api/tags 返回的模型列表（健康檢查時更新），用於聚合 /api/tags 緩存
+node_tags: Dict[str, List[Dict]] = {}
+# 聚合後的模型目錄緩存：{"body": bytes, "etag": str, "built_at": float, "checked_at": float}，None 表示需要重建
+# checked_at 是最近一次確認節點數據的時間（健康檢查發現模型沒有變化時只更新它，不重建）
+tags_catalog: Optional[Dict] = None
+# 模型 → 候選節點的路由索引（見 RoutingIndex），None 表示需要重建
+routing_index = None
+
+# 每個節點的 HTTP 客戶端（連接池），由 get_node_client() 按需創建
+node_clients: Dict[str, httpx.AsyncClient] = {}
+
+# 連接池默認上限，可在 node_config.json 中按節點用 max_connections / max_keepalive 覆蓋
+DEFAULT_NODE_MAX_CONNECTIONS = int(os.getenv("NODE_MAX_CONNECTIONS", "100"))
+DEFAULT_NODE_MAX_KEEPALIVE = int(os.getenv("NODE_MAX_KEEPALIVE", "20"))
+NODE_KEEPALIVE_EXPIRY = float(os.getenv("NODE_KEEPALIVE_EXPIRY", "60"))
+
+class ModelSizeMatcher:
+    """model_name_patterns 的多模式匹配器（Aho-Corasick 自動機）
+    
+    每次加載配置時編譯一次。匹配時只掃描一遍模型名稱，與模式數量無關；
+    多個模式同時命中時返回大小最大的一個（與按大小降序逐個查找子串的結果一致）。
+    """
+    
+    def __init__(self, patterns: Dict[str, int]):
+        # 優先級：大小降序，大小相同時保持配置中的順序
+        ordered = sorted(patterns.items(), key=lambda x: x[1], reverse=True)
+        self.sizes = [size for _, size in ordered]
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.best: List[Optional[int]] = [None]  # 每個狀態（含失敗鏈）命中的最高優先級模式
+        for priority, (pattern, _) in enumerate(ordered):
+            state = 0
+            for char in pattern.lower():
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(None)
+                state = next_state
+            if self.best[state] is None:
+                self.best[state] = priority
+        
+        # 按廣度優先計算失敗指針，並把失敗鏈上的命中合並到當前狀態
+        queue = deque(self.goto[0].values())
+        for state in queue:
+            self._inherit(state, 0)
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self._inherit(next_state, self.fail[next_state])
+    
+    def _inherit(self, state: int, fallback: int):
+        inherited = self.best[fallback]
+        if inherited is not None and (self.best[state] is None or inherited < self.best[state]):
+            self.best[state] = inherited
+    
+    def match(self, text: str) -> Optional[int]:
+        """返回 text 中命中的最大模型大小，沒有命中返回 None"""
+        goto, fail, best = self.goto, self.fail, self.best
+        state = 0
+        found: Optional[int] = best[0]
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            priority = best[state]
+            if priority is not None and (found is None or priority < found):
+                found = priority
+                if found == 0:
+                    break
+        return self.sizes[found] if found is not None else None
+
+
+# 編譯後的 model_name_patterns 匹配器（見 ModelSizeMatcher），由 load_config() 構建
+model_size_matcher: Optional[ModelSizeMatcher] = None
+# get_model_size_b 的 LRU 緩存：(model_name, full_model_name) -> 模型大小，load_config() 時清空
+model_size_cache: "OrderedDict[Tuple[str, Optional[str]], int]" = OrderedDict()
+MODEL_SIZE_CACHE_SIZE = int(os.getenv("MODEL_SIZE_CACHE_SIZE", "4096"))
+
+
+def retire_node_clients():
+    """淘汰當前所有節點客戶端
+    
+    舊客戶端上可能還有進行中的流式請求，因此不立即關閉，
+    而是在其超時時間過後再關閉。
+    """
+    if not node_clients:
+        return
+    retired = list(node_clients.values())
+    node_clients.clear()
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    for old_client in retired:
+        grace = old_client.timeout.read or 300.0
+        loop.call_later(grace, lambda c=old_client: asyncio.ensure_future(c.aclose()))
+
+
 # 初始加載配置
 load_config()
 
@@ -251,32 +460,214 @@ app.add_middleware(
 )
 
 # Prometheus metrics
+# 多進程模式下（主進程設置了 PROMETHEUS_MULTIPROC_DIR）各工作進程寫入自己的指標文件，
+# /metrics 渲染時匯總；Gauge 按 multiprocess_mode 聚合（單進程模式下該參數不起作用）
 request_count = Counter(
     "gateway_requests_total",
     "Total number of requests processed",
-    ["method", "endpoint", "node", "status"]
+    ["method", "endpoint", "node", "model", "status"]
 )
 
 request_duration = Histogram(
     "gateway_request_duration_seconds",
     "Request duration in seconds",
-    ["method", "endpoint", "node"]
+    ["method", "endpoint", "node", "model"]
 )
 
 active_connections = Gauge(
     "gateway_active_connections",
     "Number of active connections per node",
-    ["node"]
+    ["node"],
+    multiprocess_mode="livesum"
 )
 
 node_health = Gauge(
     "gateway_node_health",
     "Health status of each node (1=healthy, 0=unhealthy)",
+    ["node"],
+    multiprocess_mode="livemax"
+)
+
+passive_failures = Counter(
+    "gateway_passive_failures_total",
+    "Proxy errors before any response bytes, counted against the node",
+    ["node"]
+)
+
+proxy_retries = Counter(
+    "gateway_retries_total",
+    "Requests retried on another node after the named node failed",
+    ["node"]
+)
+
+routing_cold_loads = Counter(
+    "gateway_routing_cold_load_total",
+    "Requests routed to a node that did not have the model loaded in memory",
+    ["node"]
+)
+
+hedges_fired = Counter(
+    "gateway_hedges_fired_total",
+    "Duplicate requests sent to a second node because the first was slower than its p95",
+    ["endpoint"]
+)
+
+hedges_won = Counter(
+    "gateway_hedges_won_total",
+    "Hedged duplicates that completed before the original request",
+    ["endpoint"]
+)
+
+# LLM 延遲跨度大（毫秒級的 token 間隔到分鐘級的冷加載），使用專門的桶
+llm_request_duration = Histogram(
+    "gateway_llm_request_duration_seconds",
+    "End-to-end duration of generation requests, until the final done chunk",
+    ["node", "model"],
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+)
+
+llm_time_to_first_token = Histogram(
+    "gateway_llm_time_to_first_token_seconds",
+    "Time from forwarding the request to the first streamed token (including queueing and model load)",
+    ["node", "model"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+)
+
+llm_inter_token_latency = Histogram(
+    "gateway_llm_inter_token_latency_seconds",
+    "Average time between generated tokens",
+    ["node", "model"],
+    buckets=(0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1)
+)
+
+llm_tokens_per_second = Histogram(
+    "gateway_llm_tokens_per_second",
+    "Generation throughput reported by the node (eval_count / eval_duration)",
+    ["node", "model"],
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+)
+
+llm_prompt_tokens_per_second = Histogram(
+    "gateway_llm_prompt_tokens_per_second",
+    "Prompt processing throughput reported by the node (prompt_eval_count / prompt_eval_duration)",
+    ["node", "model"],
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2000, 5000, 10000, 20000)
+)
+
+llm_load_duration = Histogram(
+    "gateway_llm_load_duration_seconds",
+    "Model load time reported by the node (load_duration)",
+    ["node", "model"],
+    buckets=(0.01, 0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+)
+
+embed_batch_requests = Histogram(
+    "gateway_embed_batch_requests",
+    "Client /api/embed requests merged into one upstream call",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+
+collapsed_requests = Counter(
+    "gateway_collapsed_requests_total",
+    "Requests served by attaching to an identical in-flight upstream request",
+    ["endpoint"]
+)
+
+response_cache_requests = Counter(
+    "gateway_response_cache_requests_total",
+    "Deterministic generate/chat requests by response cache result",
+    ["result"]
+)
+
+response_cache_purges = Counter(
+    "gateway_response_cache_purges_total",
+    "Model digests whose cached responses were dropped because no node serves them any more"
+)
+
+admission_queue_depth = Gauge(
+    "gateway_admission_queue_depth",
+    "Requests waiting for a free node slot",
+    multiprocess_mode="livesum"
+)
+
+admission_wait_seconds = Histogram(
+    "gateway_admission_wait_seconds",
+    "Time requests spent queued before a node slot became free",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+
+admission_rejected = Counter(
+    "gateway_admission_rejected_total",
+    "Requests rejected by admission control",
+    ["reason"]
+)
+
+prefix_affinity_requests = Counter(
+    "gateway_prefix_affinity_requests_total",
+    "Prefix-affinity requests by whether they reached the node holding the conversation's KV cache",
+    ["result"]
+)
+
+prefix_affinity_overflows = Counter(
+    "gateway_prefix_affinity_overflows_total",
+    "Times a node was skipped on the affinity ring because it exceeded the bounded-load limit",
+    ["node"]
+)
+
+warmup_requests = Counter(
+    "gateway_warmup_requests_total",
+    "Background model loads and keep-alive refreshes issued by the warm-up controller",
+    ["node", "reason", "result"]
+)
+
+prefix_affinity_saved_tokens = Counter(
+    "gateway_prefix_affinity_saved_prompt_tokens_total",
+    "Estimated prompt tokens not re-evaluated because the request reached the node holding its prefix",
     ["node"]
 )
 
+# 指標標簽的基數控制：endpoint 只使用固定的路由模板，model 只為最先出現的 METRICS_MAX_MODELS 個節點上存在的模型單獨計數
+ROUTE_TEMPLATES = frozenset((
+    "/api/generate", "/api/chat", "/api/embed", "/api/embeddings", "/api/show", "/api/tags", "/api/ps",
+    "/api/pull", "/api/push", "/api/create", "/api/copy", "/api/delete", "/api/version",
+    "/v1/chat/completions", "/v1/completions", "/v1/embeddings", "/v1/models",
+))
+ROUTE_PREFIX_TEMPLATES = (("/api/blobs/", "/api/blobs/:digest"), ("/v1/models/", "/v1/models/:model"))
+METRICS_MAX_MODELS = int(os.getenv("METRICS_MAX_MODELS", "50"))  # 按首次請求順序分配，進程生命週期內不回收
+OVERFLOW_LABEL = "other"
+metric_models: Set[str] = set()
+
+
+def normalize_route(path: str) -> str:
+    """把請求路徑歸一化為固定的路由模板，未知路徑（掃描器等）統一為 other"""
+    path = path.rstrip("/") or "/"
+    if path in ROUTE_TEMPLATES:
+        return path
+    for prefix, template in ROUTE_PREFIX_TEMPLATES:
+        if path.startswith(prefix):
+            return template
+    return OVERFLOW_LABEL
+
+
+def metric_model_label(full_model_name: Optional[str]) -> str:
+    """模型標簽：只有某個節點上確實存在的模型才單獨計數，其余歸為 other
+    
+    標簽按首次請求的順序分配給最先出現的 METRICS_MAX_MODELS 個模型（不是請求量最大的），分配後不回收：
+    回收標簽需要刪除該模型的所有時間序列，多進程模式下無法做到，且會讓計數器重置。
+    模型數量多於上限時，應調大 METRICS_MAX_MODELS，而不是依賴標簽輪換。
+    """
+    if not full_model_name:
+        return ""
+    model = normalize_model_tag(full_model_name)
+    if model in metric_models:
+        return model
+    if len(metric_models) < METRICS_MAX_MODELS and split_model_name(model)[0] in get_routing_index().model_nodes:
+        metric_models.add(model)
+        return model
+    return OVERFLOW_LABEL
+
 # 調度策略類型
-SCHEDULING_STRATEGY = os.getenv("SCHEDULING_STRATEGY", "round_robin")  # round_robin, least_connections, weighted_round_robin
+SCHEDULING_STRATEGY = os.getenv("SCHEDULING_STRATEGY", "round_robin")  # round_robin, least_connections, weighted_round_robin, p2c_ewma
 
 # 節點狀態追蹤（已在 load_config() 之前定義，這裡只是註釋說明）
 # node_stats 和 node_models 已在上面定義
@@ -284,9 +675,268 @@ SCHEDULING_STRATEGY = os.getenv("SCHEDULING_STRATEGY", "round_robin")  # round_r
 # 輪詢索引
 round_robin_index = 0
 
-# HTTP客戶端（支持連接池和超時）
-timeout = httpx.Timeout(300.0, connect=10.0)  # 5分鐘總超時，10秒連接超時
-client = httpx.AsyncClient(timeout=timeout, follow_redirects=True)
+# 首輪健康檢查是否已完成（/ready 使用）
+gateway_ready = False
+
+# 多進程模式：GATEWAY_WORKERS > 1 時主進程啟動多個工作進程，各自以 SO_REUSEPORT 綁定同一端口（見 run_workers）
+GATEWAY_WORKERS = int(os.getenv("GATEWAY_WORKERS", "1"))
+GATEWAY_STATE_DIR = os.getenv("GATEWAY_STATE_DIR", "")  # 進程間共享狀態的目錄（默認在臨時目錄中創建，退出時刪除）
+SHARED_COUNTER_COLUMNS = int(os.getenv("SHARED_COUNTER_COLUMNS", "4096"))  # 共享計數器表的列數（可分配的計數鍵上限）
+STATE_SYNC_INTERVAL = float(os.getenv("STATE_SYNC_INTERVAL", "0.5"))  # 健康檢查快照的發布 / 讀取間隔（秒）
+SHARED_SLOT_POLL_INTERVAL = float(os.getenv("SHARED_SLOT_POLL_INTERVAL", "0.05"))  # 有請求排隊時檢查其他進程釋放槽位的間隔（秒）
+
+# 以下由 run_worker 在工作進程中設置；單進程模式下保持默認值
+worker_index = 0
+shared_counters: Optional["SharedCounters"] = None
+routing_state_file: Optional[str] = None
+# 集群中其他在線網關發往每個節點的請求數之和（見 update_peer_load）
+peer_node_load: Dict[str, int] = {}
+
+
+class SharedCounters:
+    """進程間共享的計數器表（文件映射的 int64 數組）
+    
+    每個工作進程只寫自己的一行，讀取時對所有行求和，因此不需要跨進程鎖。
+    文件開頭是所有進程共用的鍵目錄（每列一個鍵摘要）：鍵第一次使用時在文件鎖內按線性探測分配一列，
+    各進程得到相同且互不沖突的列；分配結果緩存在進程內，熱路徑上不加鎖。
+    round_robin 和 config_generation 只增不減，使用固定的保留列。目錄已滿時新鍵共用溢出列，
+    只會讓這些鍵的連接數偏大（對准入控制更保守），並輸出一次警告。
+    """
+    
+    RESERVED_COLUMNS = {"round_robin": 0, "config_generation": 1}
+    OVERFLOW_COLUMN = 2
+    DIGEST_SIZE = 16
+    
+    def __init__(self, path: str, workers: int, index: int, columns: int = SHARED_COUNTER_COLUMNS):
+        self._directory_size = columns * self.DIGEST_SIZE
+        size = self._directory_size + workers * columns * 8
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._cells = memoryview(self._mmap)[self._directory_size:].cast("q")
+        self._lock_path = f"{path}.lock"
+        self.columns = columns
+        self._row = index * columns
+        self._column_cache: Dict[str, int] = dict(self.RESERVED_COLUMNS)
+        self._overflow_warned = False
+    
+    def _column(self, key: str) -> int:
+        column = self._column_cache.get(key)
+        if column is None:
+            column = self._column_cache[key] = self._assign_column(key)
+        return column
+    
+    def _assign_column(self, key: str) -> int:
+        """在共享目錄中查找鍵的列，不存在時分配第一個空列"""
+        import fcntl  # 多進程模式只在支持 SO_REUSEPORT 的 Unix 上啟用
+        digest = hashlib.blake2b(key.encode(), digest_size=self.DIGEST_SIZE).digest()
+        first = self.OVERFLOW_COLUMN + 1
+        span = self.columns - first
+        start = int.from_bytes(digest[:8], "little") % span
+        empty = bytes(self.DIGEST_SIZE)
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for step in range(span):
+                column = first + (start + step) % span
+                offset = column * self.DIGEST_SIZE
+                slot = self._mmap[offset:offset + self.DIGEST_SIZE]
+                if slot == digest:
+                    return column
+                if slot == empty:
+                    self._mmap[offset:offset + self.DIGEST_SIZE] = digest
+                    return column
+        if not self._overflow_warned:
+            self._overflow_warned = True
+            health_log.warning("⚠️  Shared counter directory is full (%d columns), increase SHARED_COUNTER_COLUMNS; "
+                               "new keys share an overflow column", self.columns)
+        return self.OVERFLOW_COLUMN
+    
+    def reset_row(self):
+        """工作進程（重新）啟動時清零自己的一行：崩潰進程遺留的連接計數不再有效"""
+        self._cells[self._row:self._row + self.columns] = memoryview(bytes(self.columns * 8)).cast("q")
+    
+    def add(self, key: str, delta: int = 1):
+        cell = self._row + self._column(key)
+        self._cells[cell] += delta
+    
+    def local(self, key: str) -> int:
+        """本進程自己那一行的值"""
+        return self._cells[self._row + self._column(key)]
+    
+    def total(self, key: str) -> int:
+        return sum(self._cells[self._column(key)::self.columns])
+
+# HTTP客戶端：每個節點一個連接池（見 get_node_client），避免每個請求重新建立 TCP/TLS 連接
+
+
+class SingleFlight:
+    """合併相同 key 的並發調用：同一時刻只執行一次，其他調用者等待並共享同一個結果"""
+    
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Future] = {}
+    
+    async def do(self, key: str, fn):
+        """執行 fn()（返回 awaitable），若相同 key 已在執行中則等待其結果"""
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield：某個等待者被取消（如客戶端斷開）時不影響共享的調用
+        return await asyncio.shield(future)
+
+
+# p2c_ewma 調度：按（節點, 模型）跟蹤首 token 延遲和每 token 耗時的 peak-EWMA
+EWMA_DECAY_SECONDS = float(os.getenv("EWMA_DECAY_SECONDS", "30"))  # 衰減時間常數（秒）
+EWMA_DEFAULT_TTFT = float(os.getenv("EWMA_DEFAULT_TTFT", "1.0"))  # 尚無樣本時假定的首 token 延遲（秒）
+EWMA_DEFAULT_TOKENS_PER_SECOND = float(os.getenv("EWMA_DEFAULT_TOKENS_PER_SECOND", "20"))  # 尚無樣本時假定的生成速度
+EWMA_EXPECTED_TOKENS = int(os.getenv("EWMA_EXPECTED_TOKENS", "128"))  # 估算成本時假定的生成 token 數
+
+# 完成的請求中最後一個 JSON 對象（Ollama 的 done 塊）帶有的統計字段
+DONE_STATS_FIELDS = ("done", "eval_count", "eval_duration", "prompt_eval_count",
+                     "prompt_eval_duration", "load_duration", "total_duration")
+
+
+class PeakEwma:
+    """Peak-EWMA：樣本高於當前值時立即跟上，低於時按經過的時間指數衰減。
+    變慢的節點會被立刻識別，恢覆後逐漸重新獲得流量。"""
+    
+    __slots__ = ("value", "stamp")
+    
+    def __init__(self, value: float):
+        self.value = value
+        self.stamp = time.time()
+    
+    def observe(self, sample: float):
+        now = time.time()
+        if sample > self.value:
+            self.value = sample
+        else:
+            weight = math.exp(-(now - self.stamp) / EWMA_DECAY_SECONDS)
+            self.value = self.value * weight + sample * (1 - weight)
+        self.stamp = now
+
+
+# 流式響應最後一行（done 塊）最多保留的字節數；/api/generate 的 done 塊帶有 context 數組，可能有幾十 KB
+DONE_LINE_MAX_BYTES = int(os.getenv("DONE_LINE_MAX_BYTES", str(1024 * 1024)))
+
+
+class DoneLineTap:
+    """從轉發中的 NDJSON 流裡保留最後一行
+    
+    每個數據塊只查找一次換行符（不解碼、不拷貝已轉發的內容），
+    只保留當前行的數據塊引用；流結束時最後一行就是 Ollama 的 done 塊。
+    """
+    
+    __slots__ = ("chunks", "size", "line_ended")
+    
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.size = 0
+        self.line_ended = False
+    
+    def feed(self, chunk: bytes):
+        if not chunk:
+            return
+        if self.line_ended:
+            self.chunks, self.size = [], 0
+        newline = chunk.rfind(b"\n", 0, len(chunk) - 1)
+        if newline >= 0:
+            chunk = chunk[newline + 1:]
+            self.chunks, self.size = [], 0
+        if self.size <= DONE_LINE_MAX_BYTES:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+        self.line_ended = chunk.endswith(b"\n")
+    
+    def last_line(self) -> bytes:
+        return b"".join(self.chunks) if self.size <= DONE_LINE_MAX_BYTES else b""
+
+# (節點名, 完整模型名) -> {"ttft": PeakEwma, "seconds_per_token": PeakEwma}
+node_model_latency: Dict[Tuple[str, str], Dict[str, PeakEwma]] = {}
+
+
+def parse_done_stats(line: bytes) -> Dict:
+    """取出 Ollama done 塊（非流式響應體或流式響應的最後一行）中的統計字段"""
+    return scan_json_fields(line.strip(), DONE_STATS_FIELDS) if line else {}
+
+
+def _positive(stats: Dict, field: str) -> Optional[float]:
+    value = stats.get(field)
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0:
+        return value
+    return None
+
+
+def record_request_performance(node_name: str, full_model_name: Optional[str], first_byte_seconds: float,
+                               total_seconds: float, done_line: bytes, streamed: bool,
+                               affinity_key: Optional[str] = None):
+    """用完成的請求更新（節點, 模型）的 peak-EWMA 和 token 級指標
+    
+    流式響應的首 token 延遲取網關收到第一個數據塊的時間；非流式響應取總耗時減去生成耗時，
+    兩者都包含節點內部排隊和模型加載的時間。
+    """
+    if not full_model_name:
+        return
+    stats = parse_done_stats(done_line)
+    eval_count = _positive(stats, "eval_count")
+    eval_duration = _positive(stats, "eval_duration")
+    has_eval = eval_count is not None and eval_duration is not None
+    if streamed or not has_eval:
+        ttft = first_byte_seconds
+    else:
+        ttft = max(0.0, total_seconds - eval_duration / 1e9)
+    
+    model = normalize_model_tag(full_model_name)
+    if stats.get("done") is True:
+        label = metric_model_label(model)
+        # 只有生成類請求（帶 done 塊）才有 token 級指標
+        llm_request_duration.labels(node=node_name, model=label).observe(total_seconds)
+        llm_time_to_first_token.labels(node=node_name, model=label).observe(ttft)
+        if has_eval:
+            llm_tokens_per_second.labels(node=node_name, model=label).observe(eval_count / (eval_duration / 1e9))
+            if streamed and eval_count > 1:
+                # 實際到達網關的 token 間隔（包含網絡和節點調度抖動）
+                inter_token = max(0.0, total_seconds - first_byte_seconds) / (eval_count - 1)
+            else:
+                inter_token = eval_duration / 1e9 / eval_count
+            llm_inter_token_latency.labels(node=node_name, model=label).observe(inter_token)
+        prompt_eval_count = _positive(stats, "prompt_eval_count")
+        prompt_eval_duration = _positive(stats, "prompt_eval_duration")
+        if prompt_eval_count is not None and prompt_eval_duration is not None:
+            llm_prompt_tokens_per_second.labels(node=node_name, model=label).observe(
+                prompt_eval_count / (prompt_eval_duration / 1e9))
+        load_duration = _positive(stats, "load_duration")
+        if load_duration is not None:
+            llm_load_duration.labels(node=node_name, model=label).observe(load_duration / 1e9)
+        if affinity_key:
+            record_prefix_affinity(affinity_key, node_name, full_model_name, stats, done_line)
+    
+    key = (node_name, model)
+    entry = node_model_latency.get(key)
+    if entry is None:
+        entry = node_model_latency[key] = {
+            "ttft": PeakEwma(ttft),
+            "seconds_per_token": PeakEwma(1.0 / EWMA_DEFAULT_TOKENS_PER_SECOND),
+        }
+    else:
+        entry["ttft"].observe(ttft)
+    if has_eval:
+        entry["seconds_per_token"].observe(eval_duration / 1e9 / eval_count)
+
+
+def expected_request_cost(node_name: str, full_model_name: Optional[str]) -> float:
+    """預計完成時間：(首 token 延遲 + 預計 token 數 × 每 token 耗時) × (正在處理的請求數 + 1)"""
+    entry = node_model_latency.get((node_name, normalize_model_tag(full_model_name))) if full_model_name else None
+    if entry is None:
+        ttft, seconds_per_token = EWMA_DEFAULT_TTFT, 1.0 / EWMA_DEFAULT_TOKENS_PER_SECOND
+    else:
+        ttft, seconds_per_token = entry["ttft"].value, entry["seconds_per_token"].value
+    return (ttft + EWMA_EXPECTED_TOKENS * seconds_per_token) * (node_active_connections(node_name) + 1)
 
 
 class NodeSelector:
@@ -295,13 +945,10 @@ class NodeSelector:
     @staticmethod
     def round_robin(nodes: List[Dict]) -> Optional[Dict]:
         """輪詢調度"""
-        global round_robin_index
         enabled_nodes = [n for n in nodes if n.get("enabled", True) and node_stats[n["name"]]["is_healthy"]]
         if not enabled_nodes:
             return None
-        node = enabled_nodes[round_robin_index % len(enabled_nodes)]
-        round_robin_index += 1
-        return node
+        return enabled_nodes[next_round_robin_index() % len(enabled_nodes)]
     
     @staticmethod
     def least_connections(nodes: List[Dict]) -> Optional[Dict]:
@@ -312,7 +959,7 @@ class NodeSelector:
         ]
         if not enabled_nodes:
             return None
-        return min(enabled_nodes, key=lambda n: node_stats[n["name"]]["active_connections"])
+        return min(enabled_nodes, key=lambda n: node_active_connections(n["name"]))
     
     @staticmethod
     def weighted_round_robin(nodes: List[Dict]) -> Optional[Dict]:
@@ -335,6 +982,29 @@ class NodeSelector:
             node_stats[node["name"]]["current_weight"] += node["weight"]
         
         return max_node
+    
+    @staticmethod
+    def p2c_ewma(nodes: List[Dict], full_model_name: Optional[str] = None) -> Optional[Dict]:
+        """Power of two choices：隨機抽取兩個可用節點，選擇預計完成時間較低的一個
+        
+        只評估兩個節點，與節點總數無關；候選列表中不可用的節點只在抽樣多次失敗後才線性過濾。
+        """
+        def usable(n: Dict) -> bool:
+            return n.get("enabled", True) and node_stats[n["name"]]["is_healthy"]
+        
+        picks: List[Dict] = []
+        if len(nodes) > 2:
+            for _ in range(4):
+                first, second = random.sample(nodes, 2)
+                picks = [n for n in (first, second) if usable(n)]
+                if len(picks) == 2:
+                    break
+        if len(picks) < 2:
+            enabled_nodes = [n for n in nodes if usable(n)]
+            picks = enabled_nodes if len(enabled_nodes) <= 2 else random.sample(enabled_nodes, 2)
+        if not picks:
+            return None
+        return min(picks, key=lambda n: expected_request_cost(n["name"], full_model_name))
 
 
 def extract_model_name_from_request(request: Request, path: str) -> Optional[str]:
@@ -366,6 +1036,179 @@ def extract_model_name_from_request(request: Request, path: str) -> Optional[str
     return None
 
 
+# 路由需要的請求體字段（options.num_ctx 表示 options 對象中的 num_ctx）
+ROUTING_FIELDS = ("model", "stream", "keep_alive", "options.num_ctx")
+
+# JSON 結構字符：用於在 C 層面跳過嵌套的對象 / 數組
+_JSON_STRUCT_RE = re.compile(rb'["{}\[\]]')
+# 標量值（數字、true/false/null）的結束位置
+_JSON_SCALAR_END_RE = re.compile(rb'[,}\]\s]')
+_JSON_WHITESPACE = b" \t\r\n"
+
+
+def _json_skip_ws(buf: bytes, pos: int) -> int:
+    while buf[pos] in _JSON_WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _json_skip_string(buf: bytes, pos: int) -> int:
+    """pos 指向開頭的引號，返回結尾引號之後的位置（base64 等長字符串只需一次 find）"""
+    i = pos + 1
+    while True:
+        j = buf.index(b'"', i)
+        # 計算引號前連續反斜杠的數量，偶數表示引號未被轉義
+        k = j - 1
+        while k > pos and buf[k] == 0x5C:
+            k -= 1
+        if (j - 1 - k) % 2 == 0:
+            return j + 1
+        i = j + 1
+
+
+def _json_skip_value(buf: bytes, pos: int) -> int:
+    """跳過 pos 處的任意 JSON 值，不構造任何 Python 對象，返回值之後的位置"""
+    c = buf[pos]
+    if c == 0x22:  # "
+        return _json_skip_string(buf, pos)
+    if c in (0x7B, 0x5B):  # { [
+        depth = 0
+        while True:
+            m = _JSON_STRUCT_RE.search(buf, pos)
+            if m is None:
+                raise ValueError("unterminated JSON value")
+            ch = buf[m.start()]
+            if ch == 0x22:
+                pos = _json_skip_string(buf, m.start())
+                continue
+            pos = m.start() + 1
+            if ch in (0x7B, 0x5B):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos
+    m = _JSON_SCALAR_END_RE.search(buf, pos)
+    if m is None:
+        raise ValueError("unterminated JSON scalar")
+    return m.start()
+
+
+def _json_scan_object(buf: bytes, pos: int, wanted: Dict[str, Set[str]], found: Dict, prefix: str) -> int:
+    """掃描 pos 處的對象：只解析需要的鍵，其他值直接跳過；所有鍵都找到後提前返回"""
+    pos = _json_skip_ws(buf, pos)
+    if buf[pos] != 0x7B:
+        raise ValueError("expected JSON object")
+    pos += 1
+    remaining = set(wanted)
+    while remaining:
+        pos = _json_skip_ws(buf, pos)
+        if buf[pos] == 0x7D:  # }
+            return pos + 1
+        if buf[pos] == 0x2C:  # ,
+            pos = _json_skip_ws(buf, pos + 1)
+        key_end = _json_skip_string(buf, pos)
+        key = json.loads(buf[pos:key_end])
+        pos = _json_skip_ws(buf, key_end)
+        if buf[pos] != 0x3A:  # :
+            raise ValueError("expected ':' in JSON object")
+        pos = _json_skip_ws(buf, pos + 1)
+        if key in remaining:
+            remaining.discard(key)
+            children = wanted[key]
+            value_end = _json_skip_value(buf, pos)
+            if not children:
+                found[f"{prefix}{key}"] = json.loads(buf[pos:value_end])
+            elif buf[pos] == 0x7B:
+                # 嵌套對象（如 options）通常很小，單獨掃描其中需要的鍵
+                _json_scan_object(buf[pos:value_end], 0, {child: set() for child in children}, found, f"{prefix}{key}.")
+            pos = value_end
+        else:
+            pos = _json_skip_value(buf, pos)
+    return pos
+
+
+def scan_json_fields(body: bytes, fields=ROUTING_FIELDS) -> Dict:
+    """增量掃描 JSON 請求體的頂層鍵，只解析需要的字段
+    
+    不構造整個文檔（例如多模態請求中數 MB 的 base64 圖片和長對話歷史只會被跳過），
+    所有字段找到後立即停止，耗時與實際掃描的字節數成正比。
+    請求體被截斷（例如只讀取了前綴）或格式錯誤時，返回已經找到的字段。
+    
+    Args:
+        body: 請求體（或其前綴）
+        fields: 需要的字段，支持一層嵌套，如 "options.num_ctx"
+    """
+    wanted: Dict[str, Set[str]] = {}
+    for field in fields:
+        key, _, child = field.partition(".")
+        wanted.setdefault(key, set())
+        if child:
+            wanted[key].add(child)
+    found: Dict = {}
+    if not body:
+        return found
+    try:
+        _json_scan_object(body, 0, wanted, found, "")
+    except (ValueError, IndexError):
+        pass
+    return found
+
+
+def scan_json_array_prefix(body: bytes, key: str, max_items: int, stop=None) -> Optional[List]:
+    """只解析頂層數組字段的前 max_items 個元素，其餘元素和其他字段直接跳過
+    
+    stop(item) 返回 True 時在該元素之後停止。字段不存在、不是數組、
+    或需要的元素在請求體前綴中被截斷時返回 None。
+    """
+    try:
+        pos = _json_skip_ws(body, 0)
+        if body[pos] != 0x7B:
+            return None
+        pos += 1
+        while True:
+            pos = _json_skip_ws(body, pos)
+            if body[pos] == 0x7D:
+                return None
+            if body[pos] == 0x2C:
+                pos = _json_skip_ws(body, pos + 1)
+            key_end = _json_skip_string(body, pos)
+            name = json.loads(body[pos:key_end])
+            pos = _json_skip_ws(body, key_end)
+            if body[pos] != 0x3A:
+                return None
+            pos = _json_skip_ws(body, pos + 1)
+            if name == key:
+                break
+            pos = _json_skip_value(body, pos)
+        if body[pos] != 0x5B:
+            return None
+        pos += 1
+        items: List = []
+        while len(items) < max_items:
+            pos = _json_skip_ws(body, pos)
+            if body[pos] == 0x5D:
+                break
+            if body[pos] == 0x2C:
+                pos = _json_skip_ws(body, pos + 1)
+            value_end = _json_skip_value(body, pos)
+            items.append(json.loads(body[pos:value_end]))
+            pos = value_end
+            if stop is not None and stop(items[-1]):
+                break
+        return items
+    except (ValueError, IndexError):
+        return None
+
+
+def split_model_name(full_model: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """返回 (不含tag的模型名, 完整模型名)"""
+    if not full_model or not isinstance(full_model, str):
+        return None, None
+    model_name = full_model.split(":")[0] if ":" in full_model else full_model
+    return model_name, full_model
+
+
 async def extract_model_name_from_body(body: bytes) -> Tuple[Optional[str], Optional[str]]:
     """從請求體中提取模型名稱
     
@@ -374,9 +1217,8 @@ async def extract_model_name_from_body(body: bytes) -> Tuple[Optional[str], Opti
     """
     try:
         if body:
-            data = json.loads(body.decode('utf-8'))
-            full_model = data.get("model")
-            if full_model:
+            full_model = scan_json_fields(body, ("model",)).get("model")
+            if full_model and isinstance(full_model, str):
                 # 保留完整名稱，同時返回不含tag的版本
                 model_name = full_model.split(":")[0] if ":" in full_model else full_model
                 return model_name, full_model
@@ -385,34 +1227,51 @@ async def extract_model_name_from_body(body: bytes) -> Tuple[Optional[str], Opti
     return None, None
 
 
+# 參數數量，如 70b、30-b、7 b
+PARAM_SIZE_RE = re.compile(r'(\d+)\s*[-_]?\s*b\b')
+
+
 def get_model_size_b(model_name: str, full_model_name: Optional[str] = None) -> int:
     """從模型名稱中提取參數數量（B為單位）
     
     Ollama 的模型通常格式為：model-name:tag，其中 tag 經常包含參數數量（如 :30b, :70b-instruct）
+    結果按 (model_name, full_model_name) 緩存，加載配置時清空。
     
     Args:
         model_name: 模型名稱（可能已移除tag）
         full_model_name: 完整的模型名稱（包含tag，如 qwen3-coder:30b）
     """
+    key = (model_name, full_model_name)
+    size = model_size_cache.get(key)
+    if size is not None:
+        model_size_cache.move_to_end(key)
+        return size
+    size = resolve_model_size_b(model_name, full_model_name)
+    model_size_cache[key] = size
+    if len(model_size_cache) > MODEL_SIZE_CACHE_SIZE:
+        model_size_cache.popitem(last=False)
+    return size
+
+
+def resolve_model_size_b(model_name: str, full_model_name: Optional[str] = None) -> int:
+    """get_model_size_b 的實際解析邏輯（不經過緩存）"""
     if not model_name:
         return default_model_size
     
     # 優先檢查完整模型名稱（如果提供），因為 Ollama 的 tag 中通常包含參數數量
     if full_model_name:
-        full_name_lower = full_model_name.lower()
-        
         # 從完整名稱中提取參數數量（可能在tag中）
         # 支持多種格式：:30b, :30B, :30-b, :30b-instruct, :30b:latest 等
         # 優先匹配 tag 部分（冒號後面的內容）
         if ":" in full_model_name:
-            tag_part = full_model_name.split(":")[-1].lower()  # 取最後一個冒號後的部分
+            tag_part = full_model_name.rsplit(":", 1)[-1].lower()  # 取最後一個冒號後的部分
             # 匹配 tag 中的參數數量（如 30b, 30-b, 30b-instruct 等）
-            match = re.search(r'(\d+)\s*[-_]?\s*b\b', tag_part)
+            match = PARAM_SIZE_RE.search(tag_part)
             if match:
                 return int(match.group(1))
         
         # 如果 tag 中沒有找到，在整個完整名稱中搜索
-        match = re.search(r'(\d+)\s*[-_]?\s*b\b', full_name_lower)
+        match = PARAM_SIZE_RE.search(full_model_name.lower())
         if match:
             return int(match.group(1))
     
@@ -427,14 +1286,13 @@ def get_model_size_b(model_name: str, full_model_name: Optional[str] = None) ->
     model_name_lower = model_name.lower()
     
     # 按照模式匹配，優先匹配更大的數字
-    sorted_patterns = sorted(model_patterns.items(), key=lambda x: x[1], reverse=True)
-    for pattern, size in sorted_patterns:
-        if pattern.lower() in model_name_lower:
-            return size
+    size = model_size_matcher.match(model_name_lower) if model_size_matcher is not None else None
+    if size is not None:
+        return size
     
     # 如果沒有匹配到，嘗試用正則表達式提取數字
     # 匹配類似 "70b", "120b", "7b", "30-b" 等
-    match = re.search(r'(\d+)\s*[-_]?\s*b\b', model_name_lower)
+    match = PARAM_SIZE_RE.search(model_name_lower)
     if match:
         return int(match.group(1))
     
@@ -469,184 +1327,807 @@ def is_node_suitable_for_model(node_name: str, model_size_b: int) -> bool:
     return False
 
 
-def filter_nodes_by_model(nodes: List[Dict], model_name: Optional[str], model_size_b: int) -> List[Dict]:
-    """根據模型名稱和大小過濾節點"""
-    if not model_name:
-        # 如果沒有模型名稱，返回所有節點
-        return nodes
+ROUTING_INDEX_MAX_ROUTES = int(os.getenv("ROUTING_INDEX_MAX_ROUTES", "4096"))  # 每個路由索引最多緩存的 (模型名, 模型大小) 數
+
+
+class RoutingIndex:
+    """不可變的路由索引：(模型名, 模型大小) → 按 NODES 順序排列的候選節點
     
-    filtered = []
-    for node in nodes:
-        node_name = node["name"]
-        
-        # 第一步：檢查節點是否有該模型
-        has_model = model_name in node_models.get(node_name, set())
-        if not has_model:
-            print(f"  Node {node_name} rejected: model '{model_name}' not found on node")
-            continue
-        
-        # 第二步：檢查節點硬件是否適合該模型大小
-        if not is_node_suitable_for_model(node_name, model_size_b):
-            # 獲取節點的配置範圍以便調試
-            node_cfg = node_config.get(node_name, {})
-            ranges = node_cfg.get("supported_model_ranges", [])
-            print(f"  Node {node_name} rejected: model size {model_size_b}B not in supported range {ranges}")
-            continue
-        
-        # 第三步：檢查節點是否啟用且健康
-        if not node.get("enabled", True):
-            print(f"  Node {node_name} rejected: disabled")
-            continue
-        if not node_stats[node_name]["is_healthy"]:
-            print(f"  Node {node_name} rejected: unhealthy")
-            continue
-        
-        print(f"  ✓ Node {node_name} accepted for model {model_name} ({model_size_b}B)")
-        filtered.append(node)
+    在構建時固定節點列表、模型列表、健康狀態和配置；任何一項變化時整體替換（見 invalidate_routing_index），
+    熱路徑上只需一次字典查找。每個 (模型名, 模型大小) 的結果在首次查詢時計算並緩存在本索引中
+    （只緩存節點上存在的模型，最多 ROUTING_INDEX_MAX_ROUTES 個）。
+    """
+    
+    def __init__(self):
+        self.nodes: Tuple[Dict, ...] = tuple(NODES)
+        self.healthy_nodes: Tuple[Dict, ...] = tuple(
+            n for n in self.nodes if n.get("enabled", True) and node_stats[n["name"]]["is_healthy"]
+        )
+        # 模型名 → 擁有該模型的節點名
+        self.model_nodes: Dict[str, Set[str]] = {}
+        for node in self.nodes:
+            for model in node_models.get(node["name"], ()):
+                self.model_nodes.setdefault(model, set()).add(node["name"])
+        self.built_at = time.time()
+        self._affinity_ring: Optional["AffinityRing"] = None
+        self._routes: Dict[Tuple[str, int], Tuple[Tuple[Dict, ...], Tuple[Tuple[Dict, str], ...]]] = {}
+    
+    def route(self, model_name: str, model_size_b: int) -> Tuple[Tuple[Dict, ...], Tuple[Tuple[Dict, str], ...]]:
+        """返回 (候選節點, 被拒絕的節點及原因)；原因為 disabled / unhealthy / missing_model / unsupported_size"""
+        key = (model_name, model_size_b)
+        entry = self._routes.get(key)
+        if entry is None:
+            entry = self._evaluate(model_name, model_size_b)
+            # 只緩存確實存在於某個節點上的模型，客戶端發送的任意模型名 / tag 不會讓索引無限增長
+            if model_name in self.model_nodes and len(self._routes) < ROUTING_INDEX_MAX_ROUTES:
+                self._routes[key] = entry
+        return entry
+    
+    def candidates(self, model_name: str, model_size_b: int) -> Tuple[Dict, ...]:
+        return self.route(model_name, model_size_b)[0]
+    
+    def affinity_ring(self) -> "AffinityRing":
+        """覆蓋所有已配置節點的一致性哈希環（不健康的節點在選擇時跳過，不改變環本身）"""
+        if self._affinity_ring is None:
+            self._affinity_ring = AffinityRing(n["name"] for n in self.nodes)
+        return self._affinity_ring
     
-    return filtered
+    def _evaluate(self, model_name: str, model_size_b: int):
+        owners = self.model_nodes.get(model_name, set())
+        accepted: List[Dict] = []
+        rejected: List[Tuple[Dict, str]] = []
+        for node in self.nodes:
+            node_name = node["name"]
+            if not node.get("enabled", True):
+                rejected.append((node, "disabled"))
+            elif not node_stats[node_name]["is_healthy"]:
+                rejected.append((node, "unhealthy"))
+            elif node_name not in owners:
+                rejected.append((node, "missing_model"))
+            elif not is_node_suitable_for_model(node_name, model_size_b):
+                rejected.append((node, "unsupported_size"))
+            else:
+                accepted.append(node)
+        return tuple(accepted), tuple(rejected)
 
 
-def select_node(model_name: Optional[str] = None, model_size_b: Optional[int] = None) -> Optional[Dict]:
-    """根據調度策略選擇節點，支持模型感知的節點選擇"""
-    # 如果提供了模型信息，先過濾節點
-    candidate_nodes = NODES
-    if model_name and model_size_b is not None:
-        print(f"🔍 Filtering nodes for model '{model_name}' ({model_size_b}B)...")
-        candidate_nodes = filter_nodes_by_model(NODES, model_name, model_size_b)
-        print(f"   Found {len(candidate_nodes)} suitable node(s) after filtering")
-        # 如果過濾後沒有節點，回退到所有節點（允許模型下載）
-        if not candidate_nodes:
-            print(f"⚠️  Warning: No suitable nodes found for model {model_name} ({model_size_b}B), falling back to all healthy nodes")
-            candidate_nodes = [n for n in NODES if n.get("enabled", True) and node_stats[n["name"]]["is_healthy"]]
-            print(f"   Fallback: Using {len(candidate_nodes)} healthy node(s): {[n['name'] for n in candidate_nodes]}")
-    
-    # 根據調度策略選擇
-    if SCHEDULING_STRATEGY == "least_connections":
-        return NodeSelector.least_connections(candidate_nodes)
-    elif SCHEDULING_STRATEGY == "weighted_round_robin":
-        return NodeSelector.weighted_round_robin(candidate_nodes)
-    else:  # 默認使用 round_robin
-        return NodeSelector.round_robin(candidate_nodes)
+def get_routing_index() -> RoutingIndex:
+    """返回當前路由索引，失效後在下一次路由時重建"""
+    global routing_index
+    if routing_index is None:
+        routing_index = RoutingIndex()
+    return routing_index
 
 
-def get_node_url(node: Dict) -> str:
-    """獲取節點的完整URL"""
-    node_type = node.get("type", "local")
-    if node_type == "external":
-        # 外部節點使用 api_url
-        api_url = node.get("api_url", "")
-        # 確保 URL 以 / 結尾（如果需要的話）
-        if api_url and not api_url.endswith("/"):
-            return api_url
-        return api_url
-    else:
-        # 本地節點使用 hosts 和 port
-        hosts = node.get("hosts", [])
-        if not hosts:
-            raise ValueError(f"Local node {node.get('name')} has no hosts configured")
-        port = node.get("port", 11434)
-        return f"http://{hosts[0]}:{port}"
+def invalidate_routing_index():
+    """節點模型列表、健康狀態或配置變化時調用"""
+    global routing_index
+    routing_index = None
 
 
-def get_node_headers(node: Dict) -> Dict[str, str]:
-    """獲取節點的請求頭（包括 API key）"""
-    headers = {}
-    node_type = node.get("type", "local")
-    
-    if node_type == "external":
-        # 外部節點：添加配置的 headers
-        config_headers = node.get("headers", {})
-        headers.update(config_headers)
-        
-        # 如果有 api_key，添加到 Authorization header（如果還沒有設置）
-        api_key = node.get("api_key", "")
-        if api_key and "Authorization" not in headers:
-            headers["Authorization"] = f"Bearer {api_key}"
-    
-    return headers
+# 常駐模型優先路由：最空閒的常駐節點比最空閒的冷節點多出的活躍連接數超過此值時，冷節點也參與調度策略
+# 0 表示常駐只在負載相同的節點之間打破平局；調大可以用負載均衡換取更少的冷加載
+COLD_FALLBACK_INFLIGHT = int(os.getenv("COLD_FALLBACK_INFLIGHT", "0"))
+# 路由到冷節點後，假定模型在該節點上保持加載的時間（秒），與 Ollama 默認 keep_alive 一致
+DEFAULT_KEEP_ALIVE_SECONDS = float(os.getenv("DEFAULT_KEEP_ALIVE_SECONDS", "300"))
 
-async def get_node_models(node: Dict) -> Set[str]:
-    """獲取節點上已下載的模型列表（只返回模型名，不含tag）"""
-    try:
-        base_url = get_node_url(node)
-        url = f"{base_url}/api/tags"
+
+def normalize_model_tag(full_model_name: str) -> str:
+    """補全默認 tag：Ollama 中 llama3 等同於 llama3:latest"""
+    return full_model_name if ":" in full_model_name else f"{full_model_name}:latest"
+
+
+def parse_ollama_time(value: Optional[str]) -> Optional[float]:
+    """解析 Ollama 返回的 RFC3339 時間（可能帶納秒和 Z 後綴），返回 Unix 時間戳"""
+    if not value:
+        return None
+    try:
+        value = value.replace("Z", "+00:00")
+        # 小數秒最多保留 6 位，兼容舊版本 Python 的 fromisoformat
+        value = re.sub(r'(\.\d{6})\d+', r'\1', value)
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def update_node_residency(node_name: str, ps_data: Optional[Dict]):
+    """根據 /api/ps 響應更新節點的常駐模型表"""
+    if ps_data is None:
+        return
+    loaded = {}
+    for model in ps_data.get("models") or []:
+        name = model.get("name") or model.get("model")
+        if not name:
+            continue
+        loaded[normalize_model_tag(name)] = {
+            "size_vram": model.get("size_vram", 0),
+            "expires_at": parse_ollama_time(model.get("expires_at")),
+        }
+    node_loaded_models[node_name] = loaded
+
+
+def is_model_resident(node_name: str, full_model_name: Optional[str]) -> bool:
+    """模型是否已加載在節點內存中（且未過期）"""
+    if not full_model_name:
+        return False
+    entry = node_loaded_models.get(node_name, {}).get(normalize_model_tag(full_model_name))
+    if entry is None:
+        return False
+    return entry["expires_at"] is None or entry["expires_at"] > time.time()
+
+
+def mark_model_resident(node_name: str, full_model_name: str):
+    """請求已路由到節點，模型將被加載（直到下次 /api/ps 刷新給出準確數據）"""
+    loaded = node_loaded_models.setdefault(node_name, {})
+    key = normalize_model_tag(full_model_name)
+    entry = loaded.get(key)
+    expires_at = time.time() + DEFAULT_KEEP_ALIVE_SECONDS
+    if entry is None:
+        loaded[key] = {"size_vram": 0, "expires_at": expires_at}
+    elif entry["expires_at"] is not None:
+        entry["expires_at"] = max(entry["expires_at"], expires_at)
+
+
+def prefer_resident_nodes(candidate_nodes: List[Dict], full_model_name: str) -> List[Dict]:
+    """優先選擇已加載該模型的節點，但只在它們不比冷節點更忙時（相差不超過 COLD_FALLBACK_INFLIGHT）：
+    其他節點空閒時不會把所有請求都固定到常駐節點上，調度策略仍然在全部候選節點之間分配"""
+    warm_nodes = [n for n in candidate_nodes if is_model_resident(n["name"], full_model_name)]
+    if not warm_nodes or len(warm_nodes) == len(candidate_nodes):
+        return candidate_nodes
+    warm_load = min(node_active_connections(n["name"]) for n in warm_nodes)
+    cold_load = min(node_active_connections(n["name"]) for n in candidate_nodes if n not in warm_nodes)
+    if warm_load > cold_load + COLD_FALLBACK_INFLIGHT:
+        routing_log.debug("Resident nodes busier (%d vs %d in flight), allowing cold nodes for %s",
+                          warm_load, cold_load, full_model_name)
+        return candidate_nodes
+    # 已加載模型的節點槽位已滿且已有請求在排隊
+    if admission_waiters and not any(node_has_free_slot(n["name"], full_model_name) for n in warm_nodes):
+        routing_log.info("Resident nodes full with %d queued, allowing cold nodes for %s", len(admission_waiters), full_model_name)
+        return candidate_nodes
+    return warm_nodes
+
+
+def get_candidate_nodes(model_name: Optional[str], model_size_b: Optional[int],
+                        exclude: Optional[Set[str]] = None) -> List[Dict]:
+    """按模型可用性和硬件規格篩選候選節點（沒有符合條件的節點時回退到所有健康節點）"""
+    index = get_routing_index()
+    if model_name and model_size_b is not None:
+        candidate_nodes, rejected = index.route(model_name, model_size_b)
+        if routing_log.isEnabledFor(logging.DEBUG):
+            # 逐節點的篩選結果只在 DEBUG 級別輸出（也可以通過 /api/routing/query 查看）
+            for node, reason in rejected:
+                routing_log.debug("Node %s rejected for %s (%sB): %s", node["name"], model_name, model_size_b, reason)
+            for node in candidate_nodes:
+                routing_log.debug("✓ Node %s accepted for %s (%sB)", node["name"], model_name, model_size_b)
+        # 如果沒有符合條件的節點，回退到所有健康節點（允許模型下載）
+        if not candidate_nodes:
+            routing_log.warning("⚠️  No suitable nodes found for model %s (%sB), falling back to all healthy nodes",
+                                model_name, model_size_b)
+            candidate_nodes = index.healthy_nodes
+    else:
+        # 如果沒有模型名稱，返回所有健康節點
+        candidate_nodes = index.healthy_nodes
+    if exclude:
+        return [n for n in candidate_nodes if n["name"] not in exclude]
+    return list(candidate_nodes)
+
+
+# 前綴親和路由：同一對話的後續輪次發送到持有其 KV 緩存的節點，避免重新計算整個提示詞
+PREFIX_AFFINITY_ENABLED = os.getenv("PREFIX_AFFINITY_ENABLED", "false").lower() == "true"
+PREFIX_AFFINITY_PATHS = ("/api/chat", "/api/generate")
+PREFIX_AFFINITY_MAX_MESSAGES = int(os.getenv("PREFIX_AFFINITY_MAX_MESSAGES", "4"))  # /api/chat 前綴最多包含的消息數（系統消息 + 第一條用戶消息）
+PREFIX_AFFINITY_CONTEXT_TOKENS = int(os.getenv("PREFIX_AFFINITY_CONTEXT_TOKENS", "256"))  # /api/generate 的 context 取前多少個 token
+PREFIX_AFFINITY_PROMPT_CHARS = int(os.getenv("PREFIX_AFFINITY_PROMPT_CHARS", "2048"))  # 沒有 context 時取 prompt 的前多少個字符
+PREFIX_AFFINITY_LOAD_FACTOR = float(os.getenv("PREFIX_AFFINITY_LOAD_FACTOR", "1.25"))  # 有界負載：節點負載最多為平均值的倍數
+PREFIX_AFFINITY_VNODES = int(os.getenv("PREFIX_AFFINITY_VNODES", "64"))  # 每個節點在哈希環上的虛擬節點數
+PREFIX_AFFINITY_SESSIONS = int(os.getenv("PREFIX_AFFINITY_SESSIONS", "10000"))  # 記住最近多少個對話前綴所在的節點
+
+# 親和鍵 → {"node": 上一輪處理的節點, "tokens": 該節點上已緩存的上下文 token 數（估算）}
+affinity_sessions: "OrderedDict[str, Dict]" = OrderedDict()
+
+
+def _affinity_digest(full_model_name: str, kind: str, value) -> str:
+    data = json.dumps([normalize_model_tag(full_model_name), kind, value], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def _is_user_message(message) -> bool:
+    return isinstance(message, dict) and message.get("role") == "user"
+
+
+def prefix_affinity_key(path: str, body_bytes: bytes, full_model_name: Optional[str]) -> Optional[str]:
+    """根據對話前綴計算親和鍵，無法確定前綴時返回 None
+    
+    /api/chat 取系統消息和第一條用戶消息（同一對話的每一輪都相同）；
+    /api/generate 取 context 的前 N 個 token，沒有 context 時取 system 和 prompt 的開頭。
+    只掃描請求體前綴，不解析完整的對話歷史。
+    """
+    if not PREFIX_AFFINITY_ENABLED or path not in PREFIX_AFFINITY_PATHS or not full_model_name or not body_bytes:
+        return None
+    if path == "/api/chat":
+        messages = scan_json_array_prefix(body_bytes, "messages", PREFIX_AFFINITY_MAX_MESSAGES, stop=_is_user_message)
+        if not messages or not all(isinstance(m, dict) for m in messages):
+            return None
+        return _affinity_digest(full_model_name, "messages", [[m.get("role"), m.get("content")] for m in messages])
+    context = scan_json_array_prefix(body_bytes, "context", PREFIX_AFFINITY_CONTEXT_TOKENS)
+    if context:
+        return _affinity_digest(full_model_name, "context", context)
+    fields = scan_json_fields(body_bytes, ("system", "prompt"))
+    prompt = fields.get("prompt")
+    if not isinstance(prompt, str) or not prompt:
+        return None
+    return _affinity_digest(full_model_name, "prompt", [fields.get("system"), prompt[:PREFIX_AFFINITY_PROMPT_CHARS]])
+
+
+class AffinityRing:
+    """一致性哈希環：每個節點有 PREFIX_AFFINITY_VNODES 個虛擬節點，節點增減只移動相鄰區間的對話"""
+    
+    def __init__(self, node_names):
+        points = sorted(
+            (int(hashlib.blake2b(f"{name}#{i}".encode(), digest_size=8).hexdigest(), 16), name)
+            for name in node_names for i in range(PREFIX_AFFINITY_VNODES)
+        )
+        self.hashes = [h for h, _ in points]
+        self.names = [name for _, name in points]
+        self.node_count = len(set(self.names))
+    
+    def walk(self, affinity_key: str):
+        """從親和鍵所在位置順時針依次返回不重複的節點名"""
+        if not self.names:
+            return
+        start = bisect.bisect(self.hashes, int(affinity_key[:16], 16))
+        seen: Set[str] = set()
+        for i in range(len(self.names)):
+            name = self.names[(start + i) % len(self.names)]
+            if name not in seen:
+                seen.add(name)
+                yield name
+                if len(seen) == self.node_count:
+                    return
+
+
+def prefix_affinity_pick(candidate_nodes: List[Dict], affinity_key: str) -> Optional[Dict]:
+    """有界負載的一致性哈希：在候選節點中為對話前綴選擇節點
+    
+    優先選擇上一輪處理該對話的節點（KV 緩存所在），其次是哈希環上順時針的第一個候選節點；
+    活躍連接數達到 ceil(LOAD_FACTOR × (候選節點總連接數 + 1) / 候選節點數) 的節點被跳過，
+    熱門對話因此不會壓垮單個節點。
+    """
+    if not candidate_nodes:
+        return None
+    by_name = {n["name"]: n for n in candidate_nodes}
+    load = {name: node_active_connections(name) for name in by_name}
+    total = sum(load.values())
+    bound = math.ceil(PREFIX_AFFINITY_LOAD_FACTOR * (total + 1) / len(by_name))
+    
+    session = affinity_sessions.get(affinity_key)
+    if session and session["node"] in by_name and load[session["node"]] < bound:
+        return by_name[session["node"]]
+    for name in get_routing_index().affinity_ring().walk(affinity_key):
+        if name not in by_name:
+            continue
+        if load[name] < bound:
+            return by_name[name]
+        prefix_affinity_overflows.labels(node=name).inc()
+    return None
+
+
+def record_prefix_affinity(affinity_key: str, node_name: str, full_model_name: str, stats: Dict, done_line: bytes):
+    """請求完成後記錄對話前綴所在的節點，並估算因命中 KV 緩存而省去的提示詞 token
+    
+    Ollama 的 prompt_eval_count 只包含實際計算的 token，所以節點上緩存的上下文約為
+    上一輪的緩存 + 本輪 prompt_eval_count + eval_count。
+    """
+    session = affinity_sessions.pop(affinity_key, None)
+    cached_tokens = 0
+    if session is None:
+        prefix_affinity_requests.labels(result="new").inc()
+    elif session["node"] == node_name:
+        prefix_affinity_requests.labels(result="hit").inc()
+        cached_tokens = session["tokens"]
+        if cached_tokens:
+            prefix_affinity_saved_tokens.labels(node=node_name).inc(cached_tokens)
+    else:
+        prefix_affinity_requests.labels(result="moved").inc()
+    entry = {
+        "node": node_name,
+        "tokens": int(cached_tokens + (_positive(stats, "prompt_eval_count") or 0) + (_positive(stats, "eval_count") or 0)),
+    }
+    affinity_sessions[affinity_key] = entry
+    # /api/generate 的下一輪會帶上本輪返回的 context：把它的前綴也固定到本節點
+    context = scan_json_array_prefix(done_line.strip(), "context", PREFIX_AFFINITY_CONTEXT_TOKENS) if done_line else None
+    if context:
+        context_key = _affinity_digest(full_model_name, "context", context)
+        affinity_sessions.pop(context_key, None)
+        affinity_sessions[context_key] = dict(entry)
+    while len(affinity_sessions) > PREFIX_AFFINITY_SESSIONS:
+        affinity_sessions.popitem(last=False)
+
+
+def select_node(model_name: Optional[str] = None, model_size_b: Optional[int] = None,
+                exclude: Optional[Set[str]] = None, full_model_name: Optional[str] = None,
+                require_free_slot: bool = False, affinity_key: Optional[str] = None) -> Optional[Dict]:
+    """根據調度策略選擇節點，支持模型感知的節點選擇
+    
+    Args:
+        exclude: 不參與選擇的節點名稱（例如本次請求中已經失敗的節點）
+        full_model_name: 完整模型名（含tag），用於優先選擇模型已常駐內存的節點
+        require_free_slot: 只選擇還有空閒並發槽位的節點（准入控制使用）
+        affinity_key: 對話前綴的親和鍵，有值時優先按有界負載一致性哈希選擇
+    """
+    candidate_nodes = get_candidate_nodes(model_name, model_size_b, exclude)
+    
+    # 優先路由到模型已常駐內存的節點，避免 30~90 秒的冷加載
+    resident_aware = bool(full_model_name and model_name and model_size_b is not None)
+    if resident_aware:
+        candidate_nodes = prefer_resident_nodes(candidate_nodes, full_model_name)
+    
+    if require_free_slot:
+        candidate_nodes = [n for n in candidate_nodes if node_has_free_slot(n["name"], full_model_name)]
+    
+    # 有親和鍵時按有界負載的一致性哈希選擇，否則根據調度策略選擇
+    if affinity_key and candidate_nodes:
+        node = prefix_affinity_pick(candidate_nodes, affinity_key)
+    elif SCHEDULING_STRATEGY == "least_connections":
+        node = NodeSelector.least_connections(candidate_nodes)
+    elif SCHEDULING_STRATEGY == "weighted_round_robin":
+        node = NodeSelector.weighted_round_robin(candidate_nodes)
+    elif SCHEDULING_STRATEGY == "p2c_ewma":
+        node = NodeSelector.p2c_ewma(candidate_nodes, full_model_name)
+    else:  # 默認使用 round_robin
+        node = NodeSelector.round_robin(candidate_nodes)
+    
+    if node and resident_aware and not is_model_resident(node["name"], full_model_name):
+        routing_cold_loads.labels(node=node["name"]).inc()
+        mark_model_resident(node["name"], full_model_name)
+    return node
+
+
+def get_node_url(node: Dict) -> str:
+    """獲取節點的完整URL"""
+    node_type = node.get("type", "local")
+    if node_type == "external":
+        # 外部節點使用 api_url
+        api_url = node.get("api_url", "")
+        # 確保 URL 以 / 結尾（如果需要的話）
+        if api_url and not api_url.endswith("/"):
+            return api_url
+        return api_url
+    else:
+        # 本地節點使用 hosts 和 port
+        hosts = node.get("hosts", [])
+        if not hosts:
+            raise ValueError(f"Local node {node.get('name')} has no hosts configured")
+        port = node.get("port", 11434)
+        return f"http://{hosts[0]}:{port}"
+
+
+def get_node_headers(node: Dict) -> Dict[str, str]:
+    """獲取節點的請求頭（包括 API key）"""
+    headers = {}
+    node_type = node.get("type", "local")
+    
+    if node_type == "external":
+        # 外部節點：添加配置的 headers
+        config_headers = node.get("headers", {})
+        headers.update(config_headers)
         
-        # 構建請求頭
-        headers = get_node_headers(node)
+        # 如果有 api_key，添加到 Authorization header（如果還沒有設置）
+        api_key = node.get("api_key", "")
+        if api_key and "Authorization" not in headers:
+            headers["Authorization"] = f"Bearer {api_key}"
+    
+    return headers
+
+# Ollama 以 application/x-ndjson 流式返回 /api/generate、/api/chat、/api/pull 等，
+# OpenAI 兼容端點（/v1/*）則使用 text/event-stream
+STREAMING_CONTENT_TYPES = ("application/x-ndjson", "text/event-stream")
+
+
+def is_streaming_content_type(content_type: str) -> bool:
+    """判斷響應是否為需要逐塊轉發的流式內容"""
+    content_type = (content_type or "").lower()
+    return any(t in content_type for t in STREAMING_CONTENT_TYPES)
+
+
+def occupy_node_connection(node_name: str, full_model_name: Optional[str] = None):
+    """請求被分配到節點時佔用一個連接（以及該模型的一個並發槽位）"""
+    node_stats[node_name]["active_connections"] += 1
+    active_connections.labels(node=node_name).set(node_stats[node_name]["active_connections"])
+    if full_model_name:
+        key = (node_name, normalize_model_tag(full_model_name))
+        node_model_inflight[key] = node_model_inflight.get(key, 0) + 1
+    if shared_counters is not None:
+        shared_counters.add(f"conn:{node_name}", 1)
+        if full_model_name:
+            shared_counters.add(f"model:{node_name}:{normalize_model_tag(full_model_name)}", 1)
+
+
+def release_node_connection(node_name: str, full_model_name: Optional[str] = None):
+    """請求結束（包括流式響應關閉）時釋放節點的活躍連接計數，並把空出的槽位分配給排隊的請求"""
+    if full_model_name:
+        key = (node_name, normalize_model_tag(full_model_name))
+        remaining = node_model_inflight.get(key, 0) - 1
+        if remaining > 0:
+            node_model_inflight[key] = remaining
+        else:
+            node_model_inflight.pop(key, None)
+    if shared_counters is not None:
+        shared_counters.add(f"conn:{node_name}", -1)
+        if full_model_name:
+            shared_counters.add(f"model:{node_name}:{normalize_model_tag(full_model_name)}", -1)
+    if node_name in node_stats:
+        node_stats[node_name]["active_connections"] = max(0, node_stats[node_name]["active_connections"] - 1)
+        active_connections.labels(node=node_name).set(node_stats[node_name]["active_connections"])
+    dispatch_waiters()
+
+
+def local_active_connections(node_name: str) -> int:
+    """本網關發往節點、正在處理的請求數（多進程模式下為所有工作進程之和）"""
+    if shared_counters is not None:
+        return shared_counters.total(f"conn:{node_name}")
+    return node_stats[node_name]["active_connections"]
+
+
+def node_active_connections(node_name: str) -> int:
+    """節點正在處理的請求數，包括集群中其他網關發往該節點的請求"""
+    return local_active_connections(node_name) + peer_node_load.get(node_name, 0)
+
+
+def node_model_active(node_name: str, full_model_name: str) -> int:
+    """節點上該模型正在處理的請求數（多進程模式下為所有工作進程之和）"""
+    if shared_counters is not None:
+        return shared_counters.total(f"model:{node_name}:{normalize_model_tag(full_model_name)}")
+    return node_model_inflight.get((node_name, normalize_model_tag(full_model_name)), 0)
+
+
+def next_round_robin_index() -> int:
+    """輪詢游標：多進程模式下每個工作進程各自輪詢，起點按進程號錯開（第 n 次為 n + 進程號）
+    
+    不使用所有進程之和：先加再讀總數不是原子操作，兩個進程同時選擇時會得到相同的游標。
+    各進程分別輪詢時每個節點得到的請求仍然均勻，只是全局順序不嚴格交替。
+    """
+    global round_robin_index
+    if shared_counters is not None:
+        shared_counters.add("round_robin", 1)
+        return shared_counters.local("round_robin") - 1 + worker_index
+    index = round_robin_index
+    round_robin_index += 1
+    return index
+
+
+# 准入控制：每個節點和每個（節點, 模型）的並發槽位，0 表示不限制
+# 可在 node_config.json 中按節點覆蓋：max_concurrent_requests、num_parallel、model_parallel
+DEFAULT_NODE_MAX_CONCURRENT = int(os.getenv("NODE_MAX_CONCURRENT", "0"))
+DEFAULT_MODEL_NUM_PARALLEL = int(os.getenv("MODEL_NUM_PARALLEL", "0"))  # 對應 Ollama 的 OLLAMA_NUM_PARALLEL
+ADMISSION_QUEUE_MAX_DEPTH = int(os.getenv("ADMISSION_QUEUE_MAX_DEPTH", "100"))  # 等待隊列最大長度
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "60"))  # 單個請求最長排隊時間（秒）
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))  # 隊列已滿時建議客戶端的重試間隔（秒）
+
+# 每個（節點, 完整模型名）正在處理的請求數
+node_model_inflight: Dict[Tuple[str, str], int] = {}
+# FIFO 等待隊列：每項為 {"future", "model_name", "model_size_b", "full_model_name", "exclude", "affinity_key"}
+admission_waiters: deque = deque()
+
+
+def get_node_slot_limit(node_name: str) -> int:
+    """節點的總並發上限（0 表示不限制）"""
+    return int(node_config.get(node_name, {}).get("max_concurrent_requests") or DEFAULT_NODE_MAX_CONCURRENT)
+
+
+def get_model_slot_limit(node_name: str, full_model_name: str) -> int:
+    """節點上單個已加載模型的並發上限（0 表示不限制）"""
+    node_cfg = node_config.get(node_name, {})
+    model_parallel = node_cfg.get("model_parallel") or {}
+    limit = model_parallel.get(normalize_model_tag(full_model_name)) or model_parallel.get(full_model_name)
+    return int(limit or node_cfg.get("num_parallel") or DEFAULT_MODEL_NUM_PARALLEL)
+
+
+def node_has_free_slot(node_name: str, full_model_name: Optional[str]) -> bool:
+    """節點是否還能接受該模型的請求（配置重新加載後已移除的節點不再接受）"""
+    if node_name not in node_stats:
+        return False
+    node_limit = get_node_slot_limit(node_name)
+    if node_limit and node_active_connections(node_name) >= node_limit:
+        return False
+    if full_model_name:
+        model_limit = get_model_slot_limit(node_name, full_model_name)
+        if model_limit and node_model_active(node_name, full_model_name) >= model_limit:
+            return False
+    return True
+
+
+def try_acquire_node(model_name: Optional[str], model_size_b: Optional[int], full_model_name: Optional[str],
+                     exclude: Optional[Set[str]] = None, affinity_key: Optional[str] = None) -> Optional[Dict]:
+    """選擇一個有空閒槽位的節點並佔用槽位，沒有則返回 None（不等待）"""
+    node = select_node(model_name, model_size_b, exclude=exclude, full_model_name=full_model_name,
+                       require_free_slot=True, affinity_key=affinity_key)
+    if node:
+        occupy_node_connection(node["name"], full_model_name)
+    return node
+
+
+def dispatch_waiters():
+    """按 FIFO 順序把空閒槽位分配給排隊的請求（先釋放槽位的節點先接收）"""
+    if not admission_waiters:
+        return
+    for waiter in list(admission_waiters):
+        if waiter["future"].done():
+            admission_waiters.remove(waiter)
+            continue
+        node = try_acquire_node(waiter["model_name"], waiter["model_size_b"], waiter["full_model_name"],
+                                waiter["exclude"], waiter["affinity_key"])
+        if node:
+            admission_waiters.remove(waiter)
+            waiter["future"].set_result(node)
+    admission_queue_depth.set(len(admission_waiters))
+
+
+async def acquire_node(model_name: Optional[str], model_size_b: Optional[int], full_model_name: Optional[str],
+                       exclude: Optional[Set[str]] = None, affinity_key: Optional[str] = None) -> Optional[Dict]:
+    """為請求分配節點和槽位
+    
+    有空閒槽位時立即返回；所有候選節點都滿時進入 FIFO 隊列等待，
+    由最先釋放槽位的節點接收。沒有任何可用節點時返回 None。
+    
+    Raises:
+        HTTPException: 隊列已滿（429）或排隊超時（503），均帶 Retry-After
+    """
+    node = try_acquire_node(model_name, model_size_b, full_model_name, exclude, affinity_key)
+    if node:
+        return node
+    
+    # 沒有任何健康的候選節點：排隊也無法得到服務
+    candidates = get_candidate_nodes(model_name, model_size_b, exclude)
+    if not any(n.get("enabled", True) and node_stats[n["name"]]["is_healthy"] for n in candidates):
+        return None
+    
+    if len(admission_waiters) >= ADMISSION_QUEUE_MAX_DEPTH:
+        admission_rejected.labels(reason="queue_full").inc()
+        raise HTTPException(
+            status_code=429,
+            detail="All nodes are busy and the request queue is full",
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+        )
+    
+    waiter = {
+        "future": asyncio.get_running_loop().create_future(),
+        "model_name": model_name,
+        "model_size_b": model_size_b,
+        "full_model_name": full_model_name,
+        "exclude": exclude,
+        "affinity_key": affinity_key,
+    }
+    admission_waiters.append(waiter)
+    admission_queue_depth.set(len(admission_waiters))
+    queued_at = time.time()
+    try:
+        node = await asyncio.wait_for(asyncio.shield(waiter["future"]), timeout=ADMISSION_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        admission_rejected.labels(reason="timeout").inc()
+        raise HTTPException(
+            status_code=503,
+            detail=f"Timed out after {ADMISSION_QUEUE_TIMEOUT:.0f}s waiting for a free node slot",
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+        )
+    finally:
+        if waiter in admission_waiters:
+            admission_waiters.remove(waiter)
+            admission_queue_depth.set(len(admission_waiters))
+        if not waiter["future"].done():
+            waiter["future"].cancel()
+        elif not waiter["future"].cancelled() and node is None:
+            # 超時 / 客戶端斷開與槽位分配同時發生：歸還已分配的槽位
+            assigned = waiter["future"].result()
+            release_node_connection(assigned["name"], full_model_name)
+    admission_wait_seconds.observe(time.time() - queued_at)
+    return node
+
+
+def build_node_client(node: Dict) -> httpx.AsyncClient:
+    """根據節點配置（timeout_seconds / headers / api_key / 連接上限）創建帶連接池的客戶端"""
+    timeout = httpx.Timeout(float(node.get("timeout_seconds", 300)), connect=10.0)
+    limits = httpx.Limits(
+        max_connections=node.get("max_connections", DEFAULT_NODE_MAX_CONNECTIONS),
+        max_keepalive_connections=node.get("max_keepalive", DEFAULT_NODE_MAX_KEEPALIVE),
+        keepalive_expiry=NODE_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(
+        base_url=get_node_url(node),
+        headers=get_node_headers(node),
+        timeout=timeout,
+        limits=limits,
+        follow_redirects=True,
+    )
+
+
+def get_node_client(node: Dict) -> httpx.AsyncClient:
+    """獲取節點的共享客戶端，不存在時創建"""
+    node_client = node_clients.get(node["name"])
+    if node_client is None or node_client.is_closed:
+        node_client = build_node_client(node)
+        node_clients[node["name"]] = node_client
+    return node_client
+
+
+async def preconnect_node_clients():
+    """預先與所有啟用的節點建立 keep-alive 連接，消除首個請求的握手延遲"""
+    async def preconnect(node: Dict):
+        try:
+            node_client = get_node_client(node)
+            await node_client.get("/api/version", timeout=httpx.Timeout(5.0, connect=10.0))
+        except Exception as e:
+            health_log.warning("⚠️  Pre-connect to %s failed: %s", node["name"], e)
+    
+    await asyncio.gather(*(preconnect(node) for node in NODES if node.get("enabled", True)))
+
+
+async def close_node_clients():
+    """關閉所有節點客戶端"""
+    clients = list(node_clients.values())
+    node_clients.clear()
+    await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+
+def parse_tags_models(data: Dict) -> Set[str]:
+    """從 /api/tags 響應中提取模型名集合（不含tag）"""
+    models = set()
+    for model_info in data.get("models", []):
+        model_name = model_info.get("name", "")
+        if not model_name:
+            continue
+        # 移除版本標籤，只保留模型名（用於節點過濾）
+        # 例如 "qwen2.5-coder:30b" -> "qwen2.5-coder"
+        if ":" in model_name:
+            model_name = model_name.split(":")[0]
+        models.add(model_name)
+    return models
+
+
+async def get_node_models(node: Dict) -> Set[str]:
+    """獲取節點上已下載的模型列表（只返回模型名，不含tag）"""
+    try:
+        base_url = get_node_url(node)
+        url = f"{base_url}/api/tags"
         
         # 設置超時
         timeout_seconds = node.get("timeout_seconds", 5.0) if node.get("type") == "external" else 5.0
         timeout = httpx.Timeout(timeout_seconds, connect=10.0)
         
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.get(url, headers=headers)
-            if response.status_code == 200:
-                data = response.json()
-                models = set()
-                for model_info in data.get("models", []):
-                    model_name = model_info.get("name", "")
-                    if not model_name:
-                        continue
-                    # 移除版本標籤，只保留模型名（用於節點過濾）
-                    # 例如 "qwen2.5-coder:30b" -> "qwen2.5-coder"
-                    if ":" in model_name:
-                        model_name = model_name.split(":")[0]
-                    models.add(model_name)
-                print(f"  ✓ {node['name']}: Found {len(models)} models: {sorted(models)}")
-                return models
+        node_client = get_node_client(node)
+        response = await node_client.get(url, timeout=timeout)
+        if response.status_code == 200:
+            models = parse_tags_models(response.json())
+            health_log.debug("✓ %s: Found %d models: %s", node["name"], len(models), sorted(models))
+            return models
     except Exception as e:
-        print(f"  ❌ Failed to get models from {node['name']}: {e}")
+        health_log.warning("❌ Failed to get models from %s: %s", node["name"], e)
     return set()
 
 
+# 健康檢查參數
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "30"))  # 健康節點的檢查間隔（秒）
+HEALTH_CHECK_JITTER = float(os.getenv("HEALTH_CHECK_JITTER", "0.1"))  # 間隔抖動比例，避免所有節點同時探測
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "5"))  # 單個節點的探測截止時間（秒）
+HEALTH_CHECK_BACKOFF_BASE = float(os.getenv("HEALTH_CHECK_BACKOFF_BASE", "2"))  # 不健康節點首次重試間隔（秒）
+HEALTH_CHECK_BACKOFF_MAX = float(os.getenv("HEALTH_CHECK_BACKOFF_MAX", "60"))  # 不健康節點最大重試間隔（秒）
+
+
+def get_health_check_timeout(node: Dict) -> float:
+    """節點的健康探測截止時間，可在節點配置中用 health_check_timeout_seconds 覆蓋"""
+    return float(node.get("config", {}).get("health_check_timeout_seconds", HEALTH_CHECK_TIMEOUT))
+
+
+def schedule_next_health_check(node_name: str, is_healthy: bool):
+    """計算節點下次健康檢查時間：健康節點按帶抖動的固定間隔，不健康節點按指數退避"""
+    stats = node_stats[node_name]
+    if is_healthy:
+        stats["consecutive_failures"] = 0
+        delay = HEALTH_CHECK_INTERVAL * (1 + random.uniform(-HEALTH_CHECK_JITTER, HEALTH_CHECK_JITTER))
+    else:
+        stats["consecutive_failures"] = stats.get("consecutive_failures", 0) + 1
+        delay = min(HEALTH_CHECK_BACKOFF_MAX, HEALTH_CHECK_BACKOFF_BASE * 2 ** (stats["consecutive_failures"] - 1))
+        delay *= 1 + random.uniform(0, HEALTH_CHECK_JITTER)
+    stats["next_health_check"] = time.time() + delay
+
+
 async def health_check_node(node: Dict) -> bool:
-    """健康檢查節點並同步模型列表"""
+    """健康檢查節點並同步模型列表
+    
+    只請求一次 /api/tags：狀態碼用於判斷存活，同一份響應用於同步模型列表。
+    """
     try:
         base_url = get_node_url(node)
         url = f"{base_url}/api/tags"
         
-        # 構建請求頭
-        headers = get_node_headers(node)
-        
         # 設置超時
-        timeout_seconds = node.get("timeout_seconds", 5.0) if node.get("type") == "external" else 5.0
-        timeout = httpx.Timeout(timeout_seconds, connect=10.0)
+        deadline = get_health_check_timeout(node)
+        timeout = httpx.Timeout(deadline)
         
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.get(url, headers=headers)
-            is_healthy = response.status_code == 200
-            node_stats[node["name"]]["is_healthy"] = is_healthy
-            node_stats[node["name"]]["last_health_check"] = time.time()
-            node_health.labels(node=node["name"]).set(1 if is_healthy else 0)
-            
-            # 同步模型列表
-            if is_healthy:
-                print(f"🔄 Syncing models from {node['name']}...")
-                models = await get_node_models(node)
-                old_count = len(node_models.get(node["name"], set()))
-                node_models[node["name"]] = models
-                new_count = len(models)
-                node_stats[node["name"]]["last_model_sync"] = time.time()
-                if old_count != new_count:
-                    print(f"  📊 {node['name']}: Model count changed from {old_count} to {new_count}")
-            
+        node_client = get_node_client(node)
+        response = await asyncio.wait_for(node_client.get(url, timeout=timeout), timeout=deadline)
+        is_healthy = response.status_code == 200
+        tags_data = response.json() if is_healthy else None
+        models = parse_tags_models(tags_data) if is_healthy else None
+        if node["name"] not in node_stats:
+            # 探測期間節點已從配置中移除
             return is_healthy
+        was_healthy = node_stats[node["name"]]["is_healthy"]
+        node_stats[node["name"]]["is_healthy"] = is_healthy
+        node_stats[node["name"]]["last_health_check"] = time.time()
+        node_health.labels(node=node["name"]).set(1 if is_healthy else 0)
+        
+        # 同步模型列表
+        if is_healthy:
+            old_models = node_models.get(node["name"], set())
+            old_count = len(old_models)
+            node_models[node["name"]] = models
+            new_count = len(models)
+            if not was_healthy or models != old_models:
+                invalidate_routing_index()
+            node_stats[node["name"]]["last_model_sync"] = time.time()
+            if old_count != new_count:
+                health_log.info("📊 %s: Model count changed from %d to %d", node["name"], old_count, new_count)
+            update_node_tags(node["name"], tags_data.get("models", []), health_changed=not was_healthy)
+            if not was_healthy:
+                # 節點恢復後可以接收排隊中的請求
+                dispatch_waiters()
+        elif was_healthy:
+            invalidate_tags_catalog()
+            invalidate_routing_index()
+        
+        schedule_next_health_check(node["name"], is_healthy)
+        return is_healthy
     except Exception as e:
-        print(f"❌ Health check failed for {node['name']}: {e}")
+        if isinstance(e, asyncio.TimeoutError):
+            e = f"no response within {get_health_check_timeout(node)}s"
+        health_log.warning("❌ Health check failed for %s: %s", node["name"], str(e) or repr(e))
+        if node["name"] not in node_stats:
+            return False
+        if node_stats[node["name"]]["is_healthy"]:
+            invalidate_tags_catalog()
+            invalidate_routing_index()
         node_stats[node["name"]]["is_healthy"] = False
         node_stats[node["name"]]["last_health_check"] = time.time()
         node_health.labels(node=node["name"]).set(0)
+        schedule_next_health_check(node["name"], False)
         return False
 
 
+async def health_check_nodes(nodes: List[Dict]) -> List[bool]:
+    """並發檢查多個節點，總耗時取決於最慢的節點而不是節點數量"""
+    return await asyncio.gather(*(health_check_node(node) for node in nodes))
+
+
 async def periodic_health_check():
-    """定期健康檢查所有節點"""
+    """定期健康檢查所有節點
+    
+    每個節點有自己的下次檢查時間（見 schedule_next_health_check），
+    到期的節點各自在獨立任務中探測，單個節點超時不會拖慢其他節點。
+    集群模式下只探測本網關負責的節點（見 owns_node），其他節點的狀態來自 gossip。
+    """
+    in_flight: Dict[str, asyncio.Task] = {}
     while True:
+        now = time.time()
         for node in NODES:
-            if node.get("enabled", True):
-                await health_check_node(node)
-        await asyncio.sleep(30)  # 每30秒檢查一次
+            if (
+                node.get("enabled", True)
+                and node["name"] in node_stats
+                and node["name"] not in in_flight
+                and (node_stats[node["name"]].get("next_health_check") or 0) <= now
+                and owns_node(node["name"])
+            ):
+                task = asyncio.create_task(health_check_node(node))
+                in_flight[node["name"]] = task
+                task.add_done_callback(lambda _, name=node["name"]: in_flight.pop(name, None))
+        
+        # 睡到下一個節點到期（最多 1 秒，以便及時發現配置變更新增的節點）
+        next_due = min(
+            (node_stats[n["name"]].get("next_health_check") or 0 for n in NODES
+             if n["name"] in node_stats and owns_node(n["name"])),
+            default=now + 1,
+        )
+        await asyncio.sleep(min(1.0, max(0.05, next_due - time.time())))
 
 
 @app.on_event("startup")
@@ -659,27 +2140,1268 @@ async def startup_event():
         active_connections.labels(node=node["name"]).set(0)
         node_health.labels(node=node["name"]).set(0)
     
-    # 啟動健康檢查任務
-    asyncio.create_task(periodic_health_check())
+    # 預先建立到各節點的 keep-alive 連接（後台進行，不阻塞啟動）
+    asyncio.create_task(preconnect_node_clients())
+    
+    if shared_counters is not None:
+        # 其他工作進程釋放的槽位不會觸發本進程的 dispatch_waiters，需要輪詢
+        asyncio.create_task(poll_shared_slots())
+        if worker_index != 0:
+            # 只有 0 號工作進程做健康檢查和模型同步，其他進程讀取它發布的快照
+            asyncio.create_task(follow_routing_state())
+            print(f"✅ Worker {worker_index} accepting requests, following health snapshots from worker 0")
+            return
+        asyncio.create_task(publish_routing_state())
     
-    # 立即執行一次健康檢查和模型同步
+    # 集群模式：與配置中的其他網關交換節點狀態，健康檢查按節點分片
+    asyncio.create_task(gossip_loop())
+    if WARMUP_ENABLED:
+        asyncio.create_task(warmup_controller())
+    
+    # 首輪健康檢查和模型同步在後台進行，網關立即開始接受請求；
+    # 已通過探測的節點可以立即參與路由，/ready 在首輪完成後返回 200
+    asyncio.create_task(initial_health_check())
+    print("✅ Gateway accepting requests, initial health check running in background")
+
+
+async def initial_health_check():
+    """首輪健康檢查：並發探測所有節點，完成後標記網關就緒並啟動定期檢查"""
+    global gateway_ready
     print("🔄 Performing initial health check and model sync...")
-    for node in NODES:
-        if node.get("enabled", True):
-            await health_check_node(node)
+    started = time.time()
+    await health_check_nodes([node for node in NODES if node.get("enabled", True)])
+    gateway_ready = True
     
     # 打印初始模型統計
     total_models = sum(len(models) for models in node_models.values())
-    print(f"✅ Gateway started. Total unique models across all nodes: {total_models}")
+    print(f"✅ Initial inventory ready in {time.time() - started:.2f}s. Total unique models across all nodes: {total_models}")
     for node_name, models in node_models.items():
         if models:
             print(f"   {node_name}: {len(models)} models")
+    
+    # 啟動常駐模型跟蹤和健康檢查任務
+    asyncio.create_task(periodic_residency_refresh())
+    await periodic_health_check()
+
+
+def export_node_state(node_name: str) -> Dict:
+    """節點的探測結果：健康狀態、模型列表、/api/tags 結果和常駐模型"""
+    stats = node_stats[node_name]
+    return {
+        "is_healthy": stats["is_healthy"],
+        "last_health_check": stats["last_health_check"],
+        "last_model_sync": stats["last_model_sync"],
+        "models": sorted(node_models.get(node_name, ())),
+        "tags": node_tags.get(node_name),
+        "loaded": node_loaded_models.get(node_name, {}),
+    }
+
+
+def apply_node_state(node_name: str, entry: Dict) -> bool:
+    """應用其他進程（或其他網關）對節點的探測結果，返回健康狀態或模型列表是否變化
+    
+    健康狀態和模型列表只在對方重新探測過該節點後才覆蓋，
+    本進程的被動摘除（record_passive_failure）因此會保持到下一次探測。
+    """
+    stats = node_stats.get(node_name)
+    if stats is None:
+        # 本進程尚未重新加載包含該節點的配置
+        return False
+    node_loaded_models[node_name] = entry["loaded"]
+    if entry["last_health_check"] == stats["last_health_check"]:
+        return False
+    was_healthy = stats["is_healthy"]
+    is_healthy = entry["is_healthy"]
+    stats["is_healthy"] = is_healthy
+    stats["last_health_check"] = entry["last_health_check"]
+    stats["last_model_sync"] = entry["last_model_sync"]
+    node_health.labels(node=node_name).set(1 if is_healthy else 0)
+    models = set(entry["models"])
+    changed = was_healthy != is_healthy or models != node_models.get(node_name)
+    node_models[node_name] = models
+    if is_healthy and entry["tags"] is not None:
+        update_node_tags(node_name, entry["tags"], health_changed=not was_healthy)
+    elif was_healthy:
+        invalidate_tags_catalog()
+    return changed
+
+
+def export_routing_state() -> Dict:
+    """0 號工作進程發布的快照：各節點的探測結果，以及集群中其他網關的負載"""
+    return {
+        "ready": gateway_ready,
+        "nodes": {node_name: export_node_state(node_name) for node_name in node_stats},
+        "peer_load": peer_node_load,
+    }
+
+
+def apply_routing_state(state: Dict):
+    """在其他工作進程中應用快照，只有健康狀態或模型列表變化時才重建路由索引"""
+    global gateway_ready, peer_node_load
+    gateway_ready = gateway_ready or bool(state.get("ready"))
+    changed = False
+    for node_name, entry in state.get("nodes", {}).items():
+        changed = apply_node_state(node_name, entry) or changed
+    peer_node_load = state.get("peer_load", {})
+    if changed:
+        invalidate_routing_index()
+    dispatch_waiters()
+
+
+def write_routing_state(data: bytes):
+    """原子地替換快照文件，讀取方不會看到寫了一半的內容"""
+    tmp_path = f"{routing_state_file}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, routing_state_file)
+
+
+async def publish_routing_state():
+    """0 號工作進程：內容變化時發布健康檢查快照"""
+    last_data = None
+    while True:
+        try:
+            check_config_generation()
+            data = json.dumps(export_routing_state(), ensure_ascii=False).encode()
+            if data != last_data:
+                write_routing_state(data)
+                last_data = data
+        except Exception as e:
+            health_log.warning("⚠️  Failed to publish routing state: %s", e)
+        await asyncio.sleep(STATE_SYNC_INTERVAL)
+
+
+async def follow_routing_state():
+    """其他工作進程：快照文件變化時讀取並應用"""
+    last_mtime = None
+    while True:
+        try:
+            check_config_generation()
+            mtime = os.stat(routing_state_file).st_mtime_ns
+            if mtime != last_mtime:
+                with open(routing_state_file, "rb") as f:
+                    state = json.loads(f.read())
+                last_mtime = mtime
+                apply_routing_state(state)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            health_log.warning("⚠️  Failed to apply routing state: %s", e)
+        await asyncio.sleep(STATE_SYNC_INTERVAL)
+
+
+async def poll_shared_slots():
+    """有請求排隊時定期檢查其他工作進程是否釋放了槽位"""
+    while True:
+        await asyncio.sleep(SHARED_SLOT_POLL_INTERVAL)
+        if admission_waiters:
+            dispatch_waiters()
+
+
+# 已應用的配置版本：通過 /api/config 保存或重新加載配置的工作進程遞增共享計數，其他進程隨後重新加載
+config_generation = 0
+
+
+def announce_config_change():
+    """配置在本進程中重新加載後，通知其他工作進程"""
+    global config_generation
+    if shared_counters is not None:
+        shared_counters.add("config_generation", 1)
+        config_generation = shared_counters.total("config_generation")
+
+
+def check_config_generation():
+    """其他工作進程修改了配置時重新加載"""
+    global config_generation
+    generation = shared_counters.total("config_generation")
+    if generation != config_generation:
+        config_generation = generation
+        health_log.info("🔄 Worker %d: configuration changed by another worker, reloading", worker_index)
+        load_config()
+
+
+# 網關集群：配置文件中列出的網關通過 HTTP gossip 交換節點負載、健康狀態和常駐模型
+GOSSIP_INTERVAL = float(os.getenv("GOSSIP_INTERVAL", "1"))  # 與每個對等網關交換狀態的間隔（秒）
+GOSSIP_PEER_TIMEOUT = float(os.getenv("GOSSIP_PEER_TIMEOUT", "5"))  # 超過此時間沒有成功交換的網關視為離線（秒）
+GOSSIP_PORT = int(os.getenv("GOSSIP_PORT", "0"))  # 多進程模式下 0 號工作進程額外監聽的 gossip 端口（0 表示不監聽）
+
+
+class ClusterState:
+    """gossip 狀態：本網關發布的節點條目（帶版本號）和從其他網關收到的條目
+    
+    每次交換只發送對方尚未確認的版本之後變化的條目；網關重啟後 incarnation 改變，對方會重新收到完整狀態。
+    條目包含本網關發往節點的請求數，以及本網關負責探測的節點的探測結果（見 export_node_state）。
+    """
+    
+    def __init__(self):
+        self.incarnation = f"{GATEWAY_NAME}@{time.time():.6f}"
+        self.version = 0
+        # 節點名 -> {"v": 版本號, "entry": 條目}
+        self.local: Dict[str, Dict] = {}
+        # 網關名 -> {"incarnation", "version", "nodes", "seen_at"}
+        self.peers: Dict[str, Dict] = {}
+        # 網關名 -> 對方已收到的本網關狀態 {"incarnation", "version"}
+        self.acked: Dict[str, Dict] = {}
+        self.live: Set[str] = set()
+    
+    def refresh_local(self):
+        """用當前負載和探測結果更新本地條目，變化的條目獲得新的版本號"""
+        for node_name, stats in node_stats.items():
+            entry = {"load": local_active_connections(node_name)}
+            if stats["last_health_check"] is not None and owns_node(node_name):
+                entry["state"] = export_node_state(node_name)
+            current = self.local.get(node_name)
+            if current is None or current["entry"] != entry:
+                self.version += 1
+                self.local[node_name] = {"v": self.version, "entry": entry}
+        for node_name in [n for n in self.local if n not in node_stats]:
+            del self.local[node_name]
+    
+    def delta(self, have: Optional[Dict]) -> Dict:
+        """對方確認過的版本之後變化的條目；對方沒有本網關當前 incarnation 的狀態時發送全部條目"""
+        since = have.get("version", 0) if have and have.get("incarnation") == self.incarnation else 0
+        return {
+            "gateway": GATEWAY_NAME,
+            "incarnation": self.incarnation,
+            "version": self.version,
+            "nodes": {name: item["entry"] for name, item in self.local.items() if item["v"] > since},
+        }
+    
+    def have(self, peer: str) -> Dict:
+        state = self.peers.get(peer)
+        return {"incarnation": state["incarnation"], "version": state["version"]} if state else {}
+    
+    def merge(self, message: Dict) -> Dict:
+        """合並對方的增量，返回本次收到的節點條目"""
+        peer = message["gateway"]
+        state = self.peers.get(peer)
+        if state is None or state["incarnation"] != message.get("incarnation"):
+            state = self.peers[peer] = {"incarnation": message.get("incarnation"), "version": 0, "nodes": {}}
+        nodes = message.get("nodes") or {}
+        state["nodes"].update(nodes)
+        state["version"] = message.get("version", 0)
+        state["seen_at"] = time.time()
+        return nodes
+    
+    def live_peers(self) -> List[str]:
+        now = time.time()
+        configured = {peer["name"] for peer in cluster_peers}
+        return [
+            name for name, state in self.peers.items()
+            if name in configured and now - state["seen_at"] <= GOSSIP_PEER_TIMEOUT
+        ]
+
+
+cluster = ClusterState()
+
+
+def node_probe_owner(node_name: str) -> str:
+    """rendezvous 哈希：在在線網關中選出負責探測節點的網關，網關上下線只移動它負責的節點"""
+    members = [GATEWAY_NAME, *cluster.live_peers()]
+    return max(members, key=lambda m: hashlib.blake2b(f"{node_name}|{m}".encode(), digest_size=8).digest())
+
+
+def owns_node(node_name: str) -> bool:
+    """本網關是否負責探測該節點（未配置集群或對等網關都離線時探測所有節點）"""
+    return not cluster_peers or node_probe_owner(node_name) == GATEWAY_NAME
+
+
+def update_peer_load():
+    """匯總在線網關發往每個節點的請求數；對方負載下降時把槽位分配給排隊的請求"""
+    global peer_node_load
+    live = set(cluster.live_peers())
+    for peer in live - cluster.live:
+        health_log.info("🤝 Gateway peer %s is online", peer)
+    for peer in cluster.live - live:
+        health_log.warning("⚠️  Gateway peer %s is offline, taking over its health checks", peer)
+    cluster.live = live
+    load: Dict[str, int] = {}
+    for peer in live:
+        for node_name, entry in cluster.peers[peer]["nodes"].items():
+            if entry.get("load"):
+                load[node_name] = load.get(node_name, 0) + entry["load"]
+    decreased = any(load.get(node_name, 0) < count for node_name, count in peer_node_load.items())
+    peer_node_load = load
+    if decreased:
+        dispatch_waiters()
+
+
+def apply_gossip(message: Dict):
+    """應用對等網關的增量：負載總是計入，探測結果只接受負責探測該節點的網關
+    
+    負責的網關按本網關看到的在線網關計算。兩個網關對誰在線的判斷不一致時（例如一方剛恢復），
+    可能雙方都認為對方負責某個節點，該節點在 GOSSIP_PEER_TIMEOUT 內沒有網關探測，直到判斷重新一致。
+    """
+    peer = message["gateway"]
+    changed = False
+    for node_name, entry in cluster.merge(message).items():
+        if "state" in entry and node_probe_owner(node_name) == peer:
+            changed = apply_node_state(node_name, entry["state"]) or changed
+    if changed:
+        invalidate_routing_index()
+    update_peer_load()
+
+
+def cluster_headers() -> Dict[str, str]:
+    return {"X-Cluster-Secret": CLUSTER_SECRET}
+
+
+async def gossip_with(client: httpx.AsyncClient, peer: Dict):
+    """push-pull 交換：請求帶本網關的增量，響應帶對方的增量"""
+    message = cluster.delta(cluster.acked.get(peer["name"]))
+    message["have"] = cluster.have(peer["name"])
+    try:
+        response = await client.post(f"{peer['url'].rstrip('/')}/api/cluster/gossip", json=message,
+                                     headers=cluster_headers())
+        response.raise_for_status()
+        reply = response.json()
+    except Exception as e:
+        health_log.debug("Gossip with %s failed: %s", peer["name"], str(e) or repr(e))
+        return
+    if reply.get("gateway") != peer["name"]:
+        health_log.warning("⚠️  Gateway peer %s answered as %r, check GATEWAY_NAME", peer["name"], reply.get("gateway"))
+        return
+    cluster.acked[peer["name"]] = reply.get("have") or {}
+    apply_gossip(reply)
+
+
+async def gossip_loop():
+    """定期與每個對等網關交換狀態"""
+    async with httpx.AsyncClient(timeout=httpx.Timeout(max(1.0, GOSSIP_INTERVAL))) as client:
+        while True:
+            if cluster_peers:
+                try:
+                    cluster.refresh_local()
+                    await asyncio.gather(*(gossip_with(client, peer) for peer in cluster_peers))
+                    # 離線網關的負載不再計入
+                    update_peer_load()
+                except Exception as e:
+                    health_log.warning("⚠️  Gossip round failed: %s", e)
+            await asyncio.sleep(GOSSIP_INTERVAL)
+
+
+@app.post("/api/cluster/gossip")
+async def cluster_gossip(request: Request):
+    """接收對等網關的增量狀態，並返回本網關的增量"""
+    if not CLUSTER_SECRET:
+        raise HTTPException(status_code=403, detail="Cluster mode is disabled (CLUSTER_SECRET is not set)")
+    if not hmac.compare_digest(request.headers.get("X-Cluster-Secret", ""), CLUSTER_SECRET):
+        raise HTTPException(status_code=403, detail="Invalid cluster secret")
+    if shared_counters is not None and worker_index != 0:
+        raise HTTPException(status_code=503, detail="Gossip is handled by worker 0, point peers at GOSSIP_PORT")
+    message = await request.json()
+    peer = message.get("gateway")
+    if peer not in {p["name"] for p in cluster_peers}:
+        raise HTTPException(status_code=403, detail=f"Unknown gateway peer: {peer}")
+    apply_gossip(message)
+    cluster.acked[peer] = message.get("have") or {}
+    cluster.refresh_local()
+    reply = cluster.delta(message.get("have"))
+    reply["have"] = cluster.have(peer)
+    return reply
+
+
+@app.get("/api/cluster")
+async def cluster_status():
+    """集群視圖：對等網關、每個節點的探測負責網關和其他網關的負載"""
+    if shared_counters is not None and worker_index != 0:
+        raise HTTPException(status_code=503, detail="Cluster view is served by worker 0 on GOSSIP_PORT")
+    now = time.time()
+    live = set(cluster.live_peers())
+    return {
+        "gateway": GATEWAY_NAME,
+        "incarnation": cluster.incarnation,
+        "version": cluster.version,
+        "peers": [
+            {
+                "name": peer["name"],
+                "url": peer["url"],
+                "online": peer["name"] in live,
+                "last_seen_seconds": round(now - cluster.peers[peer["name"]]["seen_at"], 3)
+                if peer["name"] in cluster.peers else None,
+            }
+            for peer in cluster_peers
+        ],
+        "probe_owners": {node["name"]: node_probe_owner(node["name"]) for node in NODES},
+        "peer_load": peer_node_load,
+    }
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """關閉時清理資源"""
+    await close_node_clients()
+
+
+# 可能帶請求體的方法（Ollama 的 DELETE /api/delete 也帶 JSON 請求體）
+BODY_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+def is_blob_path(path: str) -> bool:
+    """/api/blobs/:digest 上傳的是模型文件本體，路由不需要讀取請求體"""
+    return path.startswith("/api/blobs/")
+
+
+async def read_request_body(request: Request, path: str) -> Tuple[bytes, Optional[AsyncIterator[bytes]]]:
+    """讀取請求體
+    
+    Returns:
+        (body_bytes, body_stream):
+        - /api/blobs/:digest 上傳：body_bytes 為空，body_stream 邊讀邊轉發，網關內存佔用與上傳大小無關
+        - 其他請求（JSON）：完整讀取，body_stream 為 None。model 字段可能位於很長的 messages 之後
+          （OpenAI SDK 先序列化 messages），只讀前綴會丟失路由；完整的請求體也保證了失敗重試、
+          對沖、去重和響應緩存對大請求同樣有效
+    """
+    if is_blob_path(path):
+        return b"", request.stream().__aiter__()
+    return await request.body(), None
+
+
+# 失敗重試：這些錯誤都發生在收到任何響應字節之前，可以安全地換一個節點重發
+RETRYABLE_ERRORS = (
+    httpx.ConnectError,
+    httpx.ConnectTimeout,
+    httpx.PoolTimeout,
+    httpx.RemoteProtocolError,
+    httpx.ReadError,
+    httpx.WriteError,
+)
+# 確定請求沒有到達節點的錯誤（建立連接失敗）
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# 有副作用的管理接口：讀寫錯誤時節點可能已經執行了請求，只在連接失敗時換節點重試
+NON_IDEMPOTENT_PATHS = ("/api/create", "/api/copy", "/api/delete", "/api/pull", "/api/push")
+PROXY_MAX_RETRIES = int(os.getenv("PROXY_MAX_RETRIES", "2"))  # 每個請求最多重試次數
+PROXY_RETRY_BUDGET_SECONDS = float(os.getenv("PROXY_RETRY_BUDGET_SECONDS", "15"))  # 每個請求可用於重試的總時間
+PASSIVE_FAILURE_THRESHOLD = int(os.getenv("PASSIVE_FAILURE_THRESHOLD", "2"))  # 連續多少次轉發失敗後將節點標記為不健康
+
+
+def is_retry_safe(path: str, error: Exception) -> bool:
+    """推理和只讀接口在 RETRYABLE_ERRORS 時都可重放；有副作用的接口只在連接失敗時重放"""
+    if path in NON_IDEMPOTENT_PATHS:
+        return isinstance(error, CONNECT_ERRORS)
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+def record_passive_failure(node_name: str):
+    """記錄轉發失敗（被動健康信號）：連續失敗達到閾值時立即將節點移出調度池，
+    並按退避策略安排重新探測，不必等到下一輪健康檢查"""
+    if node_name not in node_stats:
+        return
+    stats = node_stats[node_name]
+    stats["passive_failures"] = stats.get("passive_failures", 0) + 1
+    passive_failures.labels(node=node_name).inc()
+    if stats["is_healthy"] and stats["passive_failures"] >= PASSIVE_FAILURE_THRESHOLD:
+        health_log.warning("⚠️  %s marked unhealthy after %d consecutive proxy failures", node_name, stats["passive_failures"])
+        stats["is_healthy"] = False
+        node_health.labels(node=node_name).set(0)
+        invalidate_tags_catalog()
+        invalidate_routing_index()
+        schedule_next_health_check(node_name, False)
+
+
+def record_passive_success(node_name: str):
+    """轉發成功，重置連續失敗計數"""
+    if node_name in node_stats:
+        node_stats[node_name]["passive_failures"] = 0
+
+
+async def send_upstream(node: Dict, method: str, target_url: str, headers: Dict[str, str],
+                        body, params: Dict) -> httpx.Response:
+    """向節點發送請求，收到響應頭即返回（響應體由調用者以流的方式讀取並關閉）"""
+    request_headers = dict(headers)
+    # 如果是外部節點，添加節點的 headers（包括 API key）
+    request_headers.update(get_node_headers(node))
+    
+    # 使用節點的共享連接池（超時和認證頭已按節點配置設置）
+    upstream_client = get_node_client(node)
+    upstream_request = upstream_client.build_request(
+        method=method,
+        url=target_url,
+        headers=request_headers,
+        content=body,
+        params=params,
+    )
+    return await upstream_client.send(upstream_request, stream=True)
+
+
+# 轉發響應時不應傳遞的 hop-by-hop 頭
+SKIP_RESPONSE_HEADERS = {
+    "content-length", "transfer-encoding", "connection",
+    "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "upgrade"
+}
+
+
+def filter_response_headers(response: httpx.Response) -> Dict[str, str]:
+    """過濾響應頭，移除不應該傳遞的headers"""
+    return {key: value for key, value in response.headers.items() if key.lower() not in SKIP_RESPONSE_HEADERS}
+
+
+# 對沖請求（hedged requests）：默認關閉
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_PATHS = {"/api/embed", "/api/embeddings", "/api/show"}
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "1.0"))  # 樣本不足時的對沖延遲（秒）
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))  # 使用學習到的 p95 之前需要的最少樣本數
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.05"))  # 對沖請求最多佔可對沖請求的比例
+HEDGE_BUDGET_BURST = float(os.getenv("HEDGE_BUDGET_BURST", "10"))  # 預算最多累積的對沖次數
+
+
+class LatencyTracker:
+    """按 key（端點 + 模型）記錄最近的延遲樣本，提供 p95 估計"""
+    
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.samples: Dict[str, deque] = {}
+    
+    def record(self, key: str, seconds: float):
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.window)
+        self.samples[key].append(seconds)
+    
+    def p95(self, key: str) -> Optional[float]:
+        window = self.samples.get(key)
+        if not window or len(window) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(window)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+class HedgeBudget:
+    """令牌桶：每個可對沖請求積累 HEDGE_BUDGET_RATIO 個令牌，每次對沖消耗 1 個，
+    從而把對沖帶來的額外負載限制在該比例以內"""
+    
+    def __init__(self):
+        self.tokens = 0.0
+    
+    def earn(self):
+        self.tokens = min(HEDGE_BUDGET_BURST, self.tokens + HEDGE_BUDGET_RATIO)
+    
+    def try_spend(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+    
+    def refund(self):
+        """令牌已扣除但沒有發出對沖（沒有空閒節點）時退回"""
+        self.tokens = min(HEDGE_BUDGET_BURST, self.tokens + 1.0)
+
+
+hedge_latency = LatencyTracker()
+hedge_budget = HedgeBudget()
+
+
+def is_hedge_eligible(method: str, path: str, body_stream) -> bool:
+    """只有啟用對沖、端點可對沖、且請求體已完整緩存（可以重發）的請求才對沖"""
+    return HEDGING_ENABLED and method == "POST" and path in HEDGE_PATHS and body_stream is None
+
+
+class UpstreamStreamingResponse(StreamingResponse):
+    """轉發上游流的響應：客戶端在響應體開始迭代前斷開時，生成器的 finally 不會執行，
+    因此在響應結束（無論正常、斷開還是出錯）時再調用一次 on_close，保證上游連接關閉、節點槽位釋放"""
+    
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.on_close()
+
+
+async def fetch_from_node(node: Dict, method: str, path: str, headers: Dict[str, str],
+                          body: bytes, params: Dict, full_model_name: Optional[str]) -> Tuple[httpx.Response, bytes]:
+    """向已佔用槽位的節點發送請求並讀取完整響應體（用於對沖請求），結束時釋放槽位並記錄指標"""
+    node_name = node["name"]
+    target_url = f"{get_node_url(node)}{path}"
+    route, model_label = normalize_route(path), metric_model_label(full_model_name)
+    start_time = time.time()
+    try:
+        response = await send_upstream(node, method, target_url, headers, body, params)
+        try:
+            content = b"".join([chunk async for chunk in response.aiter_raw()])
+        finally:
+            await response.aclose()
+    except asyncio.CancelledError:
+        # 對沖中落敗的請求被取消，不算作節點失敗
+        raise
+    except Exception as e:
+        node_stats[node_name]["failed_requests"] += 1
+        status = "timeout" if isinstance(e, httpx.TimeoutException) and not isinstance(e, RETRYABLE_ERRORS) else "error"
+        request_count.labels(method=method, endpoint=route, node=node_name, model=model_label, status=status).inc()
+        if isinstance(e, RETRYABLE_ERRORS):
+            record_passive_failure(node_name)
+        proxy_log.error("❌ Request error to %s (%s): %r", node_name, target_url, e)
+        raise
+    finally:
+        release_node_connection(node_name, full_model_name)
+    
+    record_passive_success(node_name)
+    node_stats[node_name]["total_requests"] += 1
+    duration = time.time() - start_time
+    request_count.labels(method=method, endpoint=route, node=node_name, model=model_label, status=response.status_code).inc()
+    request_duration.labels(method=method, endpoint=route, node=node_name, model=model_label).observe(duration)
+    if response.status_code < 400:
+        record_request_performance(node_name, full_model_name, duration, duration, content, streamed=False)
+    return response, content
+
+
+async def hedged_proxy_request(method: str, path: str, headers: Dict[str, str], body: bytes, params: Dict,
+                               model_name: Optional[str], model_size_b: Optional[int],
+                               full_model_name: Optional[str]) -> Response:
+    """對沖轉發：首個節點在該模型學習到的 p95 內未完成時，向下一個候選節點發送副本，
+    先完成的響應勝出，另一個被取消。連接錯誤同樣會換節點重試。"""
+    hedge_key = f"{path}|{full_model_name or model_name or ''}"
+    delay = hedge_latency.p95(hedge_key) or HEDGE_DEFAULT_DELAY
+    hedge_budget.earn()
+    
+    used_nodes: Set[str] = set()
+    tasks: Dict[asyncio.Task, Tuple[str, float, bool]] = {}  # task -> (節點名, 開始時間, 是否為對沖副本)
+    
+    def start(node: Dict, is_hedge: bool):
+        used_nodes.add(node["name"])
+        task = asyncio.create_task(fetch_from_node(node, method, path, headers, body, params, full_model_name))
+        tasks[task] = (node["name"], time.time(), is_hedge)
+    
+    def launch(is_hedge: bool) -> bool:
+        # 對沖副本和重試只使用當前空閒的槽位，不排隊
+        node = try_acquire_node(model_name, model_size_b, full_model_name, exclude=used_nodes)
+        if not node:
+            return False
+        start(node, is_hedge)
+        return True
+    
+    node = await acquire_node(model_name, model_size_b, full_model_name, exclude=used_nodes)
+    if not node:
+        raise HTTPException(status_code=503, detail="No healthy nodes available")
+    start(node, False)
+    
+    started = time.time()
+    hedged = False
+    hedge_won = False
+    retries = 0
+    last_error: Optional[Exception] = None
+    try:
+        while tasks:
+            timeout = None if hedged else max(0.0, delay - (time.time() - started))
+            done, _ = await asyncio.wait(tasks.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # 首個節點超過 p95 仍未完成，在預算允許時發送對沖副本（每個請求最多一次）
+                hedged = True
+                if hedge_budget.try_spend():
+                    if launch(True):
+                        hedges_fired.labels(endpoint=path).inc()
+                        proxy_log.info("🪁 Hedging %s for %s after %.2fs", path, full_model_name or model_name, delay)
+                    else:
+                        hedge_budget.refund()
+                continue
+            for task in done:
+                node_name, task_started, is_hedge = tasks.pop(task)
+                try:
+                    response, content = task.result()
+                except RETRYABLE_ERRORS as e:
+                    last_error = e
+                    if retries < PROXY_MAX_RETRIES and time.time() - started < PROXY_RETRY_BUDGET_SECONDS:
+                        retries += 1
+                        if launch(False):
+                            proxy_retries.labels(node=node_name).inc()
+                    continue
+                except Exception as e:
+                    last_error = e
+                    continue
+                # 延遲分佈只記錄非對沖請求的耗時：只記錄勝出者會讓 p95 隨對沖不斷下降，對沖越來越激進
+                if is_hedge:
+                    hedges_won.labels(endpoint=path).inc()
+                    hedge_won = True
+                elif response.status_code < 500:
+                    hedge_latency.record(hedge_key, time.time() - task_started)
+                return Response(
+                    content=content,
+                    status_code=response.status_code,
+                    headers=filter_response_headers(response),
+                    media_type=response.headers.get("content-type", "application/json"),
+                )
+    finally:
+        for task, (_, task_started, is_hedge) in tasks.items():
+            if hedge_won and not is_hedge:
+                # 對沖勝出時原請求被取消：記錄到取消時為止的耗時（實際耗時的下界）
+                hedge_latency.record(hedge_key, time.time() - task_started)
+            task.cancel()
+    
+    if isinstance(last_error, httpx.TimeoutException) and not isinstance(last_error, RETRYABLE_ERRORS):
+        raise HTTPException(status_code=504, detail=f"Request timed out on {sorted(used_nodes)}")
+    raise HTTPException(status_code=502, detail=f"Error proxying to {sorted(used_nodes)}: {last_error}")
+
+
+# 嵌入請求微批處理：同一模型、相同參數的並發 /api/embed 請求合並為一次上游調用（Ollama 的 input 支持數組）
+EMBED_BATCHING_ENABLED = os.getenv("EMBED_BATCHING_ENABLED", "false").lower() in ("1", "true", "yes")
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", "64"))  # 每批最多的 input 條數
+EMBED_BATCH_MAX_DELAY = float(os.getenv("EMBED_BATCH_MAX_DELAY_MS", "5")) / 1000  # 第一個請求最多等待的時間
+
+
+# 轉發給節點的憑據頭：憑據不同的請求不能合並（否則整批都使用第一個請求的憑據）
+CREDENTIAL_HEADERS = ("authorization", "proxy-authorization", "cookie", "x-api-key")
+
+
+def request_credentials(headers: Dict[str, str]) -> List[Tuple[str, str]]:
+    """請求中會被轉發的憑據頭（headers 的 key 為小寫）"""
+    return [(name, headers[name]) for name in CREDENTIAL_HEADERS if name in headers]
+
+
+class EmbedBatcher:
+    """收集時間窗口內的嵌入請求，合並發送後按順序把向量分發回各個調用者"""
+    
+    def __init__(self):
+        # 批次 key -> {"body": 除 input 外的請求字段, "items": [(inputs, future)], "size": int, "timer": TimerHandle}
+        self._pending: Dict[str, Dict] = {}
+    
+    async def submit(self, payload: Dict, headers: Dict[str, str], params: Dict,
+                     model_name: Optional[str], model_size_b: Optional[int], full_model_name: Optional[str]) -> Response:
+        inputs = payload["input"]
+        inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+        shared = {k: v for k, v in payload.items() if k != "input"}
+        # 只合並請求體（除 input 外）、憑據和查詢參數都相同的請求，整批使用同一組 headers 和 params 轉發
+        key = json.dumps([shared, request_credentials(headers), sorted(params.items())],
+                         sort_keys=True, separators=(",", ":"))
+        
+        future = asyncio.get_running_loop().create_future()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = {
+                "body": shared, "items": [], "size": 0, "headers": headers, "params": params,
+                "route": (model_name, model_size_b, full_model_name),
+            }
+            batch["timer"] = asyncio.get_running_loop().call_later(EMBED_BATCH_MAX_DELAY, self._flush, key)
+        batch["items"].append((inputs, future))
+        batch["size"] += len(inputs)
+        if batch["size"] >= EMBED_BATCH_MAX_SIZE:
+            batch["timer"].cancel()
+            self._flush(key)
+        return await future
+    
+    def _flush(self, key: str):
+        batch = self._pending.pop(key, None)
+        if batch:
+            asyncio.create_task(self._send(batch))
+    
+    async def _send(self, batch: Dict):
+        items = batch["items"]
+        try:
+            response, content = await self._forward(batch)
+            if len(items) == 1 or response.status_code != 200:
+                # 單個請求或上游出錯：原樣返回給所有調用者
+                results = [self._raw_response(response, content)] * len(items)
+            else:
+                results = self._scatter(items, json.loads(content))
+        except Exception as e:
+            if not isinstance(e, HTTPException):
+                e = HTTPException(status_code=502, detail=f"Error proxying embedding batch: {e}")
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        embed_batch_requests.observe(len(items))
+        for (_, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+    
+    async def _forward(self, batch: Dict) -> Tuple[httpx.Response, bytes]:
+        """選擇節點發送合並後的請求；收到響應前的連接錯誤換節點重試"""
+        model_name, model_size_b, full_model_name = batch["route"]
+        body = dict(batch["body"])
+        body["input"] = [text for inputs, _ in batch["items"] for text in inputs]
+        body_bytes = json.dumps(body).encode()
+        
+        failed_nodes: Set[str] = set()
+        while True:
+            node = await acquire_node(model_name, model_size_b, full_model_name, exclude=failed_nodes)
+            if not node:
+                raise HTTPException(status_code=503, detail="No healthy nodes available")
+            try:
+                return await fetch_from_node(node, "POST", "/api/embed", batch["headers"], body_bytes,
+                                             batch["params"], full_model_name)
+            except RETRYABLE_ERRORS:
+                failed_nodes.add(node["name"])
+                if len(failed_nodes) > PROXY_MAX_RETRIES:
+                    raise
+                proxy_retries.labels(node=node["name"]).inc()
+    
+    @staticmethod
+    def _raw_response(response: httpx.Response, content: bytes) -> Response:
+        return Response(
+            content=content,
+            status_code=response.status_code,
+            headers=filter_response_headers(response),
+            media_type=response.headers.get("content-type", "application/json"),
+        )
+    
+    @staticmethod
+    def _scatter(items: List[Tuple[List[str], asyncio.Future]], data: Dict) -> List[Response]:
+        """按請求順序切分 embeddings；耗時字段是整批的值，prompt_eval_count 無法按請求拆分，因此不返回。
+        向量數與 input 總數不一致時無法確定對應關係，整批返回 502"""
+        embeddings = data.get("embeddings") or []
+        expected = sum(len(inputs) for inputs, _ in items)
+        if len(embeddings) != expected:
+            raise HTTPException(status_code=502,
+                                detail=f"Upstream returned {len(embeddings)} embeddings for {expected} inputs")
+        shared = {k: v for k, v in data.items() if k in ("model", "total_duration", "load_duration")}
+        results = []
+        offset = 0
+        for inputs, _ in items:
+            part = dict(shared, embeddings=embeddings[offset:offset + len(inputs)])
+            offset += len(inputs)
+            results.append(JSONResponse(part))
+        return results
+
+
+embed_batcher = EmbedBatcher()
+
+
+def parse_embed_batch_payload(method: str, path: str, body_stream, body_bytes: bytes) -> Optional[Dict]:
+    """可以批處理的 /api/embed 請求返回解析後的請求體，否則返回 None"""
+    if not EMBED_BATCHING_ENABLED or method != "POST" or path != "/api/embed":
+        return None
+    payload = parse_model_payload(body_stream, body_bytes)
+    if payload is None:
+        return None
+    inputs = payload.get("input")
+    if isinstance(inputs, str) or (isinstance(inputs, list) and inputs and all(isinstance(t, str) for t in inputs)):
+        return payload
+    return None
+
+
+# 確定性響應緩存（可選）：temperature=0 且指定 seed 的 generate/chat 請求，相同輸入總是得到相同輸出
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_PATHS = ("/api/generate", "/api/chat")
+RESPONSE_CACHE_MEMORY_MB = float(os.getenv("RESPONSE_CACHE_MEMORY_MB", "64"))  # 內存層上限
+RESPONSE_CACHE_DISK_MB = float(os.getenv("RESPONSE_CACHE_DISK_MB", "1024"))  # 磁盤層上限（0 = 不使用磁盤）
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", os.path.join(PROJECT_ROOT, "data", "response_cache"))
+RESPONSE_CACHE_MAX_ENTRY_MB = float(os.getenv("RESPONSE_CACHE_MAX_ENTRY_MB", "8"))  # 超過此大小的響應不緩存
+# 不影響輸出的字段，不參與緩存 key
+CACHE_KEY_IGNORED_FIELDS = ("stream", "keep_alive")
+
+
+def parse_model_payload(body_stream, body_bytes: bytes) -> Optional[Dict]:
+    """解析已完整讀取的 JSON 請求體（必須帶 model 字段），否則返回 None"""
+    if body_stream is not None or not body_bytes:
+        return None
+    try:
+        payload = json.loads(body_bytes)
+    except ValueError:
+        return None
+    if not isinstance(payload, dict) or not isinstance(payload.get("model"), str):
+        return None
+    return payload
+
+
+def is_deterministic_payload(payload: Dict) -> bool:
+    """options.temperature 為 0 且 options.seed 為整數時，相同輸入總是得到相同輸出"""
+    options = payload.get("options")
+    if not isinstance(options, dict):
+        return False
+    temperature, seed = options.get("temperature"), options.get("seed")
+    if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or temperature != 0:
+        return False
+    return isinstance(seed, int) and not isinstance(seed, bool)
+
+
+def deterministic_cache_payload(method: str, path: str, body_stream, body_bytes: bytes) -> Optional[Dict]:
+    """請求可以使用響應緩存時返回解析後的請求體"""
+    if not RESPONSE_CACHE_ENABLED or method != "POST" or path not in RESPONSE_CACHE_PATHS:
+        return None
+    payload = parse_model_payload(body_stream, body_bytes)
+    return payload if payload is not None and is_deterministic_payload(payload) else None
+
+
+def response_cache_key(path: str, digest: str, payload: Dict) -> str:
+    """(端點, 模型 digest, 規範化的請求體) 的 SHA-256"""
+    canonical = {k: v for k, v in payload.items() if k not in CACHE_KEY_IGNORED_FIELDS}
+    data = json.dumps([path, digest, canonical], sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def node_model_digest(node_name: str, full_model_name: str) -> Optional[str]:
+    """節點上該模型的 digest（來自最近一次 /api/tags）"""
+    model = normalize_model_tag(full_model_name)
+    for model_info in node_tags.get(node_name, ()):
+        if normalize_model_tag(model_info.get("name", "")) == model:
+            return model_info.get("digest") or None
+    return None
+
+
+def current_model_digests(full_model_name: str) -> List[str]:
+    """健康節點上該模型的所有 digest（通常只有一個）；只有這些 digest 的緩存條目會被使用"""
+    digests: List[str] = []
+    for node in get_routing_index().healthy_nodes:
+        digest = node_model_digest(node["name"], full_model_name)
+        if digest and digest not in digests:
+            digests.append(digest)
+    return digests
+
+
+def digest_file_prefix(digest: str) -> str:
+    return digest.rpartition(":")[2][:16]
+
+
+class ResponseCache:
+    """兩層 LRU：內存層保存最近使用的條目，磁盤層按總大小淘汰最久未使用的文件
+    
+    條目是 NDJSON 行的列表（非流式響應只有一行），文件名為 {digest 前綴}-{key}.ndjson，
+    模型 digest 變化時按前綴刪除。
+    """
+    
+    def __init__(self, memory_bytes: int, disk_bytes: int, directory: str):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        self.memory: "OrderedDict[str, Tuple[str, List[bytes], int]]" = OrderedDict()  # key -> (digest, 行, 大小)
+        self.memory_size = 0
+        self.disk: "OrderedDict[str, int]" = OrderedDict()  # 文件名 -> 大小
+        self.disk_size = 0
+        self.disk_loaded = False
+    
+    def _file_name(self, key: str, digest: str) -> str:
+        return f"{digest_file_prefix(digest)}-{key}.ndjson"
+    
+    def _remember(self, key: str, digest: str, lines: List[bytes]):
+        size = sum(len(line) for line in lines)
+        old = self.memory.pop(key, None)
+        if old:
+            self.memory_size -= old[2]
+        self.memory[key] = (digest, lines, size)
+        self.memory_size += size
+        while self.memory_size > self.memory_bytes and self.memory:
+            _, (_, _, evicted_size) = self.memory.popitem(last=False)
+            self.memory_size -= evicted_size
+    
+    def _load_disk_index(self):
+        """首次使用磁盤層時按修改時間加載已有文件（在線程池中執行）"""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = sorted(
+            (entry.stat().st_mtime, entry.name, entry.stat().st_size)
+            for entry in os.scandir(self.directory) if entry.name.endswith(".ndjson")
+        )
+        for _, name, size in entries:
+            self.disk[name] = size
+            self.disk_size += size
+        self.disk_loaded = True
+    
+    def _read_file(self, name: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+    
+    def _write_file(self, name: str, data: bytes):
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+    
+    def _remove_files(self, names: List[str]):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+    
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+    
+    async def get(self, key: str, digest: str) -> Optional[Tuple[List[bytes], str]]:
+        """返回 (NDJSON 行, 命中的層級)，未命中返回 None"""
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            return entry[1], "memory"
+        if self.disk_bytes <= 0:
+            return None
+        if not self.disk_loaded:
+            await self._run(self._load_disk_index)
+        name = self._file_name(key, digest)
+        if name not in self.disk:
+            return None
+        data = await self._run(self._read_file, name)
+        if data is None:
+            self.disk_size -= self.disk.pop(name, 0)
+            return None
+        self.disk.move_to_end(name)
+        lines = data.split(b"\n")
+        self._remember(key, digest, lines)
+        return lines, "disk"
+    
+    async def put(self, key: str, digest: str, lines: List[bytes]):
+        self._remember(key, digest, lines)
+        if self.disk_bytes <= 0:
+            return
+        try:
+            if not self.disk_loaded:
+                await self._run(self._load_disk_index)
+            name = self._file_name(key, digest)
+            data = b"\n".join(lines)
+            await self._run(self._write_file, name, data)
+            self.disk_size += len(data) - self.disk.pop(name, 0)
+            self.disk[name] = len(data)
+            evicted = []
+            while self.disk_size > self.disk_bytes and self.disk:
+                evicted_name, evicted_size = self.disk.popitem(last=False)
+                self.disk_size -= evicted_size
+                evicted.append(evicted_name)
+            if evicted:
+                await self._run(self._remove_files, evicted)
+        except OSError as e:
+            proxy_log.warning("⚠️  Failed to write response cache entry: %s", e)
+    
+    def purge_digest(self, digest: str):
+        """模型 digest 已不在任何節點上：刪除該 digest 的所有條目"""
+        for key in [k for k, (d, _, _) in self.memory.items() if d == digest]:
+            self.memory_size -= self.memory.pop(key)[2]
+        prefix = digest_file_prefix(digest) + "-"
+        stale = [name for name in self.disk if name.startswith(prefix)]
+        for name in stale:
+            self.disk_size -= self.disk.pop(name)
+        if stale:
+            asyncio.get_running_loop().run_in_executor(None, self._remove_files, stale)
+        response_cache_purges.inc()
+
+
+response_cache = ResponseCache(
+    int(RESPONSE_CACHE_MEMORY_MB * 1024 * 1024),
+    int(RESPONSE_CACHE_DISK_MB * 1024 * 1024),
+    RESPONSE_CACHE_DIR,
+)
+
+
+def purge_stale_digests(old_models: Optional[List[Dict]], new_models: List[Dict]):
+    """節點的模型 digest 變化後，刪除已不在任何節點上的舊 digest 的緩存條目"""
+    if not RESPONSE_CACHE_ENABLED or not old_models:
+        return
+    removed = {m.get("digest") for m in old_models} - {m.get("digest") for m in new_models}
+    removed.discard(None)
+    if not removed:
+        return
+    live = {m.get("digest") for models in node_tags.values() for m in models}
+    for digest in removed - live:
+        response_cache.purge_digest(digest)
+
+
+def merge_stream_lines(lines: List[bytes]) -> bytes:
+    """把流式響應的 NDJSON 行合並為非流式響應（拼接 response / message 內容，保留最後 done 塊的統計）"""
+    if len(lines) == 1:
+        return lines[0]
+    chunks = [json.loads(line) for line in lines if line.strip()]
+    final = dict(chunks[-1])
+    if any("message" in chunk for chunk in chunks):
+        message = dict(final.get("message") or {})
+        for field in ("content", "thinking"):
+            parts = [c.get("message", {}).get(field) or "" for c in chunks]
+            if any(parts) or field in message:
+                message[field] = "".join(parts)
+        tool_calls = [call for c in chunks for call in (c.get("message", {}).get("tool_calls") or [])]
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        final["message"] = message
+    else:
+        for field in ("response", "thinking"):
+            parts = [c.get(field) or "" for c in chunks]
+            if any(parts) or field in final:
+                final[field] = "".join(parts)
+    return json.dumps(final, ensure_ascii=False).encode()
+
+
+def replay_cached_response(lines: List[bytes], stream: bool) -> Response:
+    """按客戶端請求的形式（流式 / 非流式）返回緩存的響應"""
+    headers = {"X-Gateway-Cache": "hit"}
+    if not stream:
+        return Response(content=merge_stream_lines(lines), media_type="application/json", headers=headers)
+    
+    async def replay():
+        for line in lines:
+            yield line + b"\n"
+    
+    return StreamingResponse(replay(), media_type="application/x-ndjson", headers=headers)
+
+
+def cacheable_lines(content: bytes) -> Optional[List[bytes]]:
+    """完成的響應（最後一行是 done 塊）拆分為 NDJSON 行；不完整或過大的響應返回 None"""
+    if len(content) > RESPONSE_CACHE_MAX_ENTRY_MB * 1024 * 1024:
+        return None
+    lines = [line for line in content.split(b"\n") if line.strip()]
+    if not lines or parse_done_stats(lines[-1]).get("done") is not True:
+        return None
+    return lines
+
+
+def store_cached_response(path: str, payload: Dict, node_name: str, full_model_name: str, content: bytes):
+    """後台寫入緩存（使用實際處理請求的節點上的模型 digest）"""
+    digest = node_model_digest(node_name, full_model_name)
+    lines = cacheable_lines(content)
+    if digest and lines:
+        asyncio.create_task(response_cache.put(response_cache_key(path, digest, payload), digest, lines))
+
+
+# 相同請求去重（可選）：冪等請求（/api/show、/api/embed、確定性 generate/chat）正在處理時，
+# 後到的相同請求直接訂閱同一個上游響應，完成後立即從表中移除，不做任何緩存
+REQUEST_DEDUP_ENABLED = os.getenv("REQUEST_DEDUP_ENABLED", "false").lower() in ("1", "true", "yes")
+DEDUP_IDEMPOTENT_PATHS = ("/api/show", "/api/embed", "/api/embeddings")
+
+
+def request_dedup_key(method: str, path: str, headers: Dict[str, str], params: Dict,
+                      body_stream, body_bytes: bytes) -> Optional[str]:
+    """可以去重的請求返回規範化的請求哈希，否則返回 None"""
+    if not REQUEST_DEDUP_ENABLED or method != "POST":
+        return None
+    if path not in DEDUP_IDEMPOTENT_PATHS and path not in RESPONSE_CACHE_PATHS:
+        return None
+    payload = parse_model_payload(body_stream, body_bytes)
+    if payload is None or (path in RESPONSE_CACHE_PATHS and not is_deterministic_payload(payload)):
+        return None
+    canonical = {k: v for k, v in payload.items() if k != "keep_alive"}
+    data = json.dumps([path, request_credentials(headers), sorted(params.items()), canonical],
+                      sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class SharedResponse:
+    """一次上游響應，由多個訂閱者共享：流式響應的每個數據塊按順序分發給所有訂閱者"""
+    
+    def __init__(self):
+        self.ready = asyncio.Event()  # 狀態碼和響應頭已就緒
+        self.changed = asyncio.Event()  # 有新數據塊或已結束
+        self.status_code = 200
+        self.headers: Dict[str, str] = {}
+        self.streaming = False
+        self.chunks: List[bytes] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.on_abandon = None  # 上游請求被取消時從進行中請求表移除本條目
+    
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+    
+    async def run(self, forward):
+        response = None
+        try:
+            response = await forward()
+            self.status_code = response.status_code
+            self.headers = dict(response.headers)
+            self.streaming = isinstance(response, StreamingResponse)
+            self.ready.set()
+            if self.streaming:
+                async for chunk in response.body_iterator:
+                    self.chunks.append(chunk if isinstance(chunk, bytes) else chunk.encode())
+                    self._notify()
+            else:
+                self.chunks.append(response.body)
+        except asyncio.CancelledError:
+            # CancelledError 不是 Exception：記錄錯誤，取消前已訂閱的請求不會得到被截斷但狀態為 200 的響應
+            self.error = HTTPException(status_code=502, detail="Upstream request was cancelled")
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.streaming and response is not None:
+                await response.body_iterator.aclose()
+            if isinstance(response, UpstreamStreamingResponse):
+                # 響應體可能從未開始迭代（aclose 不會執行生成器的 finally），確保釋放節點槽位
+                await response.on_close()
+            self.done = True
+            self.ready.set()
+            self._notify()
+    
+    async def iterate(self, handoff) -> AsyncIterator[bytes]:
+        # 響應體開始迭代時才計入訂閱，並釋放 subscribe() 交接時保留的訂閱
+        self.subscribers += 1
+        handoff()
+        index = 0
+        try:
+            while True:
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        # 中斷連接，讓客戶端知道響應不完整
+                        raise self.error
+                    return
+                await self.changed.wait()
+        finally:
+            self.unsubscribe()
+    
+    def unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.done and self.task:
+            # 所有客戶端都已斷開：取消上游請求，釋放節點；之後到達的相同請求重新發起上游請求
+            if self.on_abandon:
+                self.on_abandon()
+            self.task.cancel()
+    
+    def _handoff(self):
+        """返回只生效一次的釋放函數：流式響應交給 Starlette 後，由 iterate() 開始時
+        或響應結束時（響應體從未迭代，例如客戶端提前斷開）釋放 subscribe() 中的訂閱"""
+        released = False
+        
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.unsubscribe()
+        return release
+    
+    async def subscribe(self) -> Response:
+        self.subscribers += 1
+        try:
+            await self.ready.wait()
+            if self.error is not None:
+                raise self.error
+            if self.streaming:
+                handoff = self._handoff()
+                
+                async def on_close():
+                    handoff()
+                return UpstreamStreamingResponse(self.iterate(handoff), on_close=on_close,
+                                                 status_code=self.status_code, headers=self.headers)
+            while not self.done:
+                await self.changed.wait()
+            if self.error is not None:
+                raise self.error
+        except BaseException:
+            self.unsubscribe()
+            raise
+        self.unsubscribe()
+        return Response(content=b"".join(self.chunks), status_code=self.status_code, headers=self.headers)
+
+
+class RequestFlights:
+    """進行中請求表：請求哈希 -> SharedResponse"""
+    
+    def __init__(self):
+        self._flights: Dict[str, SharedResponse] = {}
+    
+    def _remove(self, key: str, flight: SharedResponse):
+        # 同一個 key 可能已經有新的請求，只移除自己
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+    
+    async def attach(self, key: str, route: str, forward) -> Response:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = SharedResponse()
+            flight.on_abandon = lambda: self._remove(key, flight)
+            flight.task = asyncio.create_task(flight.run(forward))
+            flight.task.add_done_callback(lambda _: self._remove(key, flight))
+        else:
+            collapsed_requests.labels(endpoint=route).inc()
+        return await flight.subscribe()
 
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    """關閉時清理資源"""
-    await client.aclose()
+request_flights = RequestFlights()
 
 
 async def proxy_request(request: Request, path: str):
@@ -696,11 +3418,13 @@ async def proxy_request(request: Request, path: str):
             }
         )
     
-    # 先讀取請求體（用於提取模型信息）
+    # 讀取請求體（用於提取模型信息）；只有 /api/blobs 上傳以流的方式轉發，不在網關中緩存
     body_bytes = b""
-    if request.method == "POST":
+    body_stream = None
+    routing_fields: Dict = {}
+    if request.method in BODY_METHODS:
         try:
-            body_bytes = await request.body()
+            body_bytes, body_stream = await read_request_body(request, path)
         except Exception:
             pass
     
@@ -721,187 +3445,245 @@ async def proxy_request(request: Request, path: str):
     if full_model_name:
         model_name = full_model_name.split(":")[0] if ":" in full_model_name else full_model_name
     
-    # 如果沒有，從請求體獲取
-    if not model_name and body_bytes:
-        model_name, full_model_name = await extract_model_name_from_body(body_bytes)
+    # 如果沒有，從請求體獲取（增量掃描，不解析整個請求體）
+    if body_bytes:
+        routing_fields = scan_json_fields(body_bytes)
+    if not model_name and routing_fields:
+        model_name, full_model_name = split_model_name(routing_fields.get("model"))
     
     # 計算模型大小（傳入完整名稱以便從tag中提取參數數量）
     if model_name:
         model_size_b = get_model_size_b(model_name, full_model_name)
         display_name = full_model_name if full_model_name else model_name
-        print(f"📝 Request for model: {display_name} ({model_size_b}B)")
+        proxy_log.debug("📝 Request for model: %s (%sB)", display_name, model_size_b)
     else:
         # 沒有模型名稱的請求（如 /api/tags, /api/version 等）
-        print(f"📝 Request without model: {path}")
+        proxy_log.debug("📝 Request without model: %s", path)
     
-    # 選擇節點（基於模型信息）
-    # 如果沒有模型名稱，select_node 會返回所有健康節點
-    node = select_node(model_name, model_size_b)
-    if not node:
-        raise HTTPException(status_code=503, detail="No healthy nodes available")
+    method = request.method
+    route = normalize_route(path)
     
-    node_name = node["name"]
-    node_url = get_node_url(node)
-    target_url = f"{node_url}{path}"
+    # 記錄模型需求（預熱控制器使用）
+    if full_model_name and path in WARMUP_DEMAND_PATHS:
+        record_model_demand(model_name, full_model_name, model_size_b)
     
-    # 打印轉發信息
-    display_name = full_model_name if full_model_name else model_name
-    if display_name:
-        print(f"→ Forwarding request to {node_name} ({node_url}) for model: {display_name}")
+    # 準備請求
+    headers = dict(request.headers)
+    # 移除可能導致問題的headers
+    headers.pop("host", None)
+    content_length = headers.pop("content-length", None)
+    headers.pop("connection", None)
+    headers.pop("keep-alive", None)
+    headers.pop("transfer-encoding", None)
+    
+    # 請求體已完整讀取時直接發送；否則邊讀邊轉發（保留客戶端的 Content-Length，避免改為分塊傳輸）
+    if body_stream is not None:
+        body = body_stream
+        if content_length is not None:
+            headers["content-length"] = content_length
     else:
-        print(f"→ Forwarding request to {node_name} ({node_url}) for path: {path}")
+        body = body_bytes
     
-    # 更新連接數
-    node_stats[node_name]["active_connections"] += 1
-    active_connections.labels(node=node_name).set(node_stats[node_name]["active_connections"])
+    params = dict(request.query_params)
     
-    start_time = time.time()
-    status_code = 500
-    method = request.method  # 在try塊外定義，確保異常處理中可用
+    # 確定性請求（temperature=0 且指定 seed）先查響應緩存
+    cache_payload = deterministic_cache_payload(method, path, body_stream, body_bytes)
+    if cache_payload is not None:
+        for digest in current_model_digests(cache_payload["model"]):
+            cached = await response_cache.get(response_cache_key(path, digest, cache_payload), digest)
+            if cached:
+                lines, tier = cached
+                response_cache_requests.labels(result=f"{tier}_hit").inc()
+                return replay_cached_response(lines, cache_payload.get("stream", True) is not False)
+        response_cache_requests.labels(result="miss").inc()
     
-    try:
-        # 準備請求
-        headers = dict(request.headers)
-        # 移除可能導致問題的headers
-        headers.pop("host", None)
-        headers.pop("content-length", None)
-        headers.pop("connection", None)
-        headers.pop("keep-alive", None)
-        headers.pop("transfer-encoding", None)
-        
-        # 如果是外部節點，添加節點的 headers（包括 API key）
-        node_headers = get_node_headers(node)
-        headers.update(node_headers)
-        
-        # 使用之前讀取的body
-        body = body_bytes
+    # 相同的冪等請求正在處理中時，直接共享它的上游響應
+    flight_key = request_dedup_key(method, path, headers, params, body_stream, body_bytes)
+    
+    async def forward():
+        return await forward_request(method, path, headers, body, body_bytes, body_stream, params,
+                                     model_name, model_size_b, full_model_name, cache_payload)
+    
+    if flight_key is not None:
+        return await request_flights.attach(flight_key, route, forward)
+    return await forward()
+
+
+async def forward_request(method: str, path: str, headers: Dict[str, str], body, body_bytes: bytes, body_stream,
+                          params: Dict, model_name: Optional[str], model_size_b: Optional[int],
+                          full_model_name: Optional[str], cache_payload: Optional[Dict]) -> Response:
+    """選擇節點轉發請求並返回響應（流式響應邊收邊發）"""
+    # 指標標簽（有界）：路由模板和模型
+    route, model_label = normalize_route(path), metric_model_label(full_model_name or model_name)
+    
+    # 並發的嵌入請求合並為批次發送
+    embed_payload = parse_embed_batch_payload(method, path, body_stream, body_bytes)
+    if embed_payload is not None:
+        return await embed_batcher.submit(embed_payload, headers, params, model_name, model_size_b, full_model_name)
+    
+    # 短小的冪等請求（embedding、show）可以對沖：首個節點響應過慢時向第二個節點發送副本
+    if is_hedge_eligible(method, path, body_stream):
+        return await hedged_proxy_request(method, path, headers, body, params, model_name, model_size_b, full_model_name)
+    
+    # 同一對話的後續輪次優先發送到持有其 KV 緩存的節點
+    affinity_key = prefix_affinity_key(path, body_bytes, full_model_name)
+    
+    # 選擇節點並發送；在收到任何響應字節之前的連接錯誤會換一個節點重試
+    failed_nodes: Set[str] = set()
+    retries = 0
+    retry_deadline = time.time() + PROXY_RETRY_BUDGET_SECONDS
+    while True:
+        # 選擇節點（基於模型信息）並佔用一個並發槽位；所有節點都滿時在隊列中等待
+        # 如果沒有模型名稱，select_node 會返回所有健康節點
+        node = await acquire_node(model_name, model_size_b, full_model_name, exclude=failed_nodes,
+                                  affinity_key=affinity_key)
+        if not node:
+            if failed_nodes:
+                raise HTTPException(status_code=502, detail=f"All candidate nodes failed: {sorted(failed_nodes)}")
+            raise HTTPException(status_code=503, detail="No healthy nodes available")
         
-        # 轉發請求
-        params = dict(request.query_params)
+        node_name = node["name"]
+        node_url = get_node_url(node)
+        target_url = f"{node_url}{path}"
         
-        # 設置超時（外部節點可能有不同的超時設置）
-        timeout_seconds = node.get("timeout_seconds", 300.0) if node.get("type") == "external" else 300.0
-        timeout = httpx.Timeout(timeout_seconds, connect=10.0)
+        # 打印轉發信息
+        display_name = full_model_name if full_model_name else model_name
+        if display_name:
+            proxy_log.info("→ Forwarding request to %s (%s) for model: %s", node_name, node_url, display_name)
+        else:
+            proxy_log.info("→ Forwarding request to %s (%s) for path: %s", node_name, node_url, path)
         
+        start_time = time.time()
         try:
-            # 為外部節點創建新的客戶端（使用自定義超時），本地節點使用全局客戶端
-            if node.get("type") == "external":
-                async with httpx.AsyncClient(timeout=timeout, follow_redirects=True) as external_client:
-                    response = await external_client.request(
-                        method=method,
-                        url=target_url,
-                        headers=headers,
-                        content=body,
-                        params=params,
-                    )
-            else:
-                response = await client.request(
-                    method=method,
-                    url=target_url,
-                    headers=headers,
-                    content=body,
-                    params=params,
-                )
-        except httpx.RequestError as e:
-            print(f"❌ Request error to {node_name} ({target_url}): {e}")
-            raise
-        
-        status_code = response.status_code
-        node_stats[node_name]["total_requests"] += 1
-        
-        # 更新metrics
-        request_count.labels(
-            method=method,
-            endpoint=path,
-            node=node_name,
-            status=status_code
-        ).inc()
-        
-        duration = time.time() - start_time
-        request_duration.labels(
-            method=method,
-            endpoint=path,
-            node=node_name
-        ).observe(duration)
-        
-        # 過濾響應頭，移除不應該傳遞的headers
-        response_headers = {}
-        skip_headers = {
-            "content-length", "transfer-encoding", "connection", 
-            "keep-alive", "proxy-authenticate", "proxy-authorization",
-            "te", "trailer", "upgrade"
-        }
-        for key, value in response.headers.items():
-            if key.lower() not in skip_headers:
-                response_headers[key] = value
-        
-        # 如果是流式響應
-        if "text/event-stream" in response.headers.get("content-type", ""):
-            async def generate():
-                try:
-                    async for chunk in response.aiter_bytes():
-                        yield chunk
-                finally:
-                    node_stats[node_name]["active_connections"] -= 1
-                    active_connections.labels(node=node_name).set(node_stats[node_name]["active_connections"])
-            
-            return StreamingResponse(
-                generate(),
-                status_code=status_code,
-                headers=response_headers,
-                media_type=response.headers.get("content-type", "text/event-stream")
-            )
-        else:
-            # 普通響應
-            content = await response.aread()
-            node_stats[node_name]["active_connections"] -= 1
-            active_connections.labels(node=node_name).set(node_stats[node_name]["active_connections"])
-            
-            # 確保 content-type 正確設置
-            content_type = response.headers.get("content-type", "application/json")
+            response = await send_upstream(node, method, target_url, headers, body, params)
+            break
+        except RETRYABLE_ERRORS as e:
+            node_stats[node_name]["failed_requests"] += 1
+            release_node_connection(node_name, full_model_name)
+            request_count.labels(method=method, endpoint=route, node=node_name, model=model_label, status="error").inc()
+            proxy_log.error("❌ Request error to %s (%s): %r", node_name, target_url, e)
+            record_passive_failure(node_name)
+            failed_nodes.add(node_name)
             
-            return Response(
-                content=content,
-                status_code=status_code,
-                headers=response_headers,
-                media_type=content_type
+            # 流式上傳的請求體已被部分消費，無法重發；有副作用的請求可能已被節點執行，不能重放
+            if (body_stream is None and is_retry_safe(path, e)
+                    and retries < PROXY_MAX_RETRIES and time.time() < retry_deadline):
+                retries += 1
+                proxy_retries.labels(node=node_name).inc()
+                proxy_log.warning("↻ Retrying on another node (attempt %d/%d), excluding %s",
+                                  retries, PROXY_MAX_RETRIES, sorted(failed_nodes))
+                continue
+            raise HTTPException(status_code=502, detail=f"Error proxying to {node_name}: {str(e)}")
+        except httpx.TimeoutException:
+            node_stats[node_name]["failed_requests"] += 1
+            release_node_connection(node_name, full_model_name)
+            request_count.labels(method=method, endpoint=route, node=node_name, model=model_label, status="timeout").inc()
+            raise HTTPException(status_code=504, detail=f"Request to {node_name} timed out")
+        except Exception as e:
+            node_stats[node_name]["failed_requests"] += 1
+            release_node_connection(node_name, full_model_name)
+            request_count.labels(method=method, endpoint=route, node=node_name, model=model_label, status="error").inc()
+            proxy_log.exception("❌ Error proxying to %s (%s): %s %s", node_name, target_url, method, path)
+            raise HTTPException(
+                status_code=502, 
+                detail=f"Error proxying to {node_name}: {str(e)}"
             )
     
-    except httpx.TimeoutException:
-        node_stats[node_name]["failed_requests"] += 1
-        node_stats[node_name]["active_connections"] -= 1
-        active_connections.labels(node=node_name).set(node_stats[node_name]["active_connections"])
+    record_passive_success(node_name)
+    status_code = response.status_code
+    node_stats[node_name]["total_requests"] += 1
+    
+    # 更新metrics
+    request_count.labels(
+        method=method,
+        endpoint=route,
+        node=node_name,
+        model=model_label,
+        status=status_code
+    ).inc()
+    
+    duration = time.time() - start_time
+    request_duration.labels(
+        method=method,
+        endpoint=route,
+        node=node_name,
+        model=model_label
+    ).observe(duration)
+    
+    response_headers = filter_response_headers(response)
+    content_type = response.headers.get("content-type", "application/json")
+    
+    # 如果是流式響應（Ollama 的 /api/generate、/api/chat 使用 application/x-ndjson）
+    if is_streaming_content_type(content_type):
+        closed = False
         
-        request_count.labels(
-            method=method,
-            endpoint=path,
-            node=node_name,
-            status="timeout"
-        ).inc()
+        async def close_upstream():
+            nonlocal closed
+            if closed:
+                return
+            closed = True
+            await response.aclose()
+            release_node_connection(node_name, full_model_name)
+        
+        async def generate():
+            first_byte_seconds = None
+            done_tap = DoneLineTap()
+            # 可緩存的請求保留完整響應（超過上限則放棄緩存）
+            captured: Optional[List[bytes]] = [] if cache_payload is not None and status_code == 200 else None
+            captured_size = 0
+            try:
+                # aiter_raw 不做解碼和重新分塊，上游每寫出一行就立即轉發給客戶端
+                async for chunk in response.aiter_raw():
+                    if first_byte_seconds is None:
+                        first_byte_seconds = time.time() - start_time
+                    done_tap.feed(chunk)
+                    if captured is not None:
+                        captured.append(chunk)
+                        captured_size += len(chunk)
+                        if captured_size > RESPONSE_CACHE_MAX_ENTRY_MB * 1024 * 1024:
+                            captured = None
+                    yield chunk
+                if status_code < 400 and first_byte_seconds is not None:
+                    record_request_performance(node_name, full_model_name, first_byte_seconds,
+                                               time.time() - start_time, done_tap.last_line(), streamed=True,
+                                               affinity_key=affinity_key)
+                if captured is not None:
+                    store_cached_response(path, cache_payload, node_name, cache_payload["model"], b"".join(captured))
+            finally:
+                await close_upstream()
         
-        raise HTTPException(status_code=504, detail=f"Request to {node_name} timed out")
+        return UpstreamStreamingResponse(
+            generate(),
+            on_close=close_upstream,
+            status_code=status_code,
+            headers=response_headers,
+            media_type=content_type
+        )
     
+    # 普通響應
+    try:
+        content = b"".join([chunk async for chunk in response.aiter_raw()])
     except Exception as e:
         node_stats[node_name]["failed_requests"] += 1
-        node_stats[node_name]["active_connections"] -= 1
-        active_connections.labels(node=node_name).set(node_stats[node_name]["active_connections"])
-        
-        request_count.labels(
-            method=method,
-            endpoint=path,
-            node=node_name,
-            status="error"
-        ).inc()
-        
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"❌ Error proxying to {node_name} ({target_url}): {e}")
-        print(f"   Path: {path}, Method: {method}")
-        print(f"   Error details: {error_details}")
-        raise HTTPException(
-            status_code=502, 
-            detail=f"Error proxying to {node_name}: {str(e)}"
-        )
+        proxy_log.error("❌ Error reading response from %s (%s): %s", node_name, target_url, e)
+        raise HTTPException(status_code=502, detail=f"Error proxying to {node_name}: {str(e)}")
+    finally:
+        await response.aclose()
+        release_node_connection(node_name, full_model_name)
+    
+    if status_code < 400:
+        total_seconds = time.time() - start_time
+        record_request_performance(node_name, full_model_name, total_seconds, total_seconds, content, streamed=False,
+                                   affinity_key=affinity_key)
+    if cache_payload is not None and status_code == 200:
+        store_cached_response(path, cache_payload, node_name, cache_payload["model"], content)
+    
+    return Response(
+        content=content,
+        status_code=status_code,
+        headers=response_headers,
+        media_type=content_type
+    )
 
 
 # 根路徑顯示儀表板（包含運行中的進程）（必須在通配符路由之前）
@@ -1315,7 +4097,7 @@ async def health():
         "nodes": {
             node["name"]: {
                 "healthy": node_stats[node["name"]]["is_healthy"],
-                "active_connections": node_stats[node["name"]]["active_connections"],
+                "active_connections": node_active_connections(node["name"]),
                 "total_requests": node_stats[node["name"]]["total_requests"],
                 "failed_requests": node_stats[node["name"]]["failed_requests"],
             }
@@ -1324,6 +4106,25 @@ async def health():
     }
 
 
+# 就緒檢查端點（供負載均衡器 / PM2 等判斷網關是否已完成首輪節點探測）
+@app.get("/ready")
+async def ready():
+    """網關就緒檢查：首輪節點探測完成後返回 200，之前返回 503"""
+    enabled_nodes = [node for node in NODES if node.get("enabled", True)]
+    pending_nodes = [
+        node["name"] for node in enabled_nodes
+        if node_stats.get(node["name"], {}).get("last_health_check") is None
+    ]
+    healthy_nodes = [node["name"] for node in enabled_nodes if node_stats[node["name"]]["is_healthy"]]
+    content = {
+        "ready": gateway_ready,
+        "healthy_nodes": healthy_nodes,
+        "pending_nodes": pending_nodes,
+        "total_nodes": len(enabled_nodes),
+    }
+    return JSONResponse(content=content, status_code=200 if gateway_ready else 503)
+
+
 # 節點狀態端點（JSON API）
 @app.get("/api/nodes")
 async def get_nodes_api():
@@ -1357,6 +4158,8 @@ async def get_nodes_api():
                 "current_weight": node.get("weight", 1.0),
                 "effective_weight": node.get("weight", 1.0),
                 "last_model_sync": None,
+                "consecutive_failures": 0,
+                "next_health_check": None,
             }
         if node["name"] not in node_models:
             node_models[node["name"]] = set()
@@ -1809,48 +4612,43 @@ async def get_node_ps(node: Dict) -> Optional[Dict]:
         try:
             base_url = get_node_url(node)
             url = f"{base_url}/api/ps"
-            headers = get_node_headers(node)
-            
             timeout_seconds = node.get("timeout_seconds", 5.0)
             timeout = httpx.Timeout(timeout_seconds, connect=10.0)
             
-            print(f"Fetching /api/ps from external node {node['name']}: {url}")
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                response = await client.get(url, headers=headers)
-                if response.status_code == 200:
-                    data = response.json()
-                    print(f"Got /api/ps from {node['name']}: {len(data.get('processes', []))} processes")
-                    return data
-                elif response.status_code == 404:
-                    # 404 表示端點不存在，這是正常的（外部 API 可能不支持）
-                    print(f"⚠️  External node {node['name']} does not support /api/ps endpoint (404)")
-                    return None
-                else:
-                    print(f"⚠️  Failed to get /api/ps from {node['name']}: HTTP {response.status_code}")
-                    return None
+            health_log.debug("Fetching /api/ps from external node %s: %s", node["name"], url)
+            node_client = get_node_client(node)
+            response = await node_client.get(url, timeout=timeout)
+            if response.status_code == 200:
+                data = response.json()
+                health_log.debug("Got /api/ps from %s: %d models", node["name"], len(data.get("models") or []))
+                return data
+            elif response.status_code == 404:
+                # 404 表示端點不存在，這是正常的（外部 API 可能不支持）
+                health_log.debug("External node %s does not support /api/ps (404)", node["name"])
+                return None
+            else:
+                health_log.debug("Failed to get /api/ps from %s: HTTP %d", node["name"], response.status_code)
+                return None
         except Exception as e:
-            print(f"⚠️  External node {node['name']} /api/ps not available: {e}")
+            health_log.debug("External node %s /api/ps not available: %s", node["name"], e)
             return None
     
-    # 本地節點
+    # 本地節點（每 RESIDENCY_REFRESH_INTERVAL 秒調用一次，只輸出 DEBUG 日志；節點不可用由健康檢查報告）
     try:
         base_url = get_node_url(node)
         url = f"{base_url}/api/ps"
-        headers = get_node_headers(node)
-        
         timeout = httpx.Timeout(5.0, connect=10.0)
         
-        print(f"Fetching /api/ps from {node['name']}: {url}")
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.get(url, headers=headers)
-            if response.status_code == 200:
-                data = response.json()
-                print(f"Got /api/ps from {node['name']}: {len(data.get('processes', []))} processes")
-                return data
-            else:
-                print(f"Failed to get /api/ps from {node['name']}: HTTP {response.status_code}")
+        health_log.debug("Fetching /api/ps from %s: %s", node["name"], url)
+        node_client = get_node_client(node)
+        response = await node_client.get(url, timeout=timeout)
+        if response.status_code == 200:
+            data = response.json()
+            health_log.debug("Got /api/ps from %s: %d models", node["name"], len(data.get("models") or []))
+            return data
+        health_log.debug("Failed to get /api/ps from %s: HTTP %d", node["name"], response.status_code)
     except Exception as e:
-        print(f"Failed to get /api/ps from {node['name']}: {e}")
+        health_log.debug("Failed to get /api/ps from %s: %s", node["name"], e)
     return None
 
 
@@ -1869,6 +4667,355 @@ async def debug_config():
         "config_data_nodes_count": len(config_data.get("nodes", [])),
     }
 
+# /api/ps 共享快照：所有儀表板 / 拓撲頁面共用同一份數據，TTL 內不重覆請求節點
+PS_CACHE_TTL = float(os.getenv("PS_CACHE_TTL", "3"))  # 快照有效期（秒）
+ps_snapshot: Dict[str, Dict] = {}  # {node_name: {"ps": Optional[Dict], "fetched_at": float}}
+ps_snapshot_time = 0.0
+ps_refresh_flight = SingleFlight()
+
+
+async def refresh_ps_snapshot() -> Dict[str, Dict]:
+    """並發獲取所有啟用節點的 /api/ps 並更新快照"""
+    global ps_snapshot_time
+    nodes = [n for n in NODES if n.get("enabled", True)]
+    results = await asyncio.gather(*(get_node_ps(node) for node in nodes))
+    fetched_at = time.time()
+    for node, ps_data in zip(nodes, results):
+        ps_snapshot[node["name"]] = {"ps": ps_data, "fetched_at": fetched_at}
+        update_node_residency(node["name"], ps_data)
+    # 移除已刪除的節點
+    node_names = {n["name"] for n in NODES}
+    for node_name in list(ps_snapshot.keys()):
+        if node_name not in node_names:
+            del ps_snapshot[node_name]
+    ps_snapshot_time = fetched_at
+    return ps_snapshot
+
+
+async def get_ps_snapshot() -> Dict[str, Dict]:
+    """獲取 /api/ps 快照：未過期直接返回，否則刷新（並發的查看者共享同一次刷新）"""
+    if time.time() - ps_snapshot_time < PS_CACHE_TTL:
+        return ps_snapshot
+    return await ps_refresh_flight.do("ps", refresh_ps_snapshot)
+
+
+# 常駐模型跟蹤：定期刷新 /api/ps 快照（與儀表板共用），保持路由使用的常駐模型表最新
+RESIDENCY_REFRESH_INTERVAL = float(os.getenv("RESIDENCY_REFRESH_INTERVAL", "5"))
+
+
+async def periodic_residency_refresh():
+    """定期刷新各節點已加載的模型（集群模式下只刷新本網關負責探測的節點）"""
+    while True:
+        try:
+            if cluster_peers:
+                nodes = [n for n in NODES if n.get("enabled", True) and owns_node(n["name"])]
+                results = await asyncio.gather(*(get_node_ps(node) for node in nodes))
+                for node, ps_data in zip(nodes, results):
+                    update_node_residency(node["name"], ps_data)
+            else:
+                await get_ps_snapshot()
+        except Exception as e:
+            health_log.warning("⚠️  Residency refresh failed: %s", e)
+        await asyncio.sleep(RESIDENCY_REFRESH_INTERVAL)
+
+
+# 預熱控制器：根據模型的需求歷史，在請求到來之前把模型加載到合適的節點，沒有需求的模型按 keep_alive 自然過期
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "false").lower() == "true"
+WARMUP_INTERVAL = float(os.getenv("WARMUP_INTERVAL", "30"))  # 控制器檢查間隔（秒）
+WARMUP_RATE_HALF_LIFE = float(os.getenv("WARMUP_RATE_HALF_LIFE", "600"))  # 請求速率的衰減半衰期（秒）
+WARMUP_RATE_THRESHOLD = float(os.getenv("WARMUP_RATE_THRESHOLD", "0.5"))  # 每分鐘請求數達到此值且沒有節點常駐時預熱
+WARMUP_HOURLY_THRESHOLD = float(os.getenv("WARMUP_HOURLY_THRESHOLD", "5"))  # 歷史上某個小時的平均請求數達到此值時，在該小時到來前預熱
+WARMUP_LEAD_SECONDS = float(os.getenv("WARMUP_LEAD_SECONDS", "600"))  # 按歷史預熱時提前的時間（秒）
+WARMUP_HISTORY_DECAY = float(os.getenv("WARMUP_HISTORY_DECAY", "0.8"))  # 每小時歷史計數每過一天的衰減係數
+WARMUP_KEEP_ALIVE = os.getenv("WARMUP_KEEP_ALIVE", "15m")  # 預熱和續期請求使用的 keep_alive
+WARMUP_REFRESH_BEFORE = float(os.getenv("WARMUP_REFRESH_BEFORE", "120"))  # 仍有需求的模型在過期前多少秒續期
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "300"))  # 同一模型兩次預熱之間的最短間隔（秒）
+WARMUP_LOAD_TIMEOUT = float(os.getenv("WARMUP_LOAD_TIMEOUT", "300"))  # 等待模型加載完成的超時（秒）
+WARMUP_GB_PER_B = float(os.getenv("WARMUP_GB_PER_B", "0.7"))  # 估算模型內存：每十億參數約多少 GB（含 KV 緩存）
+WARMUP_MAX_MODELS = int(os.getenv("WARMUP_MAX_MODELS", "200"))  # 最多跟蹤的模型數
+WARMUP_HISTORY_FILE = os.getenv("WARMUP_HISTORY_FILE", os.path.join(PROJECT_ROOT, "data", "warmup_history.json"))
+WARMUP_DEMAND_PATHS = ("/api/generate", "/api/chat", "/api/embed", "/api/embeddings",
+                       "/v1/chat/completions", "/v1/completions", "/v1/embeddings")
+
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_keep_alive_seconds(value) -> Optional[float]:
+    """解析 Ollama 的 keep_alive（秒數或 "5m"、"1h30m" 等 Go 時長），負數表示永久保留，返回 None"""
+    text = str(value).strip()
+    try:
+        number = float(text)
+        return None if number < 0 else number
+    except ValueError:
+        pass
+    if text.startswith("-"):
+        return None
+    parts = _DURATION_RE.findall(text)
+    if not parts:
+        return DEFAULT_KEEP_ALIVE_SECONDS
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class DecayedCount:
+    """指數衰減的請求計數：穩定速率 r（每秒）下收斂到 r × half_life / ln2"""
+    
+    __slots__ = ("value", "stamp")
+    
+    def __init__(self, value: float = 0.0, stamp: Optional[float] = None):
+        self.value = value
+        self.stamp = stamp if stamp is not None else time.time()
+    
+    def current(self, now: float) -> float:
+        return self.value * 0.5 ** (max(0.0, now - self.stamp) / WARMUP_RATE_HALF_LIFE)
+    
+    def add(self, now: float, amount: float = 1.0):
+        self.value = self.current(now) + amount
+        self.stamp = now
+    
+    def per_minute(self, now: float) -> float:
+        return self.current(now) * math.log(2) / WARMUP_RATE_HALF_LIFE * 60
+
+
+# 完整模型名 -> {"model_name", "model_size_b", "rate": DecayedCount, "hours": 24 個 [按天衰減的計數, 最後更新的日期序號]}
+model_demand: Dict[str, Dict] = {}
+# 正在進行的預熱（完整模型名），以及每個模型最近一次預熱 / 續期的時間
+warmup_in_flight: Set[str] = set()
+warmup_attempts: Dict[str, float] = {}
+model_demand_dirty = False
+
+
+def record_model_demand(model_name: str, full_model_name: str, model_size_b: Optional[int]):
+    """記錄一次模型請求：短期衰減速率和按小時的歷史計數"""
+    global model_demand_dirty
+    if not WARMUP_ENABLED or model_size_b is None or (shared_counters is not None and worker_index != 0):
+        return
+    # 只跟蹤某個節點上確實存在的模型
+    if model_name not in get_routing_index().model_nodes:
+        return
+    key = normalize_model_tag(full_model_name)
+    now = time.time()
+    entry = model_demand.get(key)
+    if entry is None:
+        if len(model_demand) >= WARMUP_MAX_MODELS:
+            coldest = min(model_demand, key=lambda m: model_demand[m]["rate"].current(now))
+            del model_demand[coldest]
+        entry = model_demand[key] = {
+            "model_name": model_name,
+            "model_size_b": model_size_b,
+            "rate": DecayedCount(),
+            "hours": [[0.0, 0] for _ in range(24)],
+        }
+    entry["rate"].add(now)
+    local = datetime.fromtimestamp(now)
+    slot = entry["hours"][local.hour]
+    day = local.toordinal()
+    slot[0] = slot[0] * WARMUP_HISTORY_DECAY ** (day - slot[1]) + 1
+    slot[1] = day
+    model_demand_dirty = True
+
+
+def expected_hourly_requests(entry: Dict, when: float) -> float:
+    """歷史上 when 所在小時的平均請求數（按天指數加權）"""
+    local = datetime.fromtimestamp(when)
+    value, day = entry["hours"][local.hour]
+    if not day:
+        return 0.0
+    return value * WARMUP_HISTORY_DECAY ** max(0, local.toordinal() - day) * (1 - WARMUP_HISTORY_DECAY)
+
+
+def demand_scale() -> int:
+    """控制器只看到本進程的請求：假定流量在工作進程和集群網關之間平均分配"""
+    workers = GATEWAY_WORKERS if shared_counters is not None else 1
+    return workers * (1 + len(cluster.live_peers()))
+
+
+def node_used_memory_gb(node_name: str, now: float) -> float:
+    loaded = node_loaded_models.get(node_name, {}).values()
+    return sum(m.get("size_vram") or 0 for m in loaded if m["expires_at"] is None or m["expires_at"] > now) / 1e9
+
+
+def pick_warmup_node(full_model_name: str, entry: Dict, now: float) -> Optional[Dict]:
+    """選擇預熱節點：擁有該模型且 supported_model_ranges 允許，並且有空閒的並發槽位；配置了 memory_gb 的節點
+    必須有足夠的空閒內存，避免擠掉其他常駐模型。優先選擇負載最低、空閒內存最多的節點"""
+    need_gb = entry["model_size_b"] * WARMUP_GB_PER_B
+    best, best_score = None, None
+    for node in get_routing_index().candidates(entry["model_name"], entry["model_size_b"]):
+        if node.get("type") == "external" or not node_has_free_slot(node["name"], full_model_name):
+            continue
+        memory_gb = node_config.get(node["name"], {}).get("memory_gb")
+        free_gb = memory_gb - node_used_memory_gb(node["name"], now) if memory_gb else None
+        if free_gb is not None and free_gb < need_gb:
+            continue
+        score = (node_active_connections(node["name"]), -(free_gb or 0))
+        if best_score is None or score < best_score:
+            best, best_score = node, score
+    return best
+
+
+async def send_warmup(node: Dict, full_model_name: str, reason: str):
+    """發送空的 /api/generate：Ollama 只加載模型（或刷新 keep_alive），不生成內容。
+    加載期間佔用節點的一個並發槽位（由 start_warmup 佔用），與普通請求一樣受准入控制的上限約束"""
+    node_name = node["name"]
+    try:
+        response = await get_node_client(node).post(
+            f"{get_node_url(node)}/api/generate",
+            json={"model": full_model_name, "keep_alive": WARMUP_KEEP_ALIVE},
+            headers=get_node_headers(node),
+            timeout=httpx.Timeout(WARMUP_LOAD_TIMEOUT, connect=10.0),
+        )
+        ok = response.status_code == 200
+        if not ok:
+            health_log.warning("⚠️  Warm-up of %s on %s returned %d", full_model_name, node_name, response.status_code)
+    except Exception as e:
+        ok = False
+        health_log.warning("⚠️  Warm-up of %s on %s failed: %s", full_model_name, node_name, str(e) or repr(e))
+    finally:
+        warmup_in_flight.discard(full_model_name)
+        release_node_connection(node_name, full_model_name)
+    warmup_requests.labels(node=node_name, reason=reason, result="ok" if ok else "error").inc()
+    if ok:
+        keep_alive = parse_keep_alive_seconds(WARMUP_KEEP_ALIVE)
+        loaded = node_loaded_models.setdefault(node_name, {}).setdefault(full_model_name, {"size_vram": 0, "expires_at": None})
+        loaded["expires_at"] = time.time() + keep_alive if keep_alive is not None else None
+        health_log.info("🔥 Warmed %s on %s (%s)", full_model_name, node_name, reason)
+
+
+def start_warmup(node: Dict, full_model_name: str, reason: str, now: float):
+    occupy_node_connection(node["name"], full_model_name)
+    warmup_in_flight.add(full_model_name)
+    warmup_attempts[full_model_name] = now
+    asyncio.create_task(send_warmup(node, full_model_name, reason))
+
+
+def run_warmup_round():
+    """一輪預熱決策
+    
+    - rate：衰減速率達到 WARMUP_RATE_THRESHOLD，但沒有任何健康節點常駐該模型
+    - schedule：歷史上 WARMUP_LEAD_SECONDS 之後那個小時的平均請求數達到 WARMUP_HOURLY_THRESHOLD（例如上班時間開始前）
+    - keepalive：仍有需求的常駐模型即將過期時續期；沒有需求的模型不續期，由 Ollama 按 keep_alive 卸載
+    """
+    now = time.time()
+    scale = demand_scale()
+    index = get_routing_index()
+    for key, entry in list(model_demand.items()):
+        if key in warmup_in_flight or now - warmup_attempts.get(key, 0) < WARMUP_RETRY_SECONDS:
+            continue
+        # 集群模式下每個模型只由一個網關決策，避免重覆加載
+        if cluster_peers and node_probe_owner(f"warmup:{key}") != GATEWAY_NAME:
+            continue
+        if entry["rate"].per_minute(now) * scale >= WARMUP_RATE_THRESHOLD:
+            reason = "rate"
+        elif expected_hourly_requests(entry, now + WARMUP_LEAD_SECONDS) * scale >= WARMUP_HOURLY_THRESHOLD:
+            reason = "schedule"
+        else:
+            continue
+        resident = [n for n in index.healthy_nodes if is_model_resident(n["name"], key)]
+        if not resident:
+            node = pick_warmup_node(key, entry, now)
+            if node:
+                start_warmup(node, key, reason, now)
+            continue
+        for node in resident:
+            expires_at = node_loaded_models[node["name"]][key]["expires_at"]
+            if node.get("type") == "external" or expires_at is None or expires_at - now >= WARMUP_REFRESH_BEFORE:
+                continue
+            # 槽位已滿時節點正在處理請求，請求本身會刷新 keep_alive，不需要續期
+            if node_has_free_slot(node["name"], key):
+                start_warmup(node, key, "keepalive", now)
+                break
+
+
+def parse_demand_entry(entry) -> Optional[Dict]:
+    """校驗歷史文件中的一個條目，格式不正確時返回 None"""
+    if not isinstance(entry, dict):
+        return None
+    model_name, model_size_b, hours = entry.get("model_name"), entry.get("model_size_b"), entry.get("hours")
+    if not isinstance(model_name, str) or not isinstance(model_size_b, (int, float)) or isinstance(model_size_b, bool):
+        return None
+    if not isinstance(hours, list) or len(hours) != 24:
+        return None
+    slots = []
+    for slot in hours:
+        if (not isinstance(slot, list) or len(slot) != 2
+                or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in slot)):
+            return None
+        slots.append([float(slot[0]), int(slot[1])])
+    return {"model_name": model_name, "model_size_b": model_size_b, "rate": DecayedCount(), "hours": slots}
+
+
+def load_demand_history():
+    """啟動時讀取按小時的需求歷史（短期速率不保存，重新開始計算）；格式不正確的條目跳過"""
+    try:
+        with open(WARMUP_HISTORY_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        health_log.warning("⚠️  Failed to load warm-up history: %s", e)
+        return
+    if not isinstance(data, dict):
+        health_log.warning("⚠️  Ignoring warm-up history %s: not a JSON object", WARMUP_HISTORY_FILE)
+        return
+    skipped = 0
+    for key, entry in data.items():
+        parsed = parse_demand_entry(entry)
+        if parsed is None:
+            skipped += 1
+        elif len(model_demand) < WARMUP_MAX_MODELS:
+            model_demand[key] = parsed
+    if skipped:
+        health_log.warning("⚠️  Skipped %d malformed entries in warm-up history %s", skipped, WARMUP_HISTORY_FILE)
+
+
+def write_demand_history(data: Dict):
+    os.makedirs(os.path.dirname(WARMUP_HISTORY_FILE), exist_ok=True)
+    tmp_path = f"{WARMUP_HISTORY_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, WARMUP_HISTORY_FILE)
+
+
+async def save_demand_history():
+    """有變化時在線程池中寫入歷史文件（在事件循環中只複製數據）"""
+    global model_demand_dirty
+    if not model_demand_dirty:
+        return
+    data = {
+        key: {"model_name": entry["model_name"], "model_size_b": entry["model_size_b"],
+              "hours": [list(slot) for slot in entry["hours"]]}
+        for key, entry in model_demand.items()
+    }
+    model_demand_dirty = False
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, write_demand_history, data)
+    except Exception:
+        model_demand_dirty = True
+        raise
+
+
+async def warmup_controller():
+    """定期運行預熱決策並保存需求歷史"""
+    try:
+        load_demand_history()
+    except Exception as e:
+        health_log.warning("⚠️  Failed to load warm-up history: %s", e)
+    while True:
+        await asyncio.sleep(WARMUP_INTERVAL)
+        try:
+            run_warmup_round()
+            await save_demand_history()
+        except Exception as e:
+            health_log.warning("⚠️  Warm-up round failed: %s", e)
+
+
+def extract_loaded_model_names(ps_data: Optional[Dict]) -> List[str]:
+    """從 /api/ps 響應中提取已加載到內存的模型名稱"""
+    if ps_data and isinstance(ps_data.get("models"), list):
+        return [model.get("name") or model.get("model") for model in ps_data["models"] if model.get("name") or model.get("model")]
+    return []
+
+
 # 獲取所有節點的運行中進程信息
 @app.get("/nodes/ps")
 async def get_all_nodes_ps():
@@ -1890,6 +5037,9 @@ async def get_all_nodes_ps():
                 "_config_file_path": os.path.abspath(CONFIG_FILE) if CONFIG_FILE else None,
             }
     
+    snapshot = await get_ps_snapshot()
+    now = time.time()
+    
     for node in NODES:
         try:
             url = get_node_url(node)
@@ -1909,6 +5059,8 @@ async def get_all_nodes_ps():
                 "current_weight": node.get("weight", 1.0),
                 "effective_weight": node.get("weight", 1.0),
                 "last_model_sync": None,
+                "consecutive_failures": 0,
+                "next_health_check": None,
             }
         
         if not node.get("enabled", True):
@@ -1918,9 +5070,10 @@ async def get_all_nodes_ps():
                 "error": "Node is disabled"
             }
         else:
-            # 嘗試獲取進程信息（無論健康狀態如何）
+            # 從共享快照讀取進程信息（快照刷新時無論健康狀態如何都會嘗試獲取）
             try:
-                ps_data = await get_node_ps(node)
+                entry = snapshot.get(node["name"], {})
+                ps_data = entry.get("ps")
                 # 對於外部節點，如果無法獲取進程信息，顯示友好提示
                 if node.get("type") == "external" and not ps_data:
                     result[node["name"]] = {
@@ -1945,7 +5098,11 @@ async def get_all_nodes_ps():
                     "error": error_msg
                 }
     
-    print(f"📊 Returning {len(result)} nodes for /nodes/ps")
+        # 每個節點的數據時間戳，便於判斷數據新鮮度
+        fetched_at = snapshot.get(node["name"], {}).get("fetched_at")
+        result[node["name"]]["fetched_at"] = fetched_at
+        result[node["name"]]["age_seconds"] = round(now - fetched_at, 3) if fetched_at else None
+    
     return result
 
 
@@ -1954,18 +5111,13 @@ async def get_node_loaded_models(node: Dict) -> List[str]:
     try:
         base_url = get_node_url(node)
         url = f"{base_url}/api/ps"
-        headers = get_node_headers(node)
-        
         timeout_seconds = node.get("timeout_seconds", 5.0) if node.get("type") == "external" else 5.0
         timeout = httpx.Timeout(timeout_seconds, connect=10.0)
         
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.get(url, headers=headers)
-            if response.status_code == 200:
-                data = response.json()
-                # 檢查是否有 models 字段（已加載的模型）
-                if 'models' in data and isinstance(data['models'], list):
-                    return [model.get('name') or model.get('model') for model in data['models'] if model.get('name') or model.get('model')]
+        node_client = get_node_client(node)
+        response = await node_client.get(url, timeout=timeout)
+        if response.status_code == 200:
+            return extract_loaded_model_names(response.json())
     except Exception:
         pass
     return []
@@ -1974,43 +5126,48 @@ async def get_node_loaded_models(node: Dict) -> List[str]:
 # 獲取所有節點的已加載模型
 @app.get("/nodes/loaded-models")
 async def get_all_nodes_loaded_models():
-    """獲取所有節點已加載到內存的模型列表"""
+    """獲取所有節點已加載到內存的模型列表（與 /nodes/ps 共用同一份快照）"""
     result = {}
+    snapshot = await get_ps_snapshot()
+    now = time.time()
     for node in NODES:
+        entry = snapshot.get(node["name"], {})
+        fetched_at = entry.get("fetched_at")
         if node.get("enabled", True) and node_stats[node["name"]]["is_healthy"]:
-            models = await get_node_loaded_models(node)
-            result[node["name"]] = {
-                "models": models,
-                "count": len(models)
-            }
+            models = extract_loaded_model_names(entry.get("ps"))
         else:
-            result[node["name"]] = {
-                "models": [],
-                "count": 0
-            }
+            models = []
+        result[node["name"]] = {
+            "models": models,
+            "count": len(models),
+            "fetched_at": fetched_at,
+            "age_seconds": round(now - fetched_at, 3) if fetched_at else None,
+        }
     return result
 
 
 # 獲取單個節點的所有已下載模型（通過 /api/tags）
 async def get_node_tags(node: Dict) -> Dict:
-    """獲取節點所有已下載的模型列表（通過 /api/tags）"""
+    """獲取節點所有已下載的模型列表（通過 /api/tags），失敗時返回空列表"""
+    return await fetch_node_tags(node) or {"models": []}
+
+
+async def fetch_node_tags(node: Dict) -> Optional[Dict]:
+    """獲取節點的 /api/tags 響應，失敗時返回 None（與節點確實沒有模型區分開）"""
     try:
         base_url = get_node_url(node)
         url = f"{base_url}/api/tags"
-        headers = get_node_headers(node)
-        
         timeout_seconds = node.get("timeout_seconds", 5.0) if node.get("type") == "external" else 5.0
         timeout = httpx.Timeout(timeout_seconds, connect=10.0)
         
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            response = await client.get(url, headers=headers)
-            if response.status_code == 200:
-                return response.json()
-            else:
-                return {"models": []}
+        node_client = get_node_client(node)
+        response = await node_client.get(url, timeout=timeout)
+        if response.status_code == 200:
+            return response.json()
+        return None
     except Exception as e:
-        print(f"Error fetching tags from {node['name']}: {e}")
-        return {"models": []}
+        health_log.debug("Error fetching tags from %s: %s", node["name"], e)
+        return None
 
 
 @app.get("/nodes/{node_name}/tags")
@@ -2027,62 +5184,111 @@ async def get_node_tags_endpoint(node_name: str):
     return tags_data
 
 
-# 聚合所有節點的模型列表（必須在通配符路由之前）
-@app.get("/api/tags")
-async def get_all_tags():
-    """聚合所有節點的模型列表，返回統一的模型列表"""
+# 聚合模型目錄緩存
+TAGS_CACHE_MAX_AGE = float(os.getenv("TAGS_CACHE_MAX_AGE", "60"))  # 緩存最長使用時間（秒），健康檢查通常會更早刷新
+tags_refresh_flight = SingleFlight()
+
+
+def tags_signature(models: List[Dict]) -> Tuple:
+    """模型列表的簽名（名稱 + digest），用於判斷節點的模型是否有變化"""
+    return tuple(sorted((m.get("name", ""), m.get("digest", "")) for m in models))
+
+
+def update_node_tags(node_name: str, models: List[Dict], health_changed: bool = False):
+    """記錄節點的 /api/tags 結果，只有模型、digest 或節點健康狀態變化時才重建聚合目錄"""
+    old_models = node_tags.get(node_name)
+    node_tags[node_name] = models
+    purge_stale_digests(old_models, models)
+    if (
+        health_changed
+        or tags_catalog is None
+        or old_models is None
+        or tags_signature(old_models) != tags_signature(models)
+    ):
+        rebuild_tags_catalog()
+    else:
+        # 數據剛被確認沒有變化，/api/tags 可以繼續使用緩存，不必按需刷新
+        tags_catalog["checked_at"] = time.time()
+
+
+def invalidate_tags_catalog():
+    """節點健康狀態變化時重建聚合目錄（移除不健康節點的模型）"""
+    if tags_catalog is not None:
+        rebuild_tags_catalog()
+
+
+def rebuild_tags_catalog() -> Dict:
+    """從各健康節點的模型列表聚合出統一目錄，並預先序列化響應體和 ETag"""
+    global tags_catalog
     all_models = {}  # 使用字典來去重，key 是模型名，value 是模型信息
-    all_models_list = []  # 最終返回的模型列表
     
-    # 從所有健康節點獲取模型列表
     for node in NODES:
-        if node.get("enabled", True) and node_stats[node["name"]]["is_healthy"]:
-            try:
-                tags_data = await get_node_tags(node)
-                models = tags_data.get("models", [])
-                
-                for model_info in models:
-                    model_name = model_info.get("name", "")
-                    if not model_name:
-                        continue
-                    
-                    # 如果模型不存在，或當前節點的模型信息更完整（有更多字段），則更新
-                    if model_name not in all_models:
-                        all_models[model_name] = model_info.copy()
-                        # 添加節點信息，標記該模型在哪些節點可用
-                        all_models[model_name]["_available_on_nodes"] = [node["name"]]
-                    else:
-                        # 模型已存在，添加節點信息
-                        if node["name"] not in all_models[model_name].get("_available_on_nodes", []):
-                            all_models[model_name]["_available_on_nodes"].append(node["name"])
-                        
-                        # 如果當前節點的模型信息更完整（有 size, modified_at 等），則更新
-                        current_model = all_models[model_name]
-                        if not current_model.get("size") and model_info.get("size"):
-                            current_model["size"] = model_info["size"]
-                        if not current_model.get("modified_at") and model_info.get("modified_at"):
-                            current_model["modified_at"] = model_info["modified_at"]
-                        if not current_model.get("digest") and model_info.get("digest"):
-                            current_model["digest"] = model_info["digest"]
-            except Exception as e:
-                print(f"Error fetching tags from {node['name']} for aggregation: {e}")
+        if not (node.get("enabled", True) and node_stats[node["name"]]["is_healthy"]):
+            continue
+        for model_info in node_tags.get(node["name"], []):
+            model_name = model_info.get("name", "")
+            if not model_name:
                 continue
-    
-    # 轉換為列表格式，移除內部使用的 _available_on_nodes 字段（或保留作為額外信息）
-    for model_name, model_info in all_models.items():
-        model_data = model_info.copy()
-        # 可選：保留節點信息作為額外字段（如果客戶端需要知道模型在哪個節點）
-        # model_data["available_on_nodes"] = model_data.pop("_available_on_nodes", [])
-        # 或者移除內部字段，保持與 Ollama API 兼容
-        model_data.pop("_available_on_nodes", None)
-        all_models_list.append(model_data)
+            
+            if model_name not in all_models:
+                all_models[model_name] = model_info.copy()
+            else:
+                # 如果當前節點的模型信息更完整（有 size, modified_at 等），則補充
+                current_model = all_models[model_name]
+                if not current_model.get("size") and model_info.get("size"):
+                    current_model["size"] = model_info["size"]
+                if not current_model.get("modified_at") and model_info.get("modified_at"):
+                    current_model["modified_at"] = model_info["modified_at"]
+                if not current_model.get("digest") and model_info.get("digest"):
+                    current_model["digest"] = model_info["digest"]
     
     # 按模型名稱排序
-    all_models_list.sort(key=lambda x: x.get("name", ""))
-    
-    print(f"📦 Aggregated {len(all_models_list)} unique models from all nodes")
-    
-    return {"models": all_models_list}
+    all_models_list = sorted(all_models.values(), key=lambda x: x.get("name", ""))
+    body = json.dumps({"models": all_models_list}, ensure_ascii=False).encode("utf-8")
+    now = time.time()
+    tags_catalog = {
+        "body": body,
+        "etag": f'"{hashlib.sha1(body).hexdigest()}"',
+        "built_at": now,
+        "checked_at": now,
+    }
+    health_log.debug("📦 Aggregated %d unique models from all nodes", len(all_models_list))
+    return tags_catalog
+
+
+async def refresh_tags_catalog() -> Dict:
+    """按需刷新：並發獲取所有健康節點的 /api/tags，有變化時重建目錄；獲取失敗的節點保留上一次的模型列表"""
+    nodes = [n for n in NODES if n.get("enabled", True) and node_stats[n["name"]]["is_healthy"]]
+    results = await asyncio.gather(*(fetch_node_tags(node) for node in nodes))
+    for node, tags_data in zip(nodes, results):
+        if tags_data is not None:
+            update_node_tags(node["name"], tags_data.get("models", []))
+    if tags_catalog is None:
+        rebuild_tags_catalog()
+    else:
+        # 所有節點都獲取失敗時也不在每個請求上重試
+        tags_catalog["checked_at"] = time.time()
+    return tags_catalog
+
+
+async def get_tags_catalog() -> Dict:
+    """獲取聚合目錄：緩存有效時直接返回，否則刷新（並發的刷新請求共享同一輪上游請求）"""
+    catalog = tags_catalog
+    if catalog is not None and time.time() - catalog["checked_at"] < TAGS_CACHE_MAX_AGE:
+        return catalog
+    return await tags_refresh_flight.do("tags", refresh_tags_catalog)
+
+
+# 聚合所有節點的模型列表（必須在通配符路由之前）
+@app.get("/api/tags")
+async def get_all_tags(request: Request):
+    """聚合所有節點的模型列表，返回統一的模型列表（支持 ETag / If-None-Match）"""
+    catalog = await get_tags_catalog()
+    headers = {"ETag": catalog["etag"]}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match == "*" or catalog["etag"] in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=catalog["body"], media_type="application/json", headers=headers)
 
 
 # 模型路由查询 API
@@ -2100,18 +5306,24 @@ async def query_model_routing(model_name: str):
         # 计算模型大小
         model_size_b = get_model_size_b(base_name, full_model_name)
         
-        # 获取所有可能的候选节点
-        candidate_nodes = []
-        rejected_nodes = []
+        # 与代理请求使用同一份路由索引
+        index = get_routing_index()
+        accepted, rejected = index.route(base_name, model_size_b)
+        reject_reasons = {
+            "disabled": "节点已禁用",
+            "unhealthy": "节点不健康",
+            "missing_model": f"节点上没有模型 '{base_name}'",
+        }
         
-        for node in NODES:
+        def describe_node(node: Dict) -> Dict:
             node_name = node["name"]
             node_info = {
                 "name": node_name,
                 "type": node.get("type", "local"),
                 "enabled": node.get("enabled", True),
                 "healthy": node_stats[node_name]["is_healthy"],
-                "has_model": base_name in node_models.get(node_name, set()),
+                "has_model": node_name in index.model_nodes.get(base_name, ()),
+                "model_loaded": is_model_resident(node_name, full_model_name),
                 "suitable_for_size": is_node_suitable_for_model(node_name, model_size_b),
                 "config": node_config.get(node_name, {}),
                 "reasons": []
@@ -2121,49 +5333,34 @@ async def query_model_routing(model_name: str):
             else:
                 node_info["hosts"] = node.get("hosts", [])
                 node_info["port"] = node.get("port", 11434)
-            
-            # 检查各种条件
-            if not node_info["enabled"]:
-                node_info["reasons"].append("节点已禁用")
-                rejected_nodes.append(node_info)
-                continue
-            
-            if not node_info["healthy"]:
-                node_info["reasons"].append("节点不健康")
-                rejected_nodes.append(node_info)
-                continue
-            
-            if not node_info["has_model"]:
-                node_info["reasons"].append(f"节点上没有模型 '{base_name}'")
-                rejected_nodes.append(node_info)
-                continue
-            
-            if not node_info["suitable_for_size"]:
-                node_cfg = node_config.get(node_name, {})
-                ranges = node_cfg.get("supported_model_ranges", [])
+            return node_info
+        
+        candidate_nodes = [describe_node(node) for node in accepted]
+        rejected_nodes = []
+        for node, reason in rejected:
+            node_info = describe_node(node)
+            if reason == "unsupported_size":
+                ranges = node_config.get(node["name"], {}).get("supported_model_ranges", [])
                 node_info["reasons"].append(f"模型大小 {model_size_b}B 不在支持范围内: {ranges}")
-                rejected_nodes.append(node_info)
-                continue
-            
-            # 所有条件都满足
-            candidate_nodes.append(node_info)
+            else:
+                node_info["reasons"].append(reject_reasons[reason])
+            rejected_nodes.append(node_info)
         
         # 如果没有候选节点，显示回退节点
         fallback_nodes = []
         if not candidate_nodes:
-            for node in NODES:
-                if node.get("enabled", True) and node_stats[node["name"]]["is_healthy"]:
-                    fallback_node = {
-                        "name": node["name"],
-                        "type": node.get("type", "local"),
-                        "reason": "回退到所有健康节点（允许模型下载）"
-                    }
-                    if node.get("type") == "external":
-                        fallback_node["api_url"] = node.get("api_url")
-                    else:
-                        fallback_node["hosts"] = node.get("hosts", [])
-                        fallback_node["port"] = node.get("port", 11434)
-                    fallback_nodes.append(fallback_node)
+            for node in index.healthy_nodes:
+                fallback_node = {
+                    "name": node["name"],
+                    "type": node.get("type", "local"),
+                    "reason": "回退到所有健康节点（允许模型下载）"
+                }
+                if node.get("type") == "external":
+                    fallback_node["api_url"] = node.get("api_url")
+                else:
+                    fallback_node["hosts"] = node.get("hosts", [])
+                    fallback_node["port"] = node.get("port", 11434)
+                fallback_nodes.append(fallback_node)
         
         return {
             "model_name": model_name,
@@ -2179,7 +5376,8 @@ async def query_model_routing(model_name: str):
             "rejected_nodes": rejected_nodes,
             "fallback_nodes": fallback_nodes,
             "scheduling_strategy": SCHEDULING_STRATEGY,
-            "will_use_fallback": len(candidate_nodes) == 0
+            "will_use_fallback": len(candidate_nodes) == 0,
+            "index_built_at": datetime.fromtimestamp(index.built_at).isoformat()
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查询路由时发生错误: {str(e)}")
@@ -2234,6 +5432,7 @@ async def save_config_api(request: Request):
         new_config = await request.json()
         success, message = save_config(new_config)
         if success:
+            announce_config_change()
             return {"success": True, "message": message}
         else:
             raise HTTPException(status_code=400, detail=message)
@@ -2248,6 +5447,7 @@ async def reload_config_api():
     """重新加載配置（不保存）"""
     success = load_config()
     if success:
+        announce_config_change()
         return {"success": True, "message": "配置已重新加載"}
     else:
         raise HTTPException(status_code=500, detail="重新加載配置失敗")
@@ -3054,10 +6254,36 @@ async def config_editor():
 
 
 # Prometheus metrics端點
+# /metrics 渲染結果緩存：抓取頻率再高，每 METRICS_CACHE_TTL 秒也只渲染一次
+METRICS_CACHE_TTL = float(os.getenv("METRICS_CACHE_TTL", "1"))
+metrics_cache: Dict = {"body": b"", "rendered_at": 0.0}
+metrics_render_flight = SingleFlight()
+
+# 多進程模式下匯總所有工作進程的指標文件
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    metrics_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(metrics_registry)
+else:
+    metrics_registry = REGISTRY
+
+
+async def render_metrics() -> bytes:
+    """在線程池中渲染指標，避免大量序列時阻塞事件循環"""
+    body = await asyncio.get_running_loop().run_in_executor(None, generate_latest, metrics_registry)
+    metrics_cache["body"] = body
+    metrics_cache["rendered_at"] = time.time()
+    return body
+
+
 @app.get("/metrics")
 async def metrics():
     """Prometheus metrics"""
-    return MetricsResponse(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    if time.time() - metrics_cache["rendered_at"] < METRICS_CACHE_TTL:
+        body = metrics_cache["body"]
+    else:
+        # 同時到達的抓取共享同一次渲染
+        body = await metrics_render_flight.do("metrics", render_metrics)
+    return MetricsResponse(body, media_type=CONTENT_TYPE_LATEST)
 
 
 # 代理所有Ollama API請求（必須放在最後，作為通配符路由）
@@ -3067,7 +6293,87 @@ async def proxy_all(request: Request, path: str):
     return await proxy_request(request, f"/{path}")
 
 
+def bind_socket(host: str, port: int, reuse_port: bool) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_worker(index: int, state_dir: str, host: str, port: int):
+    """工作進程入口：連接共享狀態，以 SO_REUSEPORT 綁定端口（內核在各工作進程之間分配連接）"""
+    global worker_index, shared_counters, routing_state_file
+    worker_index = index
+    shared_counters = SharedCounters(os.path.join(state_dir, "counters.bin"), GATEWAY_WORKERS, index)
+    shared_counters.reset_row()
+    routing_state_file = os.path.join(state_dir, "routing_state.json")
+    
+    sockets = [bind_socket(host, port, reuse_port=True)]
+    if index == 0 and GOSSIP_PORT:
+        # 對等網關的 gossip 請求需要到達做健康檢查的 0 號進程
+        sockets.append(bind_socket(host, GOSSIP_PORT, reuse_port=False))
+    uvicorn.Server(uvicorn.Config(app, host=host, port=port)).run(sockets=sockets)
+
+
+def run_workers(host: str, port: int):
+    """主進程：準備共享狀態目錄，啟動 GATEWAY_WORKERS 個工作進程，工作進程意外退出時重啟"""
+    state_dir = GATEWAY_STATE_DIR or tempfile.mkdtemp(prefix="ollama-gateway-")
+    os.makedirs(state_dir, exist_ok=True)
+    for name in ("counters.bin", "routing_state.json"):
+        try:
+            os.remove(os.path.join(state_dir, name))
+        except FileNotFoundError:
+            pass
+    metrics_dir = os.path.join(state_dir, "metrics")
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+    # 必須在工作進程導入 prometheus_client 之前設置，因此使用 spawn 而不是 fork
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir
+    
+    context = multiprocessing.get_context("spawn")
+    workers: Dict[int, multiprocessing.Process] = {}
+    
+    def start(index: int):
+        process = context.Process(target=run_worker, args=(index, state_dir, host, port), name=f"gateway-worker-{index}")
+        process.start()
+        workers[index] = process
+    
+    stopping = False
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"🚀 Starting {GATEWAY_WORKERS} gateway workers on port {port} (shared state: {state_dir})")
+    for index in range(GATEWAY_WORKERS):
+        start(index)
+    try:
+        while not stopping:
+            time.sleep(1)
+            for index, process in list(workers.items()):
+                if not process.is_alive() and not stopping:
+                    multiprocess.mark_process_dead(process.pid)
+                    print(f"⚠️  Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+                    start(index)
+    finally:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join(10)
+        if not GATEWAY_STATE_DIR:
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+
 if __name__ == "__main__":
     gateway_port = int(os.getenv("GATEWAY_PORT", "11435"))
-    uvicorn.run(app, host="0.0.0.0", port=gateway_port)
+    if GATEWAY_WORKERS > 1 and hasattr(socket, "SO_REUSEPORT"):
+        run_workers("0.0.0.0", gateway_port)
+    else:
+        if GATEWAY_WORKERS > 1:
+            print("⚠️  SO_REUSEPORT is not supported on this platform, running a single worker")
+        uvicorn.run(app, host="0.0.0.0", port=gateway_port)
 